@@ -15,5 +15,8 @@ mkdir -p $DOCKYARD_SRVPROJ/logs
 touch $DOCKYARD_SRVPROJ/logs/famsplit.log
 tail -n 0 -f $DOCKYARD_SRVPROJ/logs/famsplit.log &
 
+echo Starting auto settle worker.
+python manage.py run_settle_worker >> $DOCKYARD_SRVPROJ/logs/famsplit.log 2>&1 &
+
 echo Starting Django runserver.
 python manage.py runserver 0.0.0.0:8000
@@ -53,6 +53,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'splitApp.middleware.QueryCountMiddleware',
 ]
 
 ROOT_URLCONF = 'famsplit.urls'
@@ -91,8 +92,10 @@ DATABASES = {
 }
 
 REST_FRAMEWORK = {
+    # authenticates from the token claims without a query,
+    # see splitApp.authentication
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'splitApp.authentication.ProfileJWTAuthentication',
     ],
 }
 
@@ -103,6 +106,82 @@ SIMPLE_JWT = {
     'BLACKLIST_AFTER_ROTATION': True,
 }
 
+# Cache used for settlement plans and balances.
+# It has to be shared by every process writing bills, including the
+# run_settle_worker process started by entrypoint.sh, otherwise their
+# invalidations are not seen by the web process. Files are shared by
+# processes on one host, use memcached/redis when running on several.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/famsplit_cache',
+        'TIMEOUT': 60*60,
+        'OPTIONS': {
+            # a third of the entries are culled once this is reached
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+# In-process LRU cache for group/username/membership resolution,
+# see splitApp.cache. Entries expire after RESOLUTION_CACHE_TIMEOUT
+# seconds which bounds how stale other processes can be.
+# RESOLUTION_CACHE_SHARED also keeps entries in the shared cache
+# above, so processes can fill entries for each other
+RESOLUTION_CACHE_MAX_ENTRIES = 10000
+RESOLUTION_CACHE_TIMEOUT = 60
+RESOLUTION_CACHE_SHARED = False
+
+# Max SQL queries per request by url name, requests going over
+# are logged by QueryCountMiddleware and fail the query budget tests.
+# Budgets assume tokens carry the profile claims (older tokens add
+# 2 queries) and group/username/membership resolution is cached
+# (a cold resolution cache adds up to 3 queries)
+QUERY_BUDGET_DEFAULT = 10
+QUERY_BUDGETS = {
+    'token_obtain_pair': 2,
+    'token_refresh': 0,
+    'create_user': 6,
+    'create_group': 2,
+    'add_member': 6,
+    'remove_member': 3,
+    'group_balance': 2,
+    'group_settle_balance': 14,
+    'group_add_picture': 1,
+    # rows are read while the response streams, after the count
+    'group_export': 1,
+    'add_bill': 15,
+    'edit_bill': 20,
+    'bill_comment': 3,
+    'group_bills': 4,
+    # scales with the number of batches written,
+    # budget is for the one bill file in QueryBudgetTest
+    'import_bills': 17,
+    'user_balance': 1,
+    'user_add_picture': 2,
+    # membership read and one balance read per group on the
+    # worker threads, budget is for the four groups in AsyncBalanceTest
+    'user_group_balances': 5,
+    'group_balance_async': 2,
+    'user_balance_async': 1,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'splitApp': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -149,4 +228,38 @@ MEDIA_ROOT = 'media'
 SUPPORTED_CURRENCIES = (
         ('INR','inr'),
         ('USD','usd'),
-    )
\ No newline at end of file
+    )
+# Amounts are stored as integers in the minor unit of the
+# group currency, this maps currency -> number of decimal places
+CURRENCY_MINOR_UNITS = {
+        'INR': 2,
+        'USD': 2,
+    }
+
+# Strategies groups can use to simplify payments. optimal finds
+# the fewest transfers but is exponential in group size, so groups
+# with more members than the limit below fall back to greedy
+SETTLEMENT_STRATEGIES = (
+        ('greedy','greedy'),
+        ('optimal','optimal'),
+    )
+SETTLEMENT_OPTIMAL_MAX_MEMBERS = 12
+
+# Groups with at least this many members settle with numpy
+# vectorized code, if numpy is installed
+VECTORIZED_SETTLEMENT_MIN_MEMBERS = 500
+
+# Bills per page of the group bill history API
+BILL_HISTORY_PAGE_SIZE = 20
+BILL_HISTORY_MAX_PAGE_SIZE = 100
+
+# Groups whose balances are computed at once on worker threads
+# by the all groups balance API, per request. Each worker thread
+# holds a database connection while busy, set CONN_MAX_AGE to keep
+# them open between requests
+BALANCE_FANOUT_CONCURRENCY = 8
+
+# Bills written per transaction by the bill import,
+# and failed rows reported back at most
+BILL_IMPORT_BATCH_SIZE = 500
+BILL_IMPORT_MAX_ERRORS = 100
@@ -24,7 +24,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
 
     # Auth Actions
-    path('api/token/', jwt_views.TokenObtainPairView.as_view(),
+    path('api/token/', split_app_views.ObtainTokenPairView.as_view(),
         name='token_obtain_pair'),
     path('api/token/refresh/', jwt_views.TokenRefreshView.as_view(),
         name='token_refresh'),
@@ -44,6 +44,8 @@ urlpatterns = [
         name='group_settle_balance'),
     path('group/addpicture/', split_app_views.AddGroupIconView.as_view(),
         name='group_add_picture'),
+    path('group/export/', split_app_views.ExportGroupLedgerView.as_view(),
+        name='group_export'),
 
     # Bill Actions
     path('group/addbill/', split_app_views.AddBillView.as_view(),
@@ -52,10 +54,22 @@ urlpatterns = [
         name='edit_bill'),
     path('group/billcomment/', split_app_views.AddBillCommentView.as_view(),
         name='bill_comment'),
+    path('group/bills/', split_app_views.GetGroupBillsView.as_view(),
+        name='group_bills'),
+    path('group/importbills/', split_app_views.ImportBillsView.as_view(),
+        name='import_bills'),
 
     # User Actions
     path('user/balance/', split_app_views.GetUserBalanceView.as_view(),
         name='user_balance'),
     path('user/addpicture/', split_app_views.AddUserProfilePictureView.as_view(),
         name='user_add_picture'),
+    path('user/groupbalances/', split_app_views.get_user_group_balances,
+        name='user_group_balances'),
+
+    # Async variants of balance actions, served best under ASGI
+    path('async/group/balance/', split_app_views.get_group_balance_async,
+        name='group_balance_async'),
+    path('async/user/balance/', split_app_views.get_user_balance_async,
+        name='user_balance_async'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
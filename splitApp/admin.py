@@ -1,41 +1,112 @@
 from django.contrib import admin
 from splitApp.models import (
     User, Group, Membership,
-    Bill, Expense, Payment, Note
+    Bill, Expense, Payment, Note, PairBalance,
+    GroupBalance, SettleJob, BalanceCheckpoint, ArchivedMembership,
+    ArchivedExpense, ArchivedPayment
 )
+import splitApp.cache as splitAppCache
 # Register your models here.
 
+class LedgerReadOnlyAdmin(admin.ModelAdmin):
+    """
+    rows which the balance ledgers are derived from or which are
+    the ledgers themselves. Writes go through splitApp.helpers only,
+    an admin edit would drift PairBalance/GroupBalance from the raw
+    expenses/payments
+    """
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 class UserAdmin(admin.ModelAdmin):
     ordering = ("name", "email")
     search_fields = ("name", "email")
     list_display = ("name", "email")
 
+    def delete_queryset(self, request, queryset):
+        # bulk soft delete sends no signals, drop cached usernames here
+        usernames = list(queryset.values_list("user__username", flat=True))
+        super().delete_queryset(request, queryset)
+        splitAppCache.invalidate_profiles(usernames)
+
 class GroupAdmin(admin.ModelAdmin):
     ordering = ("name",)
     search_fields = ("name",)
-    list_display = ("name", "created_by", "simplify_payments", "default_currency")
+    list_display = ("name", "created_by", "simplify_payments",
+                    "settlement_strategy", "default_currency")
+
+    def delete_queryset(self, request, queryset):
+        # bulk soft delete sends no signals, drop cached names here
+        names = list(queryset.values_list("name", flat=True))
+        super().delete_queryset(request, queryset)
+        splitAppCache.invalidate_groups(names)
 
 class MembershipAdmin(admin.ModelAdmin):
     search_fields = ("user__name", "group__name")
     list_display = ("user", "group")
 
+    def delete_queryset(self, request, queryset):
+        # bulk soft delete sends no signals, drop cached checks here
+        memberships = list(queryset.values_list("group_id", "user_id"))
+        super().delete_queryset(request, queryset)
+        splitAppCache.invalidate_memberships(memberships)
+
 class BillAdmin(admin.ModelAdmin):
     ordering = ("title",)
     search_fields = ("title", "group__name", "added_by__name")
     list_display = ("title", "group", "added_by", "bill_amount")
 
-class ExpenseAdmin(admin.ModelAdmin):
-    search_fields = ("user__name", "bill__title")
-    list_display = ("bill", "user", "amount_paid", "amount_owed")
+class ExpenseAdmin(LedgerReadOnlyAdmin):
+    search_fields = ("user__name", "bill__title", "group__name")
+    list_display = ("bill", "group", "user", "amount_paid", "amount_owed")
+    exclude = ("group",)
 
-class PaymentAdmin(admin.ModelAdmin):
-    search_fields = ("bill__title", "payer__name", "receiver__name")
-    list_display = ("bill", "payer", "receiver", "amount")
+class PaymentAdmin(LedgerReadOnlyAdmin):
+    search_fields = ("bill__title", "group__name", "payer__name", "receiver__name")
+    list_display = ("bill", "group", "payer", "receiver", "amount")
+    exclude = ("group",)
 
 class NoteAdmin(admin.ModelAdmin):
     search_fields = ("bill__title",)
     list_display = ("bill", "text", "image")
 
+class PairBalanceAdmin(LedgerReadOnlyAdmin):
+    search_fields = ("group__name", "user_a__name", "user_b__name")
+    list_display = ("group", "user_a", "user_b", "amount")
+
+class GroupBalanceAdmin(LedgerReadOnlyAdmin):
+    search_fields = ("group__name", "user__name")
+    list_display = ("group", "user", "amount")
+
+class SettleJobAdmin(admin.ModelAdmin):
+    search_fields = ("user__name",)
+    list_filter = ("status",)
+    list_display = ("user", "status", "attempts", "run_after", "last_error")
+
+class BalanceCheckpointAdmin(admin.ModelAdmin):
+    search_fields = ("group__name",)
+    list_display = ("group", "cutoff", "created_on")
+
+class ArchivedMembershipAdmin(admin.ModelAdmin):
+    search_fields = ("user__name", "group__name")
+    list_display = ("user", "group", "deleted_on", "archived_on")
+
+class ArchivedExpenseAdmin(admin.ModelAdmin):
+    search_fields = ("user__name", "bill__title", "group__name")
+    list_display = ("bill", "group", "user", "amount_paid", "amount_owed",
+                    "deleted_on", "archived_on")
+
+class ArchivedPaymentAdmin(admin.ModelAdmin):
+    search_fields = ("bill__title", "group__name", "payer__name", "receiver__name")
+    list_display = ("bill", "group", "payer", "receiver", "amount",
+                    "deleted_on", "archived_on")
+
 admin.site.register(User, UserAdmin)
 admin.site.register(Group, GroupAdmin)
 admin.site.register(Membership, MembershipAdmin)
@@ -43,3 +114,10 @@ admin.site.register(Bill, BillAdmin)
 admin.site.register(Expense, ExpenseAdmin)
 admin.site.register(Payment, PaymentAdmin)
 admin.site.register(Note, NoteAdmin)
+admin.site.register(PairBalance, PairBalanceAdmin)
+admin.site.register(GroupBalance, GroupBalanceAdmin)
+admin.site.register(SettleJob, SettleJobAdmin)
+admin.site.register(BalanceCheckpoint, BalanceCheckpointAdmin)
+admin.site.register(ArchivedMembership, ArchivedMembershipAdmin)
+admin.site.register(ArchivedExpense, ArchivedExpenseAdmin)
+admin.site.register(ArchivedPayment, ArchivedPaymentAdmin)
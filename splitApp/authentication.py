@@ -0,0 +1,73 @@
+"""
+JWT authentication without a database lookup per request.
+
+Tokens carry the id of the splitApp User profile and the username
+besides the django user id, so the request user is built from the
+token claims alone. The database row is only read when a view uses
+a field the token does not carry. Tokens issued before these claims
+existed fall back to loading the user from the database.
+"""
+from django.contrib.auth.models import User as DjangoUser
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+
+from splitApp.models import User
+
+PROFILE_ID_CLAIM = 'profile_id'
+USERNAME_CLAIM = 'username'
+
+
+class ProfileTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    token pair with the profile id and username claims,
+    refreshed access tokens copy them from the refresh token
+    """
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token[PROFILE_ID_CLAIM] = User.objects.values_list(
+            'id', flat=True
+        ).get(user_id=user.id)
+        token[USERNAME_CLAIM] = user.username
+        return token
+
+
+class ProfileTokenUser(TokenUser):
+    """
+    request user backed by the token claims. user is the splitApp
+    User profile with only its ids loaded, other profile fields are
+    read on access. Any other django user field loads the whole row
+    """
+    @cached_property
+    def user(self):
+        profile = User.from_db(
+            'default', ['id', 'user_id'], [self.token[PROFILE_ID_CLAIM], self.id]
+        )
+        profile.user = DjangoUser.from_db(
+            'default', ['id', 'username'], [self.id, self.username]
+        )
+        return profile
+
+    @cached_property
+    def _django_user(self):
+        return DjangoUser.objects.get(id=self.id)
+
+    def __getattr__(self, name):
+        # only called for attributes TokenUser does not have
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._django_user, name)
+
+
+class ProfileJWTAuthentication(JWTAuthentication):
+    """
+    authenticate from the token claims with no query. Users are not
+    checked for being active or deleted again until the token expires
+    """
+    def get_user(self, validated_token):
+        if PROFILE_ID_CLAIM not in validated_token:
+            # token issued before the profile claims were added
+            return super().get_user(validated_token)
+        return ProfileTokenUser(validated_token)
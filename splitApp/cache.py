@@ -0,0 +1,308 @@
+"""
+caching on top of django's cache framework.
+
+Cached values are keyed by a version counter which writes bump,
+so a stale value is never read back, it is just left to be evicted.
+Counters start from the current time when missing (eg evicted or
+cache restarted) so they never go back to a version used before.
+Writes happen in the web and the settle worker processes, so the
+cache backend has to be shared between them, see CACHES in settings.
+
+Group, username and membership resolution is cached separately in
+a bounded LRU per process, dropped by model signals on writes.
+"""
+import threading
+import time
+from collections import defaultdict, OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.fields.files import FieldFile
+
+
+# hit/miss counters of this process, see get_stats
+_stats = defaultdict(lambda:{'hits': 0, 'misses': 0})
+_stats_lock = threading.Lock()
+
+
+def _record(name, hit):
+    with _stats_lock:
+        _stats[name]['hits' if hit else 'misses'] += 1
+
+
+def get_stats():
+    """
+    hit/miss counts per cached value type since the process
+    started or the last reset_stats
+    """
+    with _stats_lock:
+        return {name: dict(counts) for name, counts in _stats.items()}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_versions(keys):
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # missing counter, a fresh one is newer anyway
+            cache.add(key, time.time_ns(), timeout=None)
+
+
+def _group_version_key(group_id):
+    return 'group_ledger_version:%s' % group_id
+
+
+def _bump_versions_on_write(keys):
+    """
+    bump right away and again once the current transaction commits.
+    A reader between the two bumps may cache data from before the
+    commit, the second bump makes sure it is never read back
+    """
+    _bump_versions(keys)
+    transaction.on_commit(lambda: _bump_versions(keys))
+
+
+def bump_group_ledger_versions(group_ids):
+    """
+    invalidate cached values of groups after a write
+    """
+    _bump_versions_on_write([
+        _group_version_key(group_id) for group_id in set(group_ids)
+    ])
+
+
+def get_group_settlement_plan(group_obj, compute_plan):
+    """
+    settlement plan of a group for its current ledger version.
+    compute_plan(group_obj) is only called on a cache miss
+    """
+    version = _get_version(_group_version_key(group_obj.id))
+    key = 'settlement_plan:%s:%s:%s' % (
+        group_obj.id, group_obj.settlement_strategy, version
+    )
+    plan = cache.get(key)
+    _record('settlement_plan', plan is not None)
+    if plan is None:
+        plan = compute_plan(group_obj)
+        cache.set(key, plan)
+    return plan
+
+
+def _user_version_key(user_id):
+    return 'user_balance_version:%s' % user_id
+
+
+def bump_user_balance_versions(user_ids):
+    """
+    invalidate cached overall balances of users after a write
+    """
+    _bump_versions_on_write([
+        _user_version_key(user_id) for user_id in set(user_ids)
+    ])
+
+
+def get_overall_user_balance(user, compute_balance):
+    """
+    overall balance of a user for the current version.
+    compute_balance(user) is only called on a cache miss
+    """
+    version = _get_version(_user_version_key(user.id))
+    key = 'user_balance:%s:%s' % (user.id, version)
+    owe_map = cache.get(key)
+    _record('user_balance', owe_map is not None)
+    if owe_map is None:
+        owe_map = compute_balance(user)
+        cache.set(key, owe_map)
+    return owe_map
+
+
+class LRUCache:
+    """
+    bounded in-process cache dropping the least recently used
+    entries first. Entries also expire after timeout seconds
+    """
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        (hit, value) for key
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# name -> id/membership resolution. Entries are dropped by the
+# write paths of this process and, with RESOLUTION_CACHE_SHARED, from
+# the shared cache too. Other processes can see a stale local entry
+# for at most RESOLUTION_CACHE_TIMEOUT seconds
+_resolution_cache = LRUCache(
+    settings.RESOLUTION_CACHE_MAX_ENTRIES, settings.RESOLUTION_CACHE_TIMEOUT
+)
+
+
+def _snapshot(instance):
+    """
+    field values of a model instance, None for a missing row
+    """
+    if instance is None:
+        return None
+    snapshot = {}
+    for field in instance._meta.concrete_fields:
+        value = getattr(instance, field.attname)
+        if isinstance(value, FieldFile):
+            value = value.name
+        snapshot[field.attname] = value
+    return snapshot
+
+
+def _from_snapshot(model, snapshot):
+    if snapshot is None:
+        return None
+    return model.from_db('default', list(snapshot.keys()), list(snapshot.values()))
+
+
+def _resolve(key, load):
+    """
+    cached result of load(), looked up in this process
+    first and then in the shared cache if enabled
+    """
+    hit, value = _resolution_cache.get(key)
+    if not hit and settings.RESOLUTION_CACHE_SHARED:
+        shared = cache.get(key, _resolution_cache)
+        if shared is not _resolution_cache:
+            hit, value = True, shared
+            _resolution_cache.set(key, value)
+    _record('resolution', hit)
+    if not hit:
+        value = load()
+        _resolution_cache.set(key, value)
+        if settings.RESOLUTION_CACHE_SHARED:
+            cache.set(key, value)
+    return value
+
+
+def _invalidate(keys):
+    _resolution_cache.delete_many(keys)
+    if settings.RESOLUTION_CACHE_SHARED:
+        cache.delete_many(keys)
+
+
+def _invalidate_on_write(keys):
+    """
+    drop right away and again once the current transaction
+    commits, see _bump_versions_on_write
+    """
+    keys = list(keys)
+    _invalidate(keys)
+    transaction.on_commit(lambda: _invalidate(keys))
+
+
+def _group_key(group_name):
+    return 'group:%s' % group_name
+
+
+def _profile_key(username):
+    return 'profile:%s' % username
+
+
+def _membership_key(group_id, user_id):
+    return 'membership:%s:%s' % (group_id, user_id)
+
+
+def get_group(group_name, model, load_group):
+    """
+    snapshot of the group named group_name as a model instance,
+    None if there is none. load_group() is only called on a miss.
+    Use a fresh instance from the database to change the group
+    """
+    return _from_snapshot(model, _resolve(
+        _group_key(group_name), lambda: _snapshot(load_group())
+    ))
+
+
+def get_profile(username, model, load_profile):
+    """
+    snapshot of the profile of username as a model instance,
+    None if there is none. load_profile() is only called on a miss
+    """
+    return _from_snapshot(model, _resolve(
+        _profile_key(username), lambda: _snapshot(load_profile())
+    ))
+
+
+def is_member(group_id, user_id, load_membership):
+    """
+    whether user_id is a member of group_id.
+    load_membership() is only called on a miss
+    """
+    return _resolve(_membership_key(group_id, user_id), load_membership)
+
+
+def invalidate_groups(group_names):
+    _invalidate_on_write(
+        _group_key(name) for name in set(group_names) if name is not None
+    )
+
+
+def invalidate_profiles(usernames):
+    _invalidate_on_write(
+        _profile_key(username) for username in set(usernames) if username is not None
+    )
+
+
+def invalidate_memberships(memberships):
+    """
+    memberships is an iterable of (group_id, user_id)
+    """
+    _invalidate_on_write(
+        _membership_key(group_id, user_id) for group_id, user_id in set(memberships)
+    )
+
+
+def clear_resolution_cache():
+    """
+    drop every entry cached in this process
+    """
+    _resolution_cache.clear()
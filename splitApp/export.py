@@ -0,0 +1,130 @@
+"""
+streaming export of a group's ledger.
+
+Rows are read in keyset batches on id instead of one big queryset.
+The MySQL driver buffers a whole result set client side, even with
+QuerySet.iterator(), so bounded batches are what keeps memory flat
+however big the group is. Output is built one line at a time and
+optionally gzip compressed on the fly.
+"""
+import csv
+import json
+import zlib
+from decimal import Decimal
+
+from django.conf import settings
+
+from splitApp.models import Bill, Expense, Payment
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+CSV_COLUMNS = (
+    'record', 'id', 'bill_id', 'created_on', 'title', 'added_by',
+    'user', 'payer', 'receiver', 'currency', 'amount', 'paid', 'owed',
+)
+
+
+def _ledger_tables(group_obj, max_bill_id):
+    """
+    (record type, queryset, output field -> lookup, amount fields)
+    of every table in the export
+    """
+    return (
+        ('bill', Bill.objects.filter(group=group_obj, id__lte=max_bill_id), {
+            'id': 'id', 'created_on': 'created_on', 'title': 'title',
+            'added_by': 'added_by__user__username', 'amount': 'bill_amount',
+        }, ('amount',)),
+        ('expense', Expense.objects.filter(group=group_obj, bill_id__lte=max_bill_id), {
+            'id': 'id', 'bill_id': 'bill_id', 'created_on': 'created_on',
+            'user': 'user__user__username', 'paid': 'amount_paid',
+            'owed': 'amount_owed',
+        }, ('paid', 'owed')),
+        ('payment', Payment.objects.filter(group=group_obj, bill_id__lte=max_bill_id), {
+            'id': 'id', 'bill_id': 'bill_id', 'created_on': 'created_on',
+            'payer': 'payer__user__username',
+            'receiver': 'receiver__user__username', 'amount': 'amount',
+        }, ('amount',)),
+    )
+
+
+def iter_ledger_rows(group_obj, batch_size=2000):
+    """
+    yield every bill, expense and payment of a group as a dict,
+    amounts as exact decimal strings in the group currency.
+    Only bills that existed when the export started are included
+    """
+    currency = group_obj.default_currency
+    exponent = settings.CURRENCY_MINOR_UNITS[currency]
+    max_bill_id = Bill.objects.filter(group=group_obj).order_by(
+        '-id'
+    ).values_list('id', flat=True).first() or 0
+
+    for record, queryset, fields, amount_fields in _ledger_tables(group_obj, max_bill_id):
+        last_id = 0
+        while True:
+            rows = list(queryset.filter(id__gt=last_id).order_by('id').values_list(
+                *fields.values()
+            )[:batch_size])
+            for values in rows:
+                row = dict(zip(fields.keys(), values))
+                row['record'] = record
+                row['currency'] = currency
+                row['created_on'] = row['created_on'].isoformat()
+                for field in amount_fields:
+                    row[field] = str(Decimal(row[field]).scaleb(-exponent))
+                yield row
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+
+
+def iter_ndjson(rows):
+    """
+    one JSON object per line
+    """
+    for row in rows:
+        yield (json.dumps(row) + '\n').encode()
+
+
+class _LineBuffer:
+    """
+    file like object handing back what csv.writer writes
+    """
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    """
+    header line then one line per row, columns
+    a row type does not have are left empty
+    """
+    writer = csv.writer(_LineBuffer())
+    yield writer.writerow(CSV_COLUMNS).encode()
+    for row in rows:
+        yield writer.writerow([row.get(column, '') for column in CSV_COLUMNS]).encode()
+
+
+def iter_gzip(chunks, level=6):
+    """
+    gzip compress a stream of byte chunks as it is produced
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_group_export(group_obj, export_format='ndjson', compress=False):
+    """
+    byte chunks of the ledger export of a group
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('Export format should be one of %s' % ', '.join(EXPORT_FORMATS))
+    rows = iter_ledger_rows(group_obj)
+    chunks = iter_ndjson(rows) if export_format == 'ndjson' else iter_csv(rows)
+    if compress:
+        chunks = iter_gzip(chunks)
+    return chunks
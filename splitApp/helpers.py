@@ -1,38 +1,213 @@
-from splitApp.models import Membership, User, Payment, Expense, Bill
+from splitApp.models import (
+    Membership, User, Group, Payment, Expense, Bill, Note, PairBalance,
+    GroupBalance, SettleJob, BalanceCheckpoint, CheckpointBalance
+)
+import splitApp.cache as splitAppCache
+from asgiref.sync import sync_to_async
 from collections import defaultdict
-from django.db import transaction
-from queue import PriorityQueue
-from django.db.models import Q
-import math
+from django.contrib.auth.models import User as DjangoUser
+from decimal import Decimal, ROUND_HALF_UP, ROUND_FLOOR
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import Q, F, Sum, Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import asyncio
+import base64
+import heapq
 
-def validate_bill_split(bill_amount, split_type, split_data, pay_data, group_obj):
+try:
+    import numpy
+except ImportError:
+    # vectorized settlement for large groups is skipped without numpy
+    numpy = None
+
+
+def to_minor_units(amount, currency):
+    """
+    convert an amount sent over HTTP (eg 10.5 INR) to
+    integer minor units of the currency (eg 1050 paise)
+    """
+    exponent = settings.CURRENCY_MINOR_UNITS[currency]
+    return int(
+        Decimal(str(amount)).scaleb(exponent).quantize(
+            Decimal(1), rounding=ROUND_HALF_UP
+        )
+    )
+
+
+def to_major_units(amount, currency):
+    """
+    convert integer minor units back to the float
+    amount exposed by the API
+    """
+    exponent = settings.CURRENCY_MINOR_UNITS[currency]
+    return float(Decimal(amount).scaleb(-exponent))
+
+
+def owe_map_to_major_units(owe_map, currency):
+    """
+    convert a balance map in minor units for the API response
+    """
+    return {
+        username: to_major_units(balance, currency)
+        for username, balance in owe_map.items()
+    }
+
+
+def bill_data_to_minor_units(bill_amount, split_type, split_data, pay_data, currency):
+    """
+    convert bill amounts sent over HTTP to minor units.
+    percentage and equal split values are not amounts
+    and are kept as they are
+    """
+    bill_amount = to_minor_units(bill_amount, currency)
+    pay_data = {
+        username: to_minor_units(amount, currency)
+        for username, amount in pay_data.items()
+    }
+    if split_type == "fixed":
+        split_data = {
+            username: to_minor_units(amount, currency)
+            for username, amount in split_data.items()
+        }
+    return bill_amount, split_data, pay_data
+
+
+def get_group_by_name(group_name):
+    """
+    group named group_name from the resolution cache, raises
+    Group.DoesNotExist for an unknown group. Related objects are
+    not cached, compare ids (eg created_by_id) instead
+    """
+    group_obj = splitAppCache.get_group(
+        group_name, Group, lambda: Group.objects.filter(name=group_name).first()
+    )
+    if group_obj is None:
+        raise Group.DoesNotExist('Group matching query does not exist.')
+    return group_obj
+
+
+def get_user_by_username(username):
+    """
+    user named username from the resolution cache, raises
+    User.DoesNotExist for an unknown user. user.user only
+    has id and username loaded, other fields are fetched on access
+    """
+    user_obj = splitAppCache.get_profile(
+        username, User, lambda: User.objects.filter(user__username=username).first()
+    )
+    if user_obj is None:
+        raise User.DoesNotExist('User matching query does not exist.')
+    user_obj.user = DjangoUser.from_db(
+        'default', ['id', 'username'], [user_obj.user_id, username]
+    )
+    return user_obj
+
+
+def is_group_member(group_id, user_id):
+    """
+    whether a user is a member of a group, from the resolution cache
+    """
+    return splitAppCache.is_member(
+        group_id, user_id,
+        lambda: Membership.objects.filter(group_id=group_id, user_id=user_id).exists()
+    )
+
+
+class GroupRoster:
     """
-    validate the split amount and pay amount with total amount
+    members of a group loaded once per request with a single
+    joined query, shared by bill validation, split computation
+    and persistence. members maps username -> User.
+    When usernames are given only those members are loaded and
+    the roster is not complete, see bill_usernames
     """
-    pay_amount = 0
-    for amount in pay_data.values():
-        pay_amount += float(amount)
+    def __init__(self, group, members, complete=True):
+        self.group = group
+        self.members = members
+        self.complete = complete
+
+    @staticmethod
+    def _members(memberships):
+        return {
+            membership.user.user.username: membership.user
+            for membership in memberships
+        }
+
+    @classmethod
+    def load(cls, group_obj, usernames=None):
+        memberships = Membership.objects.filter(
+            group=group_obj
+        ).select_related('user__user')
+        if usernames is not None:
+            memberships = memberships.filter(user__user__username__in=usernames)
+        return cls(group_obj, cls._members(memberships), usernames is None)
+
+    @classmethod
+    def load_by_name(cls, group_name, usernames=None):
+        """
+        roster of the group named group_name, the group comes from the
+        same query. raises Group.DoesNotExist for an unknown group
+        """
+        memberships = Membership.objects.filter(
+            group__name=group_name, group__is_deleted=False
+        ).select_related('group', 'user__user')
+        if usernames is not None:
+            memberships = memberships.filter(user__user__username__in=usernames)
+        memberships = list(memberships)
+        if not memberships:
+            group_obj = Group.objects.get(name=group_name)
+        else:
+            group_obj = memberships[0].group
+        return cls(group_obj, cls._members(memberships), usernames is None)
+
+    def __contains__(self, username):
+        return username in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def user(self, username):
+        return self.members[username]
+
+
+def bill_usernames(split_type, split_data, pay_data):
+    """
+    usernames a bill involves, so only they are loaded into the
+    GroupRoster. None when the bill is split equally between all
+    members and the whole roster is needed
+    """
+    if split_type == "equal" and not split_data:
+        return None
+    return set(split_data.keys()).union(pay_data.keys())
+
+
+def validate_bill_split(bill_amount, split_type, split_data, pay_data, roster):
+    """
+    validate the split amount and pay amount with total amount.
+    amounts are in minor units, see bill_data_to_minor_units.
+    usernames are checked against the GroupRoster of the bill group
+    """
+    pay_amount = sum(pay_data.values())
     if pay_amount != bill_amount:
         return False, "Bill and pay amount mismatch."
 
     usernames = list(set(split_data.keys()).union(set(pay_data.keys())))
-    users_count = Membership.objects.filter(
-        user__user__username__in=usernames, group=group_obj
-        ).count()
+    users_count = sum(1 for username in usernames if username in roster)
 
     if users_count != len(usernames):
         return False, "Invalid member passed."
 
-    split_total = 0
-    for amount in split_data.values():
-        split_total += float(amount)
-
     if split_type == "fixed":
         # sum of splits should be equal to total amount
-        if split_total != bill_amount:
+        if sum(split_data.values()) != bill_amount:
             return False, "Bill and split amount mismatch."
     elif split_type == "percentage":
         # sum of split percentages should be 100
+        split_total = sum(
+            Decimal(str(percentage)) for percentage in split_data.values()
+        )
         if split_total != 100:
             return False, "Bill and split amount mismatch."
     elif split_type != "equal":
@@ -40,69 +215,107 @@ def validate_bill_split(bill_amount, split_type, split_data, pay_data, group_obj
     return True, "valid"
 
 
-def compute_expense(bill_amount, split_type, split_data, pay_data, group_obj):
+def compute_expense(bill_amount, split_type, split_data, pay_data, roster):
     """
-    compute amounts owed and paid by users in group
+    compute amounts owed and paid by users involved in a bill.
+    amounts are integer minor units, rounding remainders are
+    given out one unit at a time so shares always add up to the bill.
+    Only users who pay or owe something are in the result
     """
-    memberships = Membership.objects.filter(group=group_obj)
-    user_object_map = {
-        membership.user.user.username: membership.user for membership in memberships
-    }
+    user_object_map = roster.members
 
-    expense_data = {
-        user_obj:[0,0] for user_obj in user_object_map.values()
-    }
+    expense_data = defaultdict(lambda:[0,0])
 
     for username, amount in pay_data.items():
         user = user_object_map[username]
-        expense_data[user][0] = float(amount)
+        expense_data[user][0] = amount
 
     if split_type == "fixed":
         for username, amount in split_data.items():
             user = user_object_map[username]
-            expense_data[user][1] = float(amount)
+            expense_data[user][1] = amount
     elif split_type == "percentage":
-        for username, percentage in split_data.items():
+        shares = {
+            username: Decimal(str(percentage))*bill_amount/100
+            for username, percentage in split_data.items()
+        }
+        floor_shares = {
+            username: int(share.to_integral_value(rounding=ROUND_FLOOR))
+            for username, share in shares.items()
+        }
+
+        # hand out units lost while flooring to the
+        # largest fractional parts first
+        excess_amount = bill_amount - sum(floor_shares.values())
+        by_fraction = sorted(
+            shares.keys(),
+            key=lambda username: shares[username]-floor_shares[username],
+            reverse=True
+        )
+        for username in by_fraction[:excess_amount]:
+            floor_shares[username] += 1
+
+        for username, share in floor_shares.items():
             user = user_object_map[username]
-            expense_data[user][1] = float(percentage*bill_amount/100)
+            expense_data[user][1] = share
     else: # split_type -> equal
-        owe_user_list = split_data.keys()
+        owe_user_list = list(split_data.keys())
 
         # if owe_list is empty, divide between all group members
         if not len(owe_user_list):
-            owe_user_list = [
-                membership.user.user.username for membership in memberships
-                ]
-
-            each_share = math.floor(bill_amount/len(owe_user_list) * 100) / 100
-
-            # calculate excess amount as there could be difference
-            # while rounding amount for shares.
-            excess_amount = bill_amount - (each_share*len(owe_user_list))
-
-            divide_excess_amount_index = int(excess_amount/0.01)
-            for username in owe_user_list:
-                user = user_object_map[username]
-                expense_data[user][1] = float(each_share)
-                if divide_excess_amount_index > 0:
-                    expense_data[user][1] = round(expense_data[user][1]+0.01, 2)
-                    divide_excess_amount_index -= 1
-    return expense_data
+            if not roster.complete:
+                raise ValueError("Equal split between all members needs the full roster")
+            owe_user_list = list(user_object_map.keys())
+
+        each_share = bill_amount // len(owe_user_list)
+
+        # calculate excess amount as there could be difference
+        # while dividing amount into shares.
+        excess_amount = bill_amount - (each_share*len(owe_user_list))
+        for username in owe_user_list:
+            user = user_object_map[username]
+            expense_data[user][1] = each_share
+            if excess_amount > 0:
+                expense_data[user][1] += 1
+                excess_amount -= 1
+    return {
+        user: expense for user, expense in expense_data.items()
+        if expense != [0,0]
+    }
             
 
 def compute_payments(expense_data):
     """
     compute payments needed to settle bills
     """
+    balances = {
+        user: expense[0]-expense[1] for user, expense in expense_data.items()
+    }
+    return [
+        {"from": debtor, "to": creditor, "amount": amount}
+        for debtor, creditor, amount in two_pointer_settlement(balances)
+    ]
+
+
+def two_pointer_settlement(balances):
+    """
+    settle balances by walking debtors (largest debt first) and
+    creditors (largest credit first) in sorted order.
+    Large groups use the vectorized version when numpy is installed.
+    returns list of (debtor, creditor, amount) transfers
+    """
+    if numpy is not None and \
+            len(balances) >= settings.VECTORIZED_SETTLEMENT_MIN_MEMBERS:
+        return vectorized_two_pointer_settlement(balances)
+
     positive_balances = []
     negative_balances = []
     
-    for user, expense in expense_data.items():
-        balance = expense[0]-expense[1]
+    for member, balance in balances.items():
         if  balance < 0:
-            negative_balances.append([user, balance])
+            negative_balances.append([member, balance])
         elif balance > 0:
-            positive_balances.append([user, balance])
+            positive_balances.append([member, balance])
 
     negative_balances.sort(key=lambda x: x[1])
     positive_balances.sort(key=lambda x: x[1], reverse=True)
@@ -110,7 +323,7 @@ def compute_payments(expense_data):
     positive_index=0
     negative_index=0
 
-    payments = []
+    transfers = []
 
     while positive_index<len(positive_balances) and \
                 negative_index<len(negative_balances):
@@ -118,12 +331,11 @@ def compute_payments(expense_data):
             positive_balances[positive_index][1],
             -1*negative_balances[negative_index][1]
             )
-        data = {
-            "from": negative_balances[negative_index][0],
-            "to": positive_balances[positive_index][0],
-            "amount": amount
-            }
-        payments.append(data)
+        transfers.append((
+            negative_balances[negative_index][0],
+            positive_balances[positive_index][0],
+            amount
+        ))
         positive_balances[positive_index][1] -= amount
         negative_balances[negative_index][1] += amount
 
@@ -131,167 +343,965 @@ def compute_payments(expense_data):
             positive_index += 1
         if negative_balances[negative_index][1] == 0:
             negative_index += 1
-    return payments
+    return transfers
+
 
+def vectorized_two_pointer_settlement(balances):
+    """
+    numpy version of two_pointer_settlement giving the same transfers.
+    Laying sorted debts and credits end to end, every transfer is the
+    overlap of one debt and one credit, so transfers are the gaps between
+    the merged cumulative sums. Members are only looked up at the end
+    """
+    members = list(balances.keys())
+    amounts = numpy.fromiter(balances.values(), dtype=numpy.int64, count=len(members))
+
+    # stable sorts keep ties in the same order as the scalar path
+    debtor_index = numpy.flatnonzero(amounts < 0)
+    debtor_index = debtor_index[numpy.argsort(amounts[debtor_index], kind='stable')]
+    creditor_index = numpy.flatnonzero(amounts > 0)
+    creditor_index = creditor_index[numpy.argsort(-amounts[creditor_index], kind='stable')]
+    if not (len(debtor_index) and len(creditor_index)):
+        return []
+
+    debt_ends = numpy.cumsum(-amounts[debtor_index])
+    credit_ends = numpy.cumsum(amounts[creditor_index])
+    settled_total = min(debt_ends[-1], credit_ends[-1])
+
+    transfer_ends = numpy.union1d(debt_ends, credit_ends)
+    transfer_ends = transfer_ends[transfer_ends <= settled_total]
+    transfer_starts = numpy.concatenate(([0], transfer_ends[:-1]))
 
-def simplify_payments(balances, user):
+    debtors = debtor_index[numpy.searchsorted(debt_ends, transfer_starts, side='right')]
+    creditors = creditor_index[numpy.searchsorted(credit_ends, transfer_starts, side='right')]
+    return [
+        (members[debtor], members[creditor], amount)
+        for debtor, creditor, amount in zip(
+            debtors.tolist(), creditors.tolist(),
+            (transfer_ends - transfer_starts).tolist()
+        )
+    ]
+
+
+def greedy_settlement(balances):
     """
-    simplify payments using priority queue
+    settle balances by repeatedly matching the largest creditor
+    with the largest debtor, using heaps.
+    returns list of (debtor, creditor, amount) transfers
     """
-    positive_queue = PriorityQueue()
-    negative_queue = PriorityQueue()
+    positive_heap = []
+    negative_heap = []
 
-    for group_user, balance in balances.items():
+    for member, balance in balances.items():
         if balance < 0:
-            negative_queue.put((balance, [group_user, round(balance,2)]))
+            negative_heap.append((balance, member))
         elif balance > 0:
-            positive_queue.put((-1*balance, [group_user, round(balance,2)]))
+            positive_heap.append((-1*balance, member))
+    heapq.heapify(positive_heap)
+    heapq.heapify(negative_heap)
+
+    transfers = []
+    while positive_heap and negative_heap:
+        positive_balance, creditor = heapq.heappop(positive_heap)
+        negative_balance, debtor = heapq.heappop(negative_heap)
+
+        amount = min(-1*positive_balance, -1*negative_balance)
+        transfers.append((debtor, creditor, amount))
+
+        if -1*positive_balance > amount:
+            heapq.heappush(positive_heap, (positive_balance+amount, creditor))
+        if -1*negative_balance > amount:
+            heapq.heappush(negative_heap, (negative_balance+amount, debtor))
+    return transfers
+
+
+def optimal_settlement(balances):
+    """
+    settle balances with the minimum number of transfers.
+    A set of k members whose balances sum to zero can always be
+    settled with k-1 transfers, so the minimum is n minus the largest
+    number of disjoint zero-sum subsets, found with a DP over subsets.
+    O(2^n * n), only use for small groups
+    """
+    members = [member for member, balance in balances.items() if balance != 0]
+    count = len(members)
+    full_mask = (1 << count) - 1
+
+    subset_sums = [0]*(full_mask+1)
+    for mask in range(1, full_mask+1):
+        lowest_bit = mask & -mask
+        subset_sums[mask] = subset_sums[mask ^ lowest_bit] + \
+            balances[members[lowest_bit.bit_length()-1]]
+
+    # zero_subsets[mask] - most zero-sum subsets the members
+    # in mask can be split into
+    zero_subsets = [0]*(full_mask+1)
+    removed_member = [0]*(full_mask+1)
+    for mask in range(1, full_mask+1):
+        best = -1
+        for index in range(count):
+            if mask & (1 << index) and zero_subsets[mask ^ (1 << index)] > best:
+                best = zero_subsets[mask ^ (1 << index)]
+                removed_member[mask] = index
+        zero_subsets[mask] = best + (1 if subset_sums[mask] == 0 else 0)
+
+    # walk back removing one member at a time; every zero-sum
+    # mask on the way closes off one subset
+    transfers = []
+    mask = full_mask
+    subset = {}
+    while mask:
+        index = removed_member[mask]
+        subset[members[index]] = balances[members[index]]
+        mask ^= (1 << index)
+        if subset_sums[mask] == 0:
+            transfers.extend(greedy_settlement(subset))
+            subset = {}
+    return transfers
+
 
+SETTLEMENT_STRATEGIES = {
+    "greedy": greedy_settlement,
+    "optimal": optimal_settlement,
+}
+
+
+def compute_settlement_plan(balances, strategy="greedy"):
+    """
+    compute transfers settling net balances of a group.
+    balances map member -> net balance (minor units).
+    the optimal strategy falls back to greedy for groups larger
+    than SETTLEMENT_OPTIMAL_MAX_MEMBERS as it is exponential, and greedy
+    switches to the vectorized two pointer walk for very large groups
+    """
+    members_count = sum(1 for balance in balances.values() if balance != 0)
+    if strategy == "optimal" and \
+            members_count > settings.SETTLEMENT_OPTIMAL_MAX_MEMBERS:
+        strategy = "greedy"
+    if strategy == "greedy" and \
+            members_count >= settings.VECTORIZED_SETTLEMENT_MIN_MEMBERS:
+        # heap matching is python bound for very large groups, the
+        # sorted two pointer walk gives as few transfers (n-1 at most)
+        # and runs vectorized
+        return two_pointer_settlement(balances)
+    return SETTLEMENT_STRATEGIES[strategy](balances)
+
+
+def settlement_plan_row(plan, username):
+    """
+    amounts owed to username in a settlement plan
+    """
     payments = defaultdict(lambda:0)
-    
-    while not (positive_queue.empty() or negative_queue.empty()):
-        positive_elem = positive_queue.get()[1]
-        negative_elem = negative_queue.get()[1]
+    for debtor, creditor, amount in plan:
+        if debtor == username:
+            payments[creditor] -= amount
+        elif creditor == username:
+            payments[debtor] += amount
+    return payments
 
-        amount = min(
-            positive_elem[1],
-            -1*negative_elem[1]
+
+def simplify_payments(balances, username, strategy="greedy"):
+    """
+    simplify payments using the group settlement strategy and
+    return the row of username. balances map username -> net
+    balance in group (minor units)
+    """
+    return settlement_plan_row(
+        compute_settlement_plan(balances, strategy), username
+    )
+
+
+def compute_group_settlement_plan(group_obj):
+    """
+    simplified settlement plan of a group from the stored
+    member balances, as (debtor, creditor, amount) usernames
+    """
+    balances = dict(
+        GroupBalance.objects.filter(
+            group=group_obj
+        ).values_list('user__user__username', 'amount')
+    )
+    return compute_settlement_plan(balances, group_obj.settlement_strategy)
+
+
+def pair_balance_delta(payer_id, receiver_id, amount):
+    """
+    normalise a payment into the (user_a, user_b) ordering
+    of PairBalance along with the change it makes to amount
+    """
+    # payer owes receiver the payment amount
+    if receiver_id < payer_id:
+        return (receiver_id, payer_id), amount
+    return (payer_id, receiver_id), -1*amount
+
+
+def update_pair_balances(group_obj, payments, sign=1):
+    """
+    apply payments to the pairwise balance ledger of a group.
+    sign=-1 reverts payments which are being deleted.
+    Should be called inside the transaction writing the payments
+    """
+    deltas = defaultdict(lambda:0)
+    for payment in payments:
+        (user_a_id, user_b_id), delta = pair_balance_delta(
+            payment.payer_id, payment.receiver_id, payment.amount
         )
-        if negative_elem[0] == user:
-            payments[positive_elem[0].user.username] -= amount
-        elif positive_elem[0] == user:
-            payments[negative_elem[0].user.username] += amount
-        positive_elem[1] -= amount
-        if positive_elem[1] > 0:
-            positive_queue.put((-1*positive_elem[1], positive_elem))
-        negative_elem[1] += amount
-        if negative_elem[1]<0:
-            negative_queue.put((negative_elem[1], negative_elem))
-    return payments
+        deltas[(group_obj.id, user_a_id, user_b_id)] += sign*delta
+    apply_pair_balance_deltas(deltas)
 
 
-def compute_group_user_balance(user, group_obj):
+def apply_pair_balance_deltas(deltas):
+    """
+    add deltas keyed by (group_id, user_a_id, user_b_id)
+    to the pairwise ledger
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta != 0}
+    if not deltas:
+        return
+
+    # make sure a row exists for every pair, then lock
+    # and update all of them with a constant number of queries
+    PairBalance.objects.bulk_create([
+        PairBalance(group_id=group_id, user_a_id=user_a_id, user_b_id=user_b_id)
+        for group_id, user_a_id, user_b_id in deltas.keys()
+    ], ignore_conflicts=True)
+    # lock exactly the changed pairs, not every
+    # combination of their groups and users
+    pair_filter = Q()
+    for group_id, user_a_id, user_b_id in deltas.keys():
+        pair_filter |= Q(group_id=group_id, user_a_id=user_a_id, user_b_id=user_b_id)
+    pair_balances = PairBalance.objects.select_for_update().filter(
+        pair_filter
+    ).order_by('id')
+
+    updated_on = timezone.now()
+    changed_balances = []
+    for pair_balance in pair_balances:
+        key = (pair_balance.group_id, pair_balance.user_a_id, pair_balance.user_b_id)
+        pair_balance.amount += deltas[key]
+        pair_balance.updated_on = updated_on
+        changed_balances.append(pair_balance)
+    PairBalance.objects.bulk_update(changed_balances, ['amount', 'updated_on'])
+    splitAppCache.bump_user_balance_versions(
+        [key[1] for key in deltas.keys()] + [key[2] for key in deltas.keys()]
+    )
+
+
+def update_group_balances(group_obj, expenses, sign=1):
+    """
+    apply expenses to the per member net balances of a group.
+    sign=-1 reverts expenses which are being deleted.
+    Should be called inside the transaction writing the expenses
+    """
+    deltas = defaultdict(lambda:0)
+    for expense in expenses:
+        deltas[(group_obj.id, expense.user_id)] += sign*expense.get_balance()
+    apply_group_balance_deltas(deltas)
+
+
+def apply_group_balance_deltas(deltas):
+    """
+    add deltas keyed by (group_id, user_id) to the per member ledger
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta != 0}
+    if not deltas:
+        return
+
+    GroupBalance.objects.bulk_create([
+        GroupBalance(group_id=group_id, user_id=user_id)
+        for group_id, user_id in deltas.keys()
+    ], ignore_conflicts=True)
+    member_filter = Q()
+    for group_id, user_id in deltas.keys():
+        member_filter |= Q(group_id=group_id, user_id=user_id)
+    group_balances = GroupBalance.objects.select_for_update().filter(
+        member_filter
+    ).order_by('id')
+
+    updated_on = timezone.now()
+    changed_balances = []
+    for group_balance in group_balances:
+        key = (group_balance.group_id, group_balance.user_id)
+        group_balance.amount += deltas[key]
+        group_balance.updated_on = updated_on
+        changed_balances.append(group_balance)
+    GroupBalance.objects.bulk_update(changed_balances, ['amount', 'updated_on'])
+
+
+def build_bill_records(bill_object, expense_data, payments_data):
+    """
+    unsaved expenses and payments of a bill
+    """
+    expense_objs = [
+        Expense(
+            bill=bill_object, group_id=bill_object.group_id, user=user,
+            amount_paid=expense[0], amount_owed=expense[1]
+        )
+        for user, expense in expense_data.items()
+        if expense != [0,0]
+    ]
+    payment_objs = [
+        Payment(
+            payer = payment["from"],
+            receiver = payment["to"],
+            amount = payment["amount"],
+            bill=bill_object, group_id=bill_object.group_id
+        )
+        for payment in payments_data
+    ]
+    return expense_objs, payment_objs
+
+
+def create_bill_records(bill_object, expense_data, payments_data):
+    """
+    bulk insert expenses and payments of a bill and apply them
+    to the balance ledgers. Costs a constant number of queries
+    however many members the bill has. Should be called inside
+    the transaction writing the bill, which locks the group row
+    before inserting the bill like every other ledger write
+    (auto_settle, settle_group_balance, update_bill_records) so
+    they all take the ledger row locks in the same order
     """
-    compute amounts owed to user in a group
+    expense_objs, payment_objs = build_bill_records(
+        bill_object, expense_data, payments_data
+    )
+    Expense.objects.bulk_create(expense_objs)
+    Payment.objects.bulk_create(payment_objs)
+
+    update_group_balances(bill_object.group, expense_objs)
+    update_pair_balances(bill_object.group, payment_objs)
+    splitAppCache.bump_group_ledger_versions([bill_object.group_id])
+    return expense_objs, payment_objs
+
+
+def update_bill_records(bill_object, expense_data, payments_data):
+    """
+    diff new expense and payment data of a bill against the stored
+    rows and write only what changed. Should be called inside the
+    transaction after locking the bill row.
+    returns change in net balance per username and change in
+    payments per (payer, receiver) username pair, in minor units
+    """
+    updated_on = timezone.now()
+    group_obj = bill_object.group
+    invalidate_balance_checkpoints(bill_object)
+
+    # diff expenses by user
+    old_expenses = {
+        expense.user_id: expense for expense in
+        Expense.objects.filter(bill=bill_object).select_related('user__user')
+    }
+    new_expenses = {
+        user.id: (user, expense) for user, expense in expense_data.items()
+        if expense != [0,0]
+    }
+
+    balance_deltas = defaultdict(lambda:0)
+    usernames = {}
+    created_expenses, changed_expenses, deleted_expense_ids = [], [], []
+    for user_id, (user, expense) in new_expenses.items():
+        usernames[user_id] = user.user.username
+        old_expense = old_expenses.get(user_id)
+        if old_expense is None:
+            created_expenses.append(Expense(
+                bill=bill_object, group_id=bill_object.group_id, user=user,
+                amount_paid=expense[0], amount_owed=expense[1]
+            ))
+            balance_deltas[user_id] += expense[0]-expense[1]
+        elif [old_expense.amount_paid, old_expense.amount_owed] != expense:
+            balance_deltas[user_id] += (expense[0]-expense[1]) - old_expense.get_balance()
+            old_expense.amount_paid, old_expense.amount_owed = expense
+            old_expense.updated_on = updated_on
+            changed_expenses.append(old_expense)
+    for user_id, old_expense in old_expenses.items():
+        if user_id not in new_expenses:
+            usernames[user_id] = old_expense.user.user.username
+            balance_deltas[user_id] -= old_expense.get_balance()
+            deleted_expense_ids.append(old_expense.id)
+
+    Expense.objects.bulk_create(created_expenses)
+    Expense.objects.bulk_update(
+        changed_expenses, ['amount_paid', 'amount_owed', 'updated_on']
+    )
+    Expense.objects.filter(id__in=deleted_expense_ids).delete()
+    apply_group_balance_deltas({
+        (group_obj.id, user_id): delta for user_id, delta in balance_deltas.items()
+    })
+
+    # diff payments by (payer, receiver)
+    old_payments = {
+        (payment.payer_id, payment.receiver_id): payment for payment in
+        Payment.objects.filter(bill=bill_object).select_related(
+            'payer__user', 'receiver__user'
+        )
+    }
+    new_payments = {
+        (payment["from"].id, payment["to"].id): payment
+        for payment in payments_data
+    }
+
+    payment_deltas = defaultdict(lambda:0)
+    created_payments, changed_payments, deleted_payment_ids = [], [], []
+    for key, payment in new_payments.items():
+        usernames[key[0]] = payment["from"].user.username
+        usernames[key[1]] = payment["to"].user.username
+        old_payment = old_payments.get(key)
+        if old_payment is None:
+            created_payments.append(Payment(
+                payer = payment["from"],
+                receiver = payment["to"],
+                amount = payment["amount"],
+                bill=bill_object, group_id=bill_object.group_id
+            ))
+            payment_deltas[key] += payment["amount"]
+        elif old_payment.amount != payment["amount"]:
+            payment_deltas[key] += payment["amount"] - old_payment.amount
+            old_payment.amount = payment["amount"]
+            old_payment.updated_on = updated_on
+            changed_payments.append(old_payment)
+    for key, old_payment in old_payments.items():
+        if key not in new_payments:
+            usernames[key[0]] = old_payment.payer.user.username
+            usernames[key[1]] = old_payment.receiver.user.username
+            payment_deltas[key] -= old_payment.amount
+            deleted_payment_ids.append(old_payment.id)
+
+    Payment.objects.bulk_create(created_payments)
+    Payment.objects.bulk_update(changed_payments, ['amount', 'updated_on'])
+    Payment.objects.filter(id__in=deleted_payment_ids).delete()
+
+    pair_deltas = defaultdict(lambda:0)
+    for (payer_id, receiver_id), amount in payment_deltas.items():
+        (user_a_id, user_b_id), delta = pair_balance_delta(
+            payer_id, receiver_id, amount
+        )
+        pair_deltas[(group_obj.id, user_a_id, user_b_id)] += delta
+    apply_pair_balance_deltas(pair_deltas)
+    splitAppCache.bump_group_ledger_versions([group_obj.id])
+
+    balance_delta = {
+        usernames[user_id]: delta
+        for user_id, delta in balance_deltas.items() if delta != 0
+    }
+    payment_delta = [
+        {"from": usernames[payer_id], "to": usernames[receiver_id], "amount": delta}
+        for (payer_id, receiver_id), delta in payment_deltas.items() if delta != 0
+    ]
+    return balance_delta, payment_delta
+
+
+def compute_pair_balances_from_payments():
+    """
+    recompute the pairwise balance ledger from raw payments.
+    returns map of (group_id, user_a_id, user_b_id) -> amount
+    """
+    payment_totals = Payment.objects.values(
+        'group_id', 'payer_id', 'receiver_id'
+    ).annotate(total=Sum('amount'))
+
+    balances = defaultdict(lambda:0)
+    for row in payment_totals:
+        (user_a_id, user_b_id), delta = pair_balance_delta(
+            row['payer_id'], row['receiver_id'], row['total']
+        )
+        balances[(row['group_id'], user_a_id, user_b_id)] += delta
+    return balances
+
+
+def compute_group_balances_from_expenses():
+    """
+    recompute per member net balances from raw expenses.
+    returns map of (group_id, user_id) -> amount
+    """
+    expense_totals = Expense.objects.values(
+        'group_id', 'user_id'
+    ).annotate(paid=Sum('amount_paid'), owed=Sum('amount_owed'))
+
+    return {
+        (row['group_id'], row['user_id']): row['paid'] - row['owed']
+        for row in expense_totals
+    }
+
+
+def compute_pair_balances_between(group_obj, start, end):
+    """
+    pairwise balances of a group from payments created
+    after start (if given) and up to end.
+    returns map of (user_a_id, user_b_id) -> amount
     """
+    payments = Payment.objects.filter(group=group_obj, created_on__lte=end)
+    if start is not None:
+        payments = payments.filter(created_on__gt=start)
+    payment_totals = payments.values(
+        'payer_id', 'receiver_id'
+    ).annotate(total=Sum('amount'))
+
+    balances = defaultdict(lambda:0)
+    for row in payment_totals:
+        pair, delta = pair_balance_delta(
+            row['payer_id'], row['receiver_id'], row['total']
+        )
+        balances[pair] += delta
+    return balances
+
+
+def latest_balance_checkpoint(group_obj, as_of):
+    """
+    most recent checkpoint of a group taken
+    up to as_of, None if there is none
+    """
+    return BalanceCheckpoint.objects.filter(
+        group=group_obj, cutoff__lte=as_of
+    ).order_by('-cutoff').first()
+
+
+def compute_pair_balances_as_of(group_obj, as_of):
+    """
+    pairwise balances of a group over payments created up to
+    as_of, read from the latest checkpoint before it plus the
+    payments since. returns map of (user_a_id, user_b_id) -> amount
+    """
+    checkpoint = latest_balance_checkpoint(group_obj, as_of)
+    if checkpoint is None:
+        return compute_pair_balances_between(group_obj, None, as_of)
+
+    balances = compute_pair_balances_between(group_obj, checkpoint.cutoff, as_of)
+    for user_a_id, user_b_id, amount in checkpoint.balance.values_list(
+            'user_a_id', 'user_b_id', 'amount'):
+        balances[(user_a_id, user_b_id)] += amount
+    return balances
+
+
+def create_balance_checkpoint(group_obj, cutoff):
+    """
+    checkpoint group balances over payments created up to cutoff.
+    Builds on the previous checkpoint so only newer payments are read.
+    cutoff should trail the current time by more than the longest
+    bill transaction so no payment before it is still uncommitted
+    """
+    with transaction.atomic():
+        # bill edits lock the group to invalidate checkpoints,
+        # so the balances read here can not go stale
+        Group.objects.select_for_update().get(id=group_obj.id)
+        checkpoint = latest_balance_checkpoint(group_obj, timezone.now())
+        if checkpoint is not None and checkpoint.cutoff >= cutoff:
+            return checkpoint
+
+        balances = compute_pair_balances_as_of(group_obj, cutoff)
+        checkpoint = BalanceCheckpoint.objects.create(group=group_obj, cutoff=cutoff)
+        CheckpointBalance.objects.bulk_create([
+            CheckpointBalance(
+                checkpoint=checkpoint, user_a_id=user_a_id,
+                user_b_id=user_b_id, amount=amount
+            )
+            for (user_a_id, user_b_id), amount in balances.items() if amount != 0
+        ])
+    return checkpoint
+
+
+def invalidate_balance_checkpoints(bill_object):
+    """
+    drop checkpoints which include payments of bill_object, for
+    when they are changed in place. Should be called inside the
+    transaction editing the bill
+    """
+    Group.objects.select_for_update().get(id=bill_object.group_id)
+    BalanceCheckpoint.objects.filter(
+        group_id=bill_object.group_id, cutoff__gte=bill_object.created_on
+    ).delete()
+
+
+def compute_group_user_balance_as_of(user, group_obj, as_of):
+    """
+    compute amounts owed to user in a group counting payments
+    created up to as_of, in minor units of the group currency
+    """
+    balances = compute_pair_balances_as_of(group_obj, as_of)
+    user_ids = set(user_id for pair in balances.keys() for user_id in pair)
+    usernames = dict(
+        User.objects.filter(id__in=user_ids).values_list('id', 'user__username')
+    )
+
     owe_map = defaultdict(lambda:0)
     if not group_obj.simplify_payments:
-        # compute balances using payments
-        # if simplify payments is turned off
-        payments = Payment.objects.filter(
-            (Q(payer=user) | Q(receiver=user)) & Q(bill__group=group_obj)
+        for (user_a_id, user_b_id), amount in balances.items():
+            if user_a_id == user.id:
+                owe_map[usernames[user_b_id]] += amount
+            elif user_b_id == user.id:
+                owe_map[usernames[user_a_id]] -= amount
+    else:
+        # net balance of every member, a positive
+        # pair amount means user_b owes user_a
+        member_balances = defaultdict(lambda:0)
+        for (user_a_id, user_b_id), amount in balances.items():
+            member_balances[usernames[user_a_id]] += amount
+            member_balances[usernames[user_b_id]] -= amount
+        owe_map = simplify_payments(
+            member_balances, user.user.username, group_obj.settlement_strategy
         )
+    return {
+        username: balance for username, balance in owe_map.items()
+        if balance != 0
+    }
 
-        for payment in payments:
-            if payment.payer == user:
-                owe_map[payment.receiver.user.username] -= payment.amount
-            else:
-                owe_map[payment.payer.user.username] += payment.amount
+
+def aggregate_pair_balances(user, **filters):
+    """
+    sum pairwise ledger rows of user grouped by counterparty and
+    currency in a single query. positive amount means counterparty owes user.
+    Rows where user is user_a and rows where user is user_b are summed
+    apart and joined with UNION ALL so both halves search an index,
+    an OR of the two with the joins falls back to a full scan. Pairs are
+    ordered by user id, so a counterparty only shows up in one half
+    """
+    as_user_a = PairBalance.objects.filter(user_a=user, **filters).annotate(
+        counterparty=F('user_b__user__username')
+    ).values('counterparty', 'group__default_currency').annotate(
+        total=Sum('amount')
+    ).values_list('counterparty', 'group__default_currency', 'total')
+    as_user_b = PairBalance.objects.filter(user_b=user, **filters).annotate(
+        counterparty=F('user_a__user__username')
+    ).values('counterparty', 'group__default_currency').annotate(
+        total=-1*Sum('amount')
+    ).values_list('counterparty', 'group__default_currency', 'total')
+    return as_user_a.union(as_user_b, all=True)
+
+
+def compute_group_user_balance(user, group_obj):
+    """
+    compute amounts owed to user in a group, in minor
+    units of the group currency
+    """
+    if not group_obj.simplify_payments:
+        # read balances from the pairwise ledger
+        # if simplify payments is turned off
+        owe_map = {
+            username: balance for username, currency, balance \
+            in aggregate_pair_balances(user, group=group_obj)
+        }
     else:
-        # compute balances using expenses
-        # if simplify payments is turned on
-        expenses = Expense.objects.filter(
-            bill__group=group_obj
+        # the whole group plan is computed once per ledger
+        # version and cached, if simplify payments is turned on
+        plan = splitAppCache.get_group_settlement_plan(
+            group_obj, compute_group_settlement_plan
         )
-        balances = defaultdict(lambda:0)
-        for expense in expenses:
-            balances[expense.user] += expense.amount_paid
-            balances[expense.user] -= expense.amount_owed
-        owe_map = simplify_payments(balances, user)
+        owe_map = settlement_plan_row(plan, user.user.username)
     owe_map = {
-        user:round(balance,2) \
+        user:balance \
         for user, balance in owe_map.items() \
-        if round(balance,2) != 0
+        if balance != 0
     }
     return owe_map
 
 
 def compute_overall_user_balance(user):
     """
-    compute overall amounts owed to user by other users
+    compute overall amounts owed to user by other users per
+    currency, amounts in different currencies are never added
+    up, like auto_settle nets them. Map of currency -> username
+    -> amount in major units, ready for the API response
     """
-    owe_map = defaultdict(lambda:0)
-    payments = Payment.objects.filter(
-        Q(payer=user) | Q(receiver=user)
-    )
-
-    for payment in payments:
-        if payment.payer == user:
-            owe_map[payment.receiver.user.username] -= payment.amount
-        else:
-            owe_map[payment.payer.user.username] += payment.amount
-    owe_map = {
-        user:round(balance,2) \
-        for user, balance in owe_map.items() \
-        if round(balance,2) != 0
-    }
-    return owe_map
+    owe_map = defaultdict(dict)
+    for username, currency, balance in aggregate_pair_balances(user):
+        if balance != 0:
+            owe_map[currency][username] = to_major_units(balance, currency)
+    return dict(owe_map)
 
 
 def settle_group_balance(user, other_user, group_obj):
-    owe_map = compute_group_user_balance(user, group_obj)
-
-    if other_user.user.username not in owe_map:
-        return {'error': 'No balance pending!'}, 400
+    """
+    settle the group balance between user and other_user
+    with a reverse bill
+    """
+    with transaction.atomic():
+        # lock group so concurrent settle workers
+        # do not settle the same balance twice
+        Group.objects.select_for_update().get(id=group_obj.id)
+        owe_map = compute_group_user_balance(user, group_obj)
 
-    amount = owe_map[other_user.user.username]
+        if other_user.user.username not in owe_map:
+            return {'error': 'No balance pending!'}, 400
 
-    bill_object = Bill.objects.create(
-        title="Settle Balance", group=group_obj,
-        added_by=user, bill_amount=abs(amount)
-    )
+        amount = owe_map[other_user.user.username]
 
-    # create reverse bill to settle the amount
-    # between 2 users
-    with transaction.atomic():
         payer=other_user
         ower=user
         if amount < 0:
             payer=user
             ower=other_user
         amount = abs(amount)
-        expense_obj_1 = Expense(
-            bill=bill_object, user=payer,
-            amount_paid=amount, amount_owed=0
-        ).save()
-
-        expense_obj_2 = Expense(
-            bill=bill_object, user=ower,
-            amount_paid=0, amount_owed=amount
-        ).save()
-        
-        payment_obj = Payment(
-            payer = ower,
-            receiver = payer,
-            amount = amount,
-            bill=bill_object
-        ).save()
+
+        # create reverse bill to settle the amount
+        # between 2 users
+        bill_object = Bill.objects.create(
+            title="Settle Balance", group=group_obj,
+            added_by=user, bill_amount=amount
+        )
+        create_bill_records(
+            bill_object,
+            {payer: [amount, 0], ower: [0, amount]},
+            [{"from": ower, "to": payer, "amount": amount}]
+        )
     return {'message': 'Balance Settled!'}, 200
 
 
+def enqueue_auto_settle(users):
+    """
+    queue auto settle work for users. The unique pending marker of
+    SettleJob skips users which already have pending work, even for
+    concurrent bills, so bursts of bills coalesce into one job per
+    user. Call inside the transaction writing the bill
+    """
+    SettleJob.objects.bulk_create([
+        SettleJob(user_id=user_id)
+        for user_id in set(user.id for user in users)
+    ], ignore_conflicts=True)
+
+
 def auto_settle(user_list):
     """
     auto settle group balances if
-    overall balance of two users is 0
+    overall balance of two users is 0.
+    The debt graph of all users across groups is loaded once
+    and settling bills are written in a single transaction
     """
-    overall_user_balances = {}
+    user_ids = set(user.id for user in user_list)
+    if not user_ids:
+        return True
+    user_filter = Q(user_a_id__in=user_ids) | Q(user_b_id__in=user_ids)
 
-    # get overall balances for all users in recently added bill
-    for user in user_list:
-        overall_user_balances[user] = compute_overall_user_balance(user)
-    
-    for user in overall_user_balances.keys():
-        user_membership_list = Membership.objects.filter(user=user)
-
-        # check for user balances in all groups he's a member of
-        for membership in user_membership_list:
-            group = membership.group
-            group_balance = compute_group_user_balance(user, group)
-
-            for user_owed in group_balance.keys():
-                # settle group balance if there is no overall balance
-                # between 2 users but group balance is pending.
-                if user_owed not in overall_user_balances[user]:
-                    user_owed_obj = User.objects.get(user__username=user_owed)
-                    settle_group_balance(user, user_owed_obj, group)
+    with transaction.atomic():
+        # lock every group the users have balances in so manual
+        # settlements and other workers wait for us
+        group_ids = set(PairBalance.objects.filter(user_filter).exclude(
+            amount=0
+        ).values_list('group_id', flat=True)).union(Membership.objects.filter(
+            user_id__in=user_ids, group__simplify_payments=True
+        ).values_list('group_id', flat=True))
+        groups = {
+            group.id: group for group in
+            Group.objects.select_for_update().filter(id__in=group_ids).order_by('id')
+        }
+
+        # only rows of the groups locked above, a pair which became
+        # non zero since is left for the next run
+        pair_rows = list(PairBalance.objects.select_for_update().filter(
+            user_filter, group_id__in=groups.keys()
+        ).exclude(amount=0).values_list('group_id', 'user_a_id', 'user_b_id', 'amount'))
+        simplified_rows = list(GroupBalance.objects.select_for_update().filter(
+            group_id__in=[
+                group_id for group_id, group in groups.items() if group.simplify_payments
+            ]
+        ).exclude(amount=0).values_list('group_id', 'user_id', 'amount'))
+
+        # overall balance between pairs of users across all groups,
+        # per currency as amounts in different currencies do not net
+        overall_balances = defaultdict(lambda:0)
+        for group_id, user_a_id, user_b_id, amount in pair_rows:
+            currency = groups[group_id].default_currency
+            overall_balances[(user_a_id, user_b_id, currency)] += amount
+
+        # group balances as (group_id, creditor_id, debtor_id) -> amount
+        group_debts = {}
+        for group_id, user_a_id, user_b_id, amount in pair_rows:
+            if groups[group_id].simplify_payments:
+                continue
+            if amount > 0:
+                group_debts[(group_id, user_a_id, user_b_id)] = amount
+            else:
+                group_debts[(group_id, user_b_id, user_a_id)] = -1*amount
+
+        simplified_balances = defaultdict(dict)
+        for group_id, user_id, amount in simplified_rows:
+            simplified_balances[group_id][user_id] = amount
+        for group_id, balances in simplified_balances.items():
+            for user_id in user_ids.intersection(balances.keys()):
+                other_balances = simplify_payments(
+                    balances, user_id, groups[group_id].settlement_strategy
+                )
+                for other_id, amount in other_balances.items():
+                    if amount > 0:
+                        group_debts[(group_id, user_id, other_id)] = amount
+                    elif amount < 0:
+                        group_debts[(group_id, other_id, user_id)] = -1*amount
+
+        # settle group balance if there is no overall balance
+        # between 2 users but group balance is pending.
+        settlements = defaultdict(list)
+        for (group_id, creditor_id, debtor_id), amount in group_debts.items():
+            pair = (
+                min(creditor_id, debtor_id), max(creditor_id, debtor_id),
+                groups[group_id].default_currency
+            )
+            if overall_balances.get(pair, 0) == 0:
+                settlements[group_id].append((creditor_id, debtor_id, amount))
+        if not settlements:
+            return True
+
+        # one reverse bill per group settles all its pairs
+        expense_objs, payment_objs = [], []
+        group_deltas = defaultdict(lambda:0)
+        pair_deltas = defaultdict(lambda:0)
+        for group_id, group_settlements in settlements.items():
+            creditor_id, debtor_id, amount = group_settlements[0]
+            bill_object = Bill.objects.create(
+                title="Settle Balance", group=groups[group_id],
+                added_by_id=creditor_id if creditor_id in user_ids else debtor_id,
+                bill_amount=sum(amount for _, _, amount in group_settlements)
+            )
+
+            expense_data = defaultdict(lambda:[0,0])
+            for creditor_id, debtor_id, amount in group_settlements:
+                expense_data[debtor_id][0] += amount
+                expense_data[creditor_id][1] += amount
+                payment_objs.append(Payment(
+                    payer_id=creditor_id, receiver_id=debtor_id,
+                    amount=amount, bill=bill_object, group_id=group_id
+                ))
+                (user_a_id, user_b_id), delta = pair_balance_delta(
+                    creditor_id, debtor_id, amount
+                )
+                pair_deltas[(group_id, user_a_id, user_b_id)] += delta
+            for user_id, expense in expense_data.items():
+                expense_objs.append(Expense(
+                    bill=bill_object, group_id=group_id, user_id=user_id,
+                    amount_paid=expense[0], amount_owed=expense[1]
+                ))
+                group_deltas[(group_id, user_id)] += expense[0]-expense[1]
+
+        Expense.objects.bulk_create(expense_objs)
+        Payment.objects.bulk_create(payment_objs)
+        apply_group_balance_deltas(group_deltas)
+        apply_pair_balance_deltas(pair_deltas)
+        splitAppCache.bump_group_ledger_versions(settlements.keys())
     return True
+
+
+def encode_bill_cursor(bill_obj):
+    """
+    opaque cursor pointing after bill_obj in the bill history
+    """
+    position = '%s|%s' % (bill_obj.created_on.isoformat(), bill_obj.id)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_bill_cursor(cursor):
+    """
+    (created_on, id) position of a bill history cursor,
+    raises ValueError for a malformed cursor
+    """
+    try:
+        created_on, bill_id = base64.urlsafe_b64decode(
+            cursor.encode()
+        ).decode().split('|')
+        created_on, bill_id = parse_datetime(created_on), int(bill_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if created_on is None:
+        raise ValueError('Invalid cursor')
+    return created_on, bill_id
+
+
+def get_bill_history_page(group_obj, cursor=None, limit=20):
+    """
+    page of bills of a group, newest first, with their expenses,
+    payments and notes. Pages are keyed on (created_on, id) so
+    deep pages cost the same as the first one, and prefetching
+    keeps it at four queries however many bills are on the page.
+    returns (bills, next_cursor)
+    """
+    bills = Bill.objects.filter(group=group_obj)
+    if cursor is not None:
+        created_on, bill_id = decode_bill_cursor(cursor)
+        bills = bills.filter(
+            Q(created_on__lt=created_on) | Q(created_on=created_on, id__lt=bill_id)
+        )
+    bills = list(bills.select_related('added_by__user').prefetch_related(
+        Prefetch('expense', queryset=Expense.objects.select_related(
+            'user__user'
+        ).order_by('id')),
+        Prefetch('payment', queryset=Payment.objects.select_related(
+            'payer__user', 'receiver__user'
+        ).order_by('id')),
+        Prefetch('note', queryset=Note.objects.order_by('id')),
+    ).order_by('-created_on', '-id')[:limit+1])
+
+    next_cursor = None
+    if len(bills) > limit:
+        bills = bills[:limit]
+        next_cursor = encode_bill_cursor(bills[-1])
+    return bills, next_cursor
+
+
+def bill_history_row(bill_obj, currency):
+    """
+    API representation of a bill with prefetched
+    expenses, payments and notes
+    """
+    return {
+        "id": bill_obj.id,
+        "title": bill_obj.title,
+        "amount": to_major_units(bill_obj.bill_amount, currency),
+        "added_by": bill_obj.added_by.user.username,
+        "created_on": bill_obj.created_on.isoformat(),
+        "expenses": [
+            {
+                "user": expense.user.user.username,
+                "paid": to_major_units(expense.amount_paid, currency),
+                "owed": to_major_units(expense.amount_owed, currency),
+            }
+            for expense in bill_obj.expense.all()
+        ],
+        "payments": [
+            {
+                "from": payment.payer.user.username,
+                "to": payment.receiver.user.username,
+                "amount": to_major_units(payment.amount, currency),
+            }
+            for payment in bill_obj.payment.all()
+        ],
+        "notes": [
+            {
+                "text": note.text,
+                "image": note.image.url if note.image else None,
+                "created_on": note.created_on.isoformat(),
+            }
+            for note in bill_obj.note.all()
+        ],
+    }
+
+
+async def map_in_threads(func, items, concurrency=None):
+    """
+    run func(item) for every item on worker threads with at most
+    concurrency (BALANCE_FANOUT_CONCURRENCY by default) running at
+    once. returns results in the order of items
+    """
+    semaphore = asyncio.Semaphore(
+        concurrency or settings.BALANCE_FANOUT_CONCURRENCY
+    )
+
+    def call(item):
+        try:
+            return func(item)
+        finally:
+            # worker threads are not request threads, so close their
+            # connection here as request_finished would (honours CONN_MAX_AGE)
+            close_old_connections()
+
+    async def run(item):
+        async with semaphore:
+            return await sync_to_async(call, thread_sensitive=False)(item)
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+def user_groups(user):
+    """
+    groups user is a member of
+    """
+    return [
+        membership.group for membership in Membership.objects.filter(
+            user=user, group__is_deleted=False
+        ).select_related('group').order_by('group__name')
+    ]
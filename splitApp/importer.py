@@ -0,0 +1,191 @@
+"""
+bulk import of historical bills into a group.
+
+Files are parsed one row at a time and every row is validated
+against a single GroupRoster of the group, so an import costs
+the same membership lookup whatever its size. Valid bills are
+written in batches, one transaction per batch, and auto settlement
+is queued once when the whole file is in.
+"""
+import csv
+import json
+import uuid
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from splitApp.models import Bill, Expense, Payment, Group
+from splitApp import helpers
+import splitApp.cache as splitAppCache
+
+IMPORT_FORMATS = ('ndjson', 'csv')
+
+
+def iter_ndjson_rows(lines):
+    """
+    one bill JSON object per line, blank lines are skipped
+    and malformed ones come out as None
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row if isinstance(row, dict) else None
+
+
+def iter_csv_rows(lines):
+    """
+    csv with title, amount, split_type, split_data and pay_data
+    columns, split_data and pay_data hold JSON objects.
+    Rows with malformed JSON come out as None
+    """
+    for row in csv.DictReader(lines):
+        try:
+            row['split_data'] = json.loads(row.get('split_data') or '{}')
+            row['pay_data'] = json.loads(row.get('pay_data') or '{}')
+        except ValueError:
+            row = None
+        yield row
+
+
+def iter_import_rows(lines, import_format):
+    """
+    bill rows of a text stream in ndjson or csv format
+    """
+    if import_format not in IMPORT_FORMATS:
+        raise ValueError('Import format should be one of %s' % ', '.join(IMPORT_FORMATS))
+    if import_format == 'ndjson':
+        return iter_ndjson_rows(lines)
+    return iter_csv_rows(lines)
+
+
+def parse_bill_row(row, roster):
+    """
+    validate a bill row against the group roster and compute
+    its expenses and payments, in the shape AddBillView takes.
+    returns (title, bill_amount, expense_data, payments_data),
+    raises ValueError for an invalid row
+    """
+    split_type = row.get("split_type")
+    try:
+        bill_amount, split_data, pay_data = helpers.bill_data_to_minor_units(
+            row.get("amount"), split_type, row.get("split_data") or {},
+            row.get("pay_data") or {}, roster.group.default_currency
+        )
+    except Exception:
+        raise ValueError('Invalid amount')
+
+    try:
+        is_valid, msg = helpers.validate_bill_split(
+            bill_amount, split_type, split_data, pay_data, roster
+        )
+        if is_valid:
+            expense_data = helpers.compute_expense(
+                bill_amount, split_type, split_data, pay_data, roster
+            )
+    except (TypeError, KeyError, AttributeError, ArithmeticError):
+        raise ValueError('Invalid split data')
+    if not is_valid:
+        raise ValueError(msg)
+    return (
+        row.get("title"), bill_amount, expense_data,
+        helpers.compute_payments(expense_data)
+    )
+
+
+def insert_bills_returning_ids(bills):
+    """
+    bulk insert bills and set their ids on backends where
+    bulk_create does not (MySQL). Every bill gets a random
+    import_key which its id is read back by
+    """
+    if len(bills) == 1:
+        bills[0].save()
+        return
+    for bill_object in bills:
+        bill_object.import_key = uuid.uuid4()
+    Bill.objects.bulk_create(bills)
+    bill_ids = dict(Bill.original_objects.filter(
+        import_key__in=[bill_object.import_key for bill_object in bills]
+    ).values_list('import_key', 'id'))
+    for bill_object in bills:
+        bill_object.id = bill_ids[bill_object.import_key]
+        bill_object._state.adding = False
+        bill_object._state.db = Bill.objects.db
+
+
+def write_bill_batch(group_obj, added_by, batch):
+    """
+    insert a batch of parsed bills with their expenses and
+    payments and apply them to the balance ledgers in one transaction
+    """
+    with transaction.atomic():
+        # group lock first, see helpers.create_bill_records
+        Group.objects.select_for_update().get(id=group_obj.id)
+        bills = [
+            Bill(title=title, group=group_obj, added_by=added_by, bill_amount=bill_amount)
+            for title, bill_amount, _, _ in batch
+        ]
+        if connection.features.can_return_rows_from_bulk_insert:
+            Bill.objects.bulk_create(bills)
+        else:
+            insert_bills_returning_ids(bills)
+
+        expense_objs, payment_objs = [], []
+        for bill_object, (_, _, expense_data, payments_data) in zip(bills, batch):
+            bill_expenses, bill_payments = helpers.build_bill_records(
+                bill_object, expense_data, payments_data
+            )
+            expense_objs += bill_expenses
+            payment_objs += bill_payments
+        Expense.objects.bulk_create(expense_objs)
+        Payment.objects.bulk_create(payment_objs)
+
+        helpers.update_group_balances(group_obj, expense_objs)
+        helpers.update_pair_balances(group_obj, payment_objs)
+        splitAppCache.bump_group_ledger_versions([group_obj.id])
+
+
+def import_bills(group_obj, added_by, rows, batch_size=None):
+    """
+    import bill rows into a group. Invalid rows are skipped and
+    reported. returns (imported count, failed count, errors) where
+    errors lists the first BILL_IMPORT_MAX_ERRORS failures
+    """
+    batch_size = batch_size or settings.BILL_IMPORT_BATCH_SIZE
+    roster = helpers.GroupRoster.load(group_obj)
+
+    imported, failed, errors = 0, 0, []
+    users, batch = set(), []
+    for row_number, row in enumerate(rows, 1):
+        try:
+            if row is None:
+                raise ValueError('Malformed row')
+            parsed = parse_bill_row(row, roster)
+        except ValueError as e:
+            failed += 1
+            if len(errors) < settings.BILL_IMPORT_MAX_ERRORS:
+                errors.append({'row': row_number, 'error': str(e)})
+            continue
+
+        batch.append(parsed)
+        users.update(
+            user for user, expense in parsed[2].items() if expense != [0,0]
+        )
+        if len(batch) >= batch_size:
+            write_bill_batch(group_obj, added_by, batch)
+            imported += len(batch)
+            batch = []
+
+    if batch:
+        write_bill_batch(group_obj, added_by, batch)
+        imported += len(batch)
+
+    # auto settle once for everyone the import touched
+    with transaction.atomic():
+        helpers.enqueue_auto_settle(users)
+    return imported, failed, errors
@@ -0,0 +1,61 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from splitApp.models import Membership, Expense, Payment
+
+ARCHIVED_MODELS = (Membership, Expense, Payment)
+
+
+class Command(BaseCommand):
+    help = "Move rows soft deleted more than N days ago into the archive tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90,
+            help='Archive rows deleted more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Rows moved per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Only report how many rows would be archived')
+
+    def archive_batch(self, model, deleted_before, batch_size):
+        """
+        copy one batch of old deleted rows into the archive
+        table and remove them from the hot table.
+        returns number of rows moved
+        """
+        archive_model = model.original_objects.archived().model
+        with transaction.atomic():
+            rows = list(model.original_objects.select_for_update().filter(
+                is_deleted=True, deleted_on__lt=deleted_before
+            ).order_by('id')[:batch_size])
+            if not rows:
+                return 0
+            # ignore rows already copied by a run
+            # that died before deleting them
+            archive_model.objects.bulk_create(
+                [archive_model.from_row(row) for row in rows],
+                ignore_conflicts=True
+            )
+            model.original_objects.filter(id__in=[row.id for row in rows]).delete()
+        return len(rows)
+
+    def handle(self, *args, **options):
+        deleted_before = timezone.now() - datetime.timedelta(days=options['days'])
+        for model in ARCHIVED_MODELS:
+            if options['dry_run']:
+                count = model.original_objects.filter(
+                    is_deleted=True, deleted_on__lt=deleted_before
+                ).count()
+                self.stdout.write('%s: %s rows to archive' % (model.__name__, count))
+                continue
+
+            count = 0
+            while True:
+                moved = self.archive_batch(model, deleted_before, options['batch_size'])
+                count += moved
+                if moved < options['batch_size']:
+                    break
+            self.stdout.write('%s: archived %s rows' % (model.__name__, count))
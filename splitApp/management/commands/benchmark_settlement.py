@@ -0,0 +1,61 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from splitApp import helpers
+
+
+def random_balances(members_count, rng):
+    """
+    random net balances (minor units) summing to zero. Built from
+    small zero-sum clusters, like groups of friends splitting bills
+    among themselves, so there is something for optimal to find
+    """
+    balances = {}
+    member = 0
+    while member < members_count:
+        cluster_size = min(rng.randint(2, 4), members_count-member)
+        if members_count-member-cluster_size == 1:
+            cluster_size += 1
+        amounts = [rng.randint(1, 100000) for _ in range(cluster_size-1)]
+        amounts = [amount*rng.choice((-1, 1)) for amount in amounts]
+        amounts.append(-1*sum(amounts))
+        for amount in amounts:
+            balances["user%s" % member] = amount
+            member += 1
+    return balances
+
+
+class Command(BaseCommand):
+    help = "Compare speed and transfer count of the settlement strategies"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+',
+            default=[4, 6, 8, 10, 12, 14, 16, 100, 1000],
+            help='Group sizes to benchmark')
+        parser.add_argument('--rounds', type=int, default=20,
+            help='Random groups per size')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.stdout.write('%8s %10s %14s %14s %14s' % (
+            'members', 'strategy', 'avg ms', 'avg transfers', 'max transfers'
+        ))
+        for size in options['sizes']:
+            groups = [random_balances(size, rng) for _ in range(options['rounds'])]
+            for strategy, settle in helpers.SETTLEMENT_STRATEGIES.items():
+                # exponential solver is not run past the size groups may use
+                if strategy == "optimal" and size > 16:
+                    continue
+                transfer_counts = []
+                started = time.perf_counter()
+                for balances in groups:
+                    transfer_counts.append(len(settle(balances)))
+                elapsed = (time.perf_counter() - started) * 1000 / len(groups)
+                self.stdout.write('%8s %10s %14.3f %14.2f %14s' % (
+                    size, strategy, elapsed,
+                    sum(transfer_counts) / len(transfer_counts),
+                    max(transfer_counts),
+                ))
@@ -0,0 +1,154 @@
+import json
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from splitApp.models import Membership, Bill, SettleJob
+from splitApp import helpers
+
+
+def hot_paths(membership, bill):
+    """
+    the helpers run on every request, called for a sample
+    membership and bill. The queries they run are the ones
+    checked, so the check follows the code. Resolution
+    lookups served from splitApp.cache are unique key reads
+    and not included
+    """
+    user, group = membership.user, membership.group
+    username = user.user.username
+    return [
+        ('bill roster', lambda: helpers.GroupRoster.load_by_name(
+            group.name, [username]
+        )),
+        ('group roster', lambda: helpers.GroupRoster.load(group)),
+        ('group pair balances', lambda: list(
+            helpers.aggregate_pair_balances(user, group=group)
+        )),
+        ('overall balance', lambda: helpers.compute_overall_user_balance(user)),
+        ('group settlement plan', lambda: helpers.compute_group_settlement_plan(group)),
+        ('balance as of', lambda: helpers.compute_group_user_balance_as_of(
+            user, group, timezone.now()
+        )),
+        ('bill history page', lambda: helpers.get_bill_history_page(group)),
+        ('bill history next page', lambda: helpers.get_bill_history_page(
+            group, helpers.encode_bill_cursor(bill)
+        )),
+        ('user groups', lambda: helpers.user_groups(user)),
+        ('pending settle jobs', lambda: list(SettleJob.objects.filter(
+            status=SettleJob.PENDING, run_after__lte=timezone.now()
+        ).order_by('id').values_list('id', flat=True)[:50])),
+    ]
+
+
+class QueryCollector:
+    """
+    execute wrapper keeping the SELECTs run with their params
+    """
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith('SELECT'):
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+def collect_queries(func):
+    collector = QueryCollector()
+    with connection.execute_wrapper(collector):
+        func()
+    return collector.queries
+
+
+def explain(sql, params):
+    """
+    EXPLAIN output of a query the way QuerySet.explain formats
+    it, JSON on mysql and text elsewhere
+    """
+    vendor = connection.vendor
+    prefix = connection.ops.explain_query_prefix(
+        'json' if vendor == 'mysql' else None
+    )
+    with connection.cursor() as cursor:
+        cursor.execute('%s %s' % (prefix, sql), params)
+        rows = cursor.fetchall()
+    if vendor == 'mysql':
+        return rows[0][0]
+    return '\n'.join(
+        row if isinstance(row, str) else ' '.join(str(column) for column in row)
+        for row in rows
+    )
+
+
+def plan_full_scans(vendor, plan):
+    """
+    tables read with a full table scan in an EXPLAIN plan,
+    plan is the JSON output on mysql and the text output elsewhere
+    """
+    if vendor == 'mysql':
+        tables = []
+
+        def walk(node):
+            if isinstance(node, dict):
+                if node.get('access_type') == 'ALL':
+                    tables.append(node.get('table_name'))
+                for value in node.values():
+                    walk(value)
+            elif isinstance(node, list):
+                for value in node:
+                    walk(value)
+
+        walk(json.loads(plan))
+        return tables
+    if vendor == 'postgresql':
+        # mixed case table names like splitApp_expense are quoted
+        return re.findall(r'Seq Scan on "?(\w+)"?', plan)
+    if vendor == 'sqlite':
+        return re.findall(r'\bSCAN (?:TABLE )?(\w+)(?! USING)(?:\s|$)', plan)
+    raise CommandError('Query plan check is not supported on %s' % vendor)
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the hot balance and membership queries and fail on full table scans"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verbose-plans', action='store_true',
+            help='Print the full plan of every query',
+        )
+
+    def handle(self, *args, **options):
+        membership = Membership.objects.select_related(
+            'user__user', 'group'
+        ).order_by('id').first()
+        bill = membership and Bill.objects.filter(
+            group=membership.group
+        ).order_by('id').first()
+        if membership is None or bill is None:
+            raise CommandError(
+                'Seed the database with memberships and bills to check query plans'
+            )
+
+        failures = []
+        for label, func in hot_paths(membership, bill):
+            for index, (sql, params) in enumerate(collect_queries(func), 1):
+                query_label = '%s query %s' % (label, index)
+                plan = explain(sql, params)
+                if options['verbose_plans']:
+                    self.stdout.write('%s:\n%s\n%s' % (query_label, sql, plan))
+                tables = plan_full_scans(connection.vendor, plan)
+                if tables:
+                    failures.append(query_label)
+                    self.stdout.write('%s: full scan of %s' % (
+                        query_label, ', '.join(tables)
+                    ))
+                else:
+                    self.stdout.write('%s: ok' % query_label)
+
+        if failures:
+            raise CommandError(
+                '%s hot queries fall back to full table scans' % len(failures)
+            )
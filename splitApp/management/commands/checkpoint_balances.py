@@ -0,0 +1,41 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+
+from splitApp.models import Group, Payment, BalanceCheckpoint
+from splitApp import helpers
+
+
+class Command(BaseCommand):
+    help = "Checkpoint group balances incrementally from the previous checkpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lag', type=int, default=300,
+            help='Seconds the cutoff trails the current time, longer than any bill transaction')
+        parser.add_argument('--min-payments', type=int, default=100,
+            help='Only checkpoint groups with at least this many payments since their last checkpoint')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(seconds=options['lag'])
+        last_cutoffs = dict(
+            BalanceCheckpoint.objects.values('group_id').annotate(
+                last_cutoff=Max('cutoff')
+            ).values_list('group_id', 'last_cutoff')
+        )
+
+        count = 0
+        for group_obj in Group.objects.order_by('id'):
+            payments = Payment.objects.filter(group=group_obj, created_on__lte=cutoff)
+            last_cutoff = last_cutoffs.get(group_obj.id)
+            if last_cutoff is not None:
+                if last_cutoff >= cutoff:
+                    continue
+                payments = payments.filter(created_on__gt=last_cutoff)
+            if payments.count() < options['min_payments']:
+                continue
+
+            helpers.create_balance_checkpoint(group_obj, cutoff)
+            count += 1
+        self.stdout.write('Checkpointed %s groups up to %s' % (count, cutoff.isoformat()))
@@ -0,0 +1,38 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from splitApp.models import Group
+import splitApp.export as splitAppExport
+
+
+class Command(BaseCommand):
+    help = "Stream every bill, expense and payment of a group as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('groupname')
+        parser.add_argument('--format', default='ndjson',
+            choices=splitAppExport.EXPORT_FORMATS, dest='export_format')
+        parser.add_argument('--gzip', action='store_true',
+            help='gzip compress the output')
+        parser.add_argument('--output',
+            help='File to write to, stdout by default')
+
+    def handle(self, *args, **options):
+        try:
+            group_obj = Group.objects.get(name=options['groupname'])
+        except Group.DoesNotExist:
+            raise CommandError('Group not found!')
+
+        chunks = splitAppExport.iter_group_export(
+            group_obj, options['export_format'], options['gzip']
+        )
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+        else:
+            output = sys.stdout.buffer
+            for chunk in chunks:
+                output.write(chunk)
+            output.flush()
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from splitApp.models import Group, User, Membership
+import splitApp.importer as splitAppImporter
+
+
+class Command(BaseCommand):
+    help = "Bulk import bills into a group from an NDJSON or CSV file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('groupname')
+        parser.add_argument('path')
+        parser.add_argument('--username', required=True,
+            help='Group member the bills are added by')
+        parser.add_argument('--format', choices=splitAppImporter.IMPORT_FORMATS,
+            dest='import_format',
+            help='File format, guessed from the file extension by default')
+        parser.add_argument('--batch-size', type=int,
+            help='Bills written per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            group_obj = Group.objects.get(name=options['groupname'])
+        except Group.DoesNotExist:
+            raise CommandError('Group not found!')
+        try:
+            user = User.objects.get(user__username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('User not found!')
+        if not Membership.objects.filter(group=group_obj, user=user).exists():
+            raise CommandError('User is not a member of the group!')
+
+        import_format = options['import_format'] or (
+            'csv' if options['path'].endswith('.csv') else 'ndjson'
+        )
+        with open(options['path'], newline='', encoding='utf-8') as bills_file:
+            imported, failed, errors = splitAppImporter.import_bills(
+                group_obj, user,
+                splitAppImporter.iter_import_rows(bills_file, import_format),
+                options['batch_size']
+            )
+        for error in errors:
+            self.stdout.write('row %(row)s: %(error)s' % error)
+        self.stdout.write('Imported %s bills, %s rows failed' % (imported, failed))
@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from splitApp.models import Group, PairBalance, GroupBalance
+from splitApp import helpers
+import splitApp.cache as splitAppCache
+
+
+class Command(BaseCommand):
+    help = "Recompute the balance ledgers from expenses/payments and verify them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report mismatches, do not rewrite the ledgers',
+        )
+
+    def compare(self, label, expected, current):
+        """
+        print and return keys whose stored balance does not
+        match the recomputed one
+        """
+        mismatches = []
+        for key in set(expected.keys()).union(current.keys()):
+            expected_amount = expected.get(key, 0)
+            current_amount = current.get(key, 0)
+            if expected_amount != current_amount:
+                mismatches.append(key)
+                self.stdout.write('%s %s: ledger %s, recomputed %s' % (
+                    label, key, current_amount, expected_amount
+                ))
+        return mismatches
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # lock every group first, in id order, like the bill writers
+            # do, so no bill commits between reading the raw rows and
+            # rewriting the ledgers
+            list(Group.original_objects.select_for_update().order_by(
+                'id'
+            ).values_list('id', flat=True))
+            current_pairs = {
+                (row.group_id, row.user_a_id, row.user_b_id): row.amount
+                for row in PairBalance.objects.select_for_update()
+            }
+            current_members = {
+                (row.group_id, row.user_id): row.amount
+                for row in GroupBalance.objects.select_for_update()
+            }
+            expected_pairs = helpers.compute_pair_balances_from_payments()
+            expected_members = helpers.compute_group_balances_from_expenses()
+
+            mismatches = self.compare(
+                'pair (group, user_a, user_b)', expected_pairs, current_pairs
+            ) + self.compare(
+                'member (group, user)', expected_members, current_members
+            )
+
+            if options['check']:
+                if mismatches:
+                    raise CommandError(
+                        '%s balances do not match expenses/payments' % len(mismatches)
+                    )
+                self.stdout.write('Balances match expenses and payments')
+                return
+
+            PairBalance.objects.all().delete()
+            PairBalance.objects.bulk_create([
+                PairBalance(
+                    group_id=group_id, user_a_id=user_a_id,
+                    user_b_id=user_b_id, amount=amount
+                )
+                for (group_id, user_a_id, user_b_id), amount in expected_pairs.items()
+            ])
+            GroupBalance.objects.all().delete()
+            GroupBalance.objects.bulk_create([
+                GroupBalance(group_id=group_id, user_id=user_id, amount=amount)
+                for (group_id, user_id), amount in expected_members.items()
+            ])
+            splitAppCache.bump_group_ledger_versions(
+                set(key[0] for key in current_members.keys()).union(
+                    key[0] for key in expected_members.keys()
+                )
+            )
+            splitAppCache.bump_user_balance_versions(
+                set(key[1] for key in current_pairs.keys()).union(
+                    key[2] for key in current_pairs.keys()
+                ).union(
+                    key[1] for key in expected_pairs.keys()
+                ).union(
+                    key[2] for key in expected_pairs.keys()
+                )
+            )
+        self.stdout.write(
+            'Rebuilt %s pair and %s member balances, fixed %s mismatches' % (
+                len(expected_pairs), len(expected_members), len(mismatches)
+            )
+        )
@@ -0,0 +1,135 @@
+import datetime
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, connection, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from splitApp.models import SettleJob
+from splitApp import helpers
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Process queued auto settle jobs with a bounded pool of worker threads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+            help='Number of worker threads (and DB connections)')
+        parser.add_argument('--batch-size', type=int, default=50,
+            help='Jobs claimed per poll')
+        parser.add_argument('--max-attempts', type=int, default=5,
+            help='Attempts before a job is marked failed')
+        parser.add_argument('--retry-delay', type=int, default=30,
+            help='Base seconds to wait before retrying, doubled per attempt')
+        parser.add_argument('--stale-after', type=int, default=600,
+            help='Seconds after which running jobs are considered lost')
+        parser.add_argument('--poll-interval', type=float, default=2,
+            help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+            help='Exit once the queue is empty')
+
+    def requeue_stale_jobs(self, stale_after):
+        """
+        put back jobs left running by a worker that died
+        """
+        stale_before = timezone.now() - datetime.timedelta(seconds=stale_after)
+        stale_jobs = list(SettleJob.objects.filter(
+            status=SettleJob.RUNNING, updated_on__lt=stale_before
+        ))
+        for job in stale_jobs:
+            job.status = SettleJob.PENDING
+            self.save_job(job)
+        if stale_jobs:
+            self.stdout.write('Requeued %s stale jobs' % len(stale_jobs))
+
+    def save_job(self, job):
+        """
+        save a job, dropping it instead if it goes back to pending
+        while a bill has queued a new pending job for the user,
+        which settles them anyway
+        """
+        try:
+            with transaction.atomic():
+                job.save()
+        except IntegrityError:
+            job.delete()
+
+    def claim_jobs(self, batch_size):
+        """
+        claim pending jobs. The conditional update makes sure only
+        one worker process runs a job even when several poll together
+        """
+        job_ids = SettleJob.objects.filter(
+            status=SettleJob.PENDING, run_after__lte=timezone.now()
+        ).order_by('id').values_list('id', flat=True)[:batch_size]
+
+        claimed_ids = []
+        for job_id in job_ids:
+            claimed = SettleJob.objects.filter(
+                id=job_id, status=SettleJob.PENDING
+            ).update(
+                status=SettleJob.RUNNING, pending=None,
+                attempts=F('attempts')+1, updated_on=timezone.now()
+            )
+            if claimed:
+                claimed_ids.append(job_id)
+        return list(SettleJob.objects.filter(id__in=claimed_ids).select_related('user'))
+
+    def run_jobs(self, jobs, max_attempts, retry_delay):
+        """
+        auto settle the users of a chunk of jobs together in a
+        worker thread, so their balances are netted in one pass
+        """
+        close_old_connections()
+        try:
+            helpers.auto_settle([job.user for job in jobs])
+            SettleJob.objects.filter(id__in=[job.id for job in jobs]).delete()
+        except Exception as e:
+            logger.exception(
+                'Auto settle failed for users %s', [job.user_id for job in jobs]
+            )
+            for job in jobs:
+                if job.attempts >= max_attempts:
+                    job.status = SettleJob.FAILED
+                else:
+                    job.status = SettleJob.PENDING
+                    job.run_after = timezone.now() + datetime.timedelta(
+                        seconds=retry_delay * 2**(job.attempts-1)
+                    )
+                job.last_error = str(e)
+                self.save_job(job)
+        finally:
+            # worker threads own their connection, close it
+            # instead of leaking one per thread
+            connection.close()
+
+    def handle(self, *args, **options):
+        self.requeue_stale_jobs(options['stale_after'])
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                jobs = self.claim_jobs(options['batch_size'])
+                if not jobs:
+                    if options['once']:
+                        break
+                    connection.close()
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                # one chunk of users per worker thread
+                workers = options['workers']
+                futures = [
+                    executor.submit(
+                        self.run_jobs, jobs[index::workers],
+                        options['max_attempts'], options['retry_delay']
+                    )
+                    for index in range(min(workers, len(jobs)))
+                ]
+                for future in futures:
+                    future.result()
+                self.stdout.write('Processed %s settle jobs' % len(jobs))
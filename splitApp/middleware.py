@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_query_budget(url_name):
+    """
+    max queries a request to url_name should run,
+    see QUERY_BUDGETS in settings
+    """
+    return settings.QUERY_BUDGETS.get(url_name, settings.QUERY_BUDGET_DEFAULT)
+
+
+class QueryRecorder:
+    """
+    execute wrapper counting queries run and time spent in them.
+    Async views run queries on several threads at once
+    """
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.count += 1
+                self.duration += time.perf_counter() - started
+
+
+# recorder of the request being served. Context variables follow the
+# request onto the threads sync_to_async runs its queries on
+_current_recorder = ContextVar('query_recorder', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    execute wrapper of every connection, hands queries to
+    the recorder of the current request if there is one
+    """
+    recorder = _current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """
+    connection_created receiver, connections are per thread so
+    worker threads get the wrapper when they first connect
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class QueryCountMiddleware:
+    """
+    record SQL query count and time per request and log
+    requests which go over the budget of their url.
+    Runs natively under ASGI so async views are not
+    moved onto the single thread of sync middleware
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks __call__ as returning a coroutine for the
+            # handler, as django's MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        token = _current_recorder.set(recorder)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_recorder.reset(token)
+        return self.process_response(request, response, recorder)
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        token = _current_recorder.set(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_recorder.reset(token)
+        return self.process_response(request, response, recorder)
+
+    def process_response(self, request, response, recorder):
+        url_name = None
+        if request.resolver_match:
+            url_name = request.resolver_match.url_name
+        budget = get_query_budget(url_name)
+
+        response['X-Query-Count'] = recorder.count
+        response['X-Query-Time-Ms'] = '%.2f' % (recorder.duration*1000)
+        if recorder.count > budget:
+            logger.warning(
+                '%s %s ran %s queries in %.2fms, budget is %s',
+                request.method, request.path, recorder.count,
+                recorder.duration*1000, budget
+            )
+        return response
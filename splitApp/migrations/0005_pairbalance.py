@@ -0,0 +1,60 @@
+# Generated by Django 3.1.4 on 2026-10-18 08:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+from collections import defaultdict
+
+
+def populate_pair_balances(apps, schema_editor):
+    """
+    build the pairwise ledger from existing payments
+    """
+    Payment = apps.get_model('splitApp', 'Payment')
+    PairBalance = apps.get_model('splitApp', 'PairBalance')
+
+    balances = defaultdict(lambda:0)
+    payment_totals = Payment.objects.filter(is_deleted=False).values(
+        'bill__group_id', 'payer_id', 'receiver_id'
+    ).annotate(total=models.Sum('amount'))
+    for row in payment_totals:
+        payer_id, receiver_id = row['payer_id'], row['receiver_id']
+        if receiver_id < payer_id:
+            key = (row['bill__group_id'], receiver_id, payer_id)
+            balances[key] += row['total']
+        else:
+            key = (row['bill__group_id'], payer_id, receiver_id)
+            balances[key] -= row['total']
+
+    PairBalance.objects.bulk_create([
+        PairBalance(
+            group_id=group_id, user_a_id=user_a_id,
+            user_b_id=user_b_id, amount=amount
+        )
+        for (group_id, user_a_id, user_b_id), amount in balances.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0004_auto_20201231_0615'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PairBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.FloatField(default=0)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='pair_balance', to='splitApp.group')),
+                ('user_a', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='pair_balance_a', to='splitApp.user')),
+                ('user_b', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='pair_balance_b', to='splitApp.user')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pairbalance',
+            constraint=models.UniqueConstraint(fields=('group', 'user_a', 'user_b'), name='unique_pair_balance'),
+        ),
+        migrations.RunPython(populate_pair_balances, migrations.RunPython.noop),
+    ]
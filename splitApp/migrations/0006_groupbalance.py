@@ -0,0 +1,48 @@
+# Generated by Django 3.1.4 on 2026-10-18 08:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_group_balances(apps, schema_editor):
+    """
+    build per member balances from existing expenses
+    """
+    Expense = apps.get_model('splitApp', 'Expense')
+    GroupBalance = apps.get_model('splitApp', 'GroupBalance')
+
+    expense_totals = Expense.objects.filter(is_deleted=False).values(
+        'bill__group_id', 'user_id'
+    ).annotate(paid=models.Sum('amount_paid'), owed=models.Sum('amount_owed'))
+    GroupBalance.objects.bulk_create([
+        GroupBalance(
+            group_id=row['bill__group_id'], user_id=row['user_id'],
+            amount=row['paid'] - row['owed']
+        )
+        for row in expense_totals
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0005_pairbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.FloatField(default=0)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='group_balance', to='splitApp.group')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='group_balance', to='splitApp.user')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='groupbalance',
+            constraint=models.UniqueConstraint(fields=('group', 'user'), name='unique_group_balance'),
+        ),
+        migrations.RunPython(populate_group_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,127 @@
+# Generated by Django 3.1.4 on 2026-10-18 08:52
+
+from collections import defaultdict
+from django.db import migrations, models
+from django.db.models.functions import Round
+
+
+# model -> (amount fields, lookup to group currency)
+AMOUNT_FIELDS = {
+    'Bill': (['bill_amount'], 'group__default_currency'),
+    'Expense': (['amount_paid', 'amount_owed'], 'bill__group__default_currency'),
+    'Payment': (['amount'], 'bill__group__default_currency'),
+    'PairBalance': (['amount'], 'group__default_currency'),
+    'GroupBalance': (['amount'], 'group__default_currency'),
+}
+
+# currency -> exponent as settings.CURRENCY_MINOR_UNITS was when this
+# migration was written. Frozen so a later settings change does not
+# rescale existing rows differently
+CURRENCY_MINOR_UNITS = {
+    'INR': 2,
+    'USD': 2,
+}
+
+
+def scale_amounts(apps, reverse):
+    for model_name, (fields, currency_lookup) in AMOUNT_FIELDS.items():
+        model = apps.get_model('splitApp', model_name)
+        for currency, exponent in CURRENCY_MINOR_UNITS.items():
+            factor = 10**exponent
+            if reverse:
+                updates = {field: models.F(field)*1.0/factor for field in fields}
+            else:
+                updates = {field: Round(models.F(field)*factor) for field in fields}
+            model.objects.filter(**{currency_lookup: currency}).update(**updates)
+
+
+def amounts_to_minor_units(apps, schema_editor):
+    scale_amounts(apps, reverse=False)
+
+
+def amounts_to_major_units(apps, schema_editor):
+    scale_amounts(apps, reverse=True)
+
+
+def rebuild_balances(apps, schema_editor):
+    """
+    rebuild ledgers from the converted rows so they hold
+    the exact sums of the rounded amounts
+    """
+    Expense = apps.get_model('splitApp', 'Expense')
+    Payment = apps.get_model('splitApp', 'Payment')
+    PairBalance = apps.get_model('splitApp', 'PairBalance')
+    GroupBalance = apps.get_model('splitApp', 'GroupBalance')
+
+    balances = defaultdict(lambda:0)
+    payment_totals = Payment.objects.filter(is_deleted=False).values(
+        'bill__group_id', 'payer_id', 'receiver_id'
+    ).annotate(total=models.Sum('amount'))
+    for row in payment_totals:
+        payer_id, receiver_id = row['payer_id'], row['receiver_id']
+        if receiver_id < payer_id:
+            balances[(row['bill__group_id'], receiver_id, payer_id)] += row['total']
+        else:
+            balances[(row['bill__group_id'], payer_id, receiver_id)] -= row['total']
+    PairBalance.objects.all().delete()
+    PairBalance.objects.bulk_create([
+        PairBalance(
+            group_id=group_id, user_a_id=user_a_id,
+            user_b_id=user_b_id, amount=amount
+        )
+        for (group_id, user_a_id, user_b_id), amount in balances.items()
+    ])
+
+    expense_totals = Expense.objects.filter(is_deleted=False).values(
+        'bill__group_id', 'user_id'
+    ).annotate(paid=models.Sum('amount_paid'), owed=models.Sum('amount_owed'))
+    GroupBalance.objects.all().delete()
+    GroupBalance.objects.bulk_create([
+        GroupBalance(
+            group_id=row['bill__group_id'], user_id=row['user_id'],
+            amount=row['paid'] - row['owed']
+        )
+        for row in expense_totals
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0006_groupbalance'),
+    ]
+
+    operations = [
+        migrations.RunPython(amounts_to_minor_units, amounts_to_major_units),
+        migrations.AlterField(
+            model_name='bill',
+            name='bill_amount',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='amount_owed',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='amount_paid',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='groupbalance',
+            name='amount',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='pairbalance',
+            name='amount',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='amount',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(rebuild_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.4 on 2026-10-18 08:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0007_minor_unit_amounts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SettleJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('failed', 'failed')], default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='settle_job', to='splitApp.user')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='settlejob',
+            index=models.Index(fields=['status', 'run_after'], name='settle_job_status_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0008_settlejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='settlement_strategy',
+            field=models.CharField(choices=[('greedy', 'greedy'), ('optimal', 'optimal')], default='greedy', max_length=20),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 3.1.4 on 2026-10-18 09:02
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def mark_live_memberships(apps, schema_editor):
+    """
+    clear the live marker of deleted memberships and soft delete
+    duplicate live memberships, keeping the oldest one, so the
+    unique constraint can be added
+    """
+    Membership = apps.get_model('splitApp', 'Membership')
+    now = timezone.now()
+    Membership.objects.filter(is_deleted=True).update(live=None)
+
+    duplicates = Membership.objects.filter(is_deleted=False).values(
+        'group_id', 'user_id'
+    ).annotate(
+        count=models.Count('id'), first_id=models.Min('id')
+    ).filter(count__gt=1)
+    for row in duplicates:
+        Membership.objects.filter(
+            group_id=row['group_id'], user_id=row['user_id'], is_deleted=False
+        ).exclude(id=row['first_id']).update(
+            is_deleted=True, live=None, deleted_on=now, updated_on=now
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0009_group_settlement_strategy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='membership',
+            name='live',
+            field=models.BooleanField(default=True, editable=False, null=True),
+        ),
+        migrations.RunPython(mark_live_memberships, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['group', 'is_deleted', 'created_on'], name='bill_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['bill', 'is_deleted'], name='expense_bill_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['user', 'is_deleted', 'bill'], name='expense_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='membership',
+            index=models.Index(fields=['group', 'is_deleted', 'user'], name='membership_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='membership',
+            index=models.Index(fields=['user', 'is_deleted', 'group'], name='membership_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pairbalance',
+            index=models.Index(fields=['user_a', 'group'], name='pair_balance_user_a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pairbalance',
+            index=models.Index(fields=['user_b', 'group'], name='pair_balance_user_b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['bill', 'is_deleted'], name='payment_bill_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['payer', 'is_deleted', 'bill'], name='payment_payer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['receiver', 'is_deleted', 'bill'], name='payment_receiver_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='membership',
+            constraint=models.UniqueConstraint(fields=('group', 'user', 'live'), name='unique_live_membership'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.1.4 on 2026-10-18 09:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def backfill_group(model):
+    """
+    copy bill.group onto rows of model in id ranges. The migration
+    is not atomic so every batch commits on its own and row locks
+    are only held for one batch
+    """
+    def backfill(apps, schema_editor):
+        Bill = apps.get_model('splitApp', 'Bill')
+        Model = apps.get_model('splitApp', model)
+        bill_group = Bill.objects.filter(
+            id=models.OuterRef('bill_id')
+        ).values('group_id')[:1]
+
+        max_id = Model.objects.aggregate(max_id=models.Max('id'))['max_id'] or 0
+        for start in range(0, max_id+1, BACKFILL_BATCH_SIZE):
+            Model.objects.filter(
+                id__gte=start, id__lt=start+BACKFILL_BATCH_SIZE,
+                group__isnull=True
+            ).update(group_id=models.Subquery(bill_group))
+    return backfill
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('splitApp', '0010_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='group',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='expense', to='splitApp.group'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='group',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='payment', to='splitApp.group'),
+        ),
+        migrations.RunPython(backfill_group('Expense'), migrations.RunPython.noop),
+        migrations.RunPython(backfill_group('Payment'), migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.1.4 on 2026-10-18 09:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0011_expense_payment_group'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='expense',
+            name='expense_user_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_payer_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_receiver_idx',
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='group',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='expense', to='splitApp.group'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='group',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='payment', to='splitApp.group'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['group', 'is_deleted', 'user'], name='expense_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['user', 'is_deleted', 'group'], name='expense_user_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['group', 'is_deleted', 'payer', 'receiver'], name='payment_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['payer', 'is_deleted', 'group'], name='payment_payer_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['receiver', 'is_deleted', 'group'], name='payment_receiver_group_idx'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.1.4 on 2026-10-18 09:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0012_group_not_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPayment',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created_on', models.DateTimeField()),
+                ('updated_on', models.DateTimeField()),
+                ('deleted_on', models.DateTimeField(blank=True, null=True)),
+                ('archived_on', models.DateTimeField(auto_now_add=True)),
+                ('amount', models.BigIntegerField(default=0)),
+                ('bill', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.bill')),
+                ('group', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.group')),
+                ('payer', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.user')),
+                ('receiver', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.user')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedMembership',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created_on', models.DateTimeField()),
+                ('updated_on', models.DateTimeField()),
+                ('deleted_on', models.DateTimeField(blank=True, null=True)),
+                ('archived_on', models.DateTimeField(auto_now_add=True)),
+                ('group', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.group')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.user')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedExpense',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created_on', models.DateTimeField()),
+                ('updated_on', models.DateTimeField()),
+                ('deleted_on', models.DateTimeField(blank=True, null=True)),
+                ('archived_on', models.DateTimeField(auto_now_add=True)),
+                ('amount_paid', models.BigIntegerField(default=0)),
+                ('amount_owed', models.BigIntegerField(default=0)),
+                ('bill', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.bill')),
+                ('group', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.group')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='splitApp.user')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
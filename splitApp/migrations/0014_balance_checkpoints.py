@@ -0,0 +1,61 @@
+# Generated by Django 3.1.4 on 2026-10-18 09:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0013_archive_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cutoff', models.DateTimeField()),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CheckpointBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['group', 'is_deleted', 'created_on'], name='payment_group_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='checkpointbalance',
+            name='checkpoint',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance', to='splitApp.balancecheckpoint'),
+        ),
+        migrations.AddField(
+            model_name='checkpointbalance',
+            name='user_a',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='checkpoint_balance_a', to='splitApp.user'),
+        ),
+        migrations.AddField(
+            model_name='checkpointbalance',
+            name='user_b',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='checkpoint_balance_b', to='splitApp.user'),
+        ),
+        migrations.AddField(
+            model_name='balancecheckpoint',
+            name='group',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='balance_checkpoint', to='splitApp.group'),
+        ),
+        migrations.AddConstraint(
+            model_name='checkpointbalance',
+            constraint=models.UniqueConstraint(fields=('checkpoint', 'user_a', 'user_b'), name='unique_checkpoint_balance'),
+        ),
+        migrations.AddIndex(
+            model_name='balancecheckpoint',
+            index=models.Index(fields=['group', 'cutoff'], name='checkpoint_group_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1.4 on 2026-10-18 09:56
+
+from django.db import migrations, models
+
+
+def mark_pending_jobs(apps, schema_editor):
+    """
+    clear the pending marker of running and failed jobs and drop
+    duplicate pending jobs of a user, keeping the oldest one, so
+    the unique constraint can be added. One job settles the user
+    """
+    SettleJob = apps.get_model('splitApp', 'SettleJob')
+    SettleJob.objects.exclude(status='pending').update(pending=None)
+
+    duplicates = SettleJob.objects.filter(status='pending').values(
+        'user_id'
+    ).annotate(
+        count=models.Count('id'), first_id=models.Min('id')
+    ).filter(count__gt=1)
+    for row in duplicates:
+        SettleJob.objects.filter(
+            user_id=row['user_id'], status='pending'
+        ).exclude(id=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0014_balance_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settlejob',
+            name='pending',
+            field=models.BooleanField(default=True, editable=False, null=True),
+        ),
+        migrations.RunPython(mark_pending_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='settlejob',
+            constraint=models.UniqueConstraint(fields=('user', 'pending'), name='unique_pending_settle_job'),
+        ),
+    ]
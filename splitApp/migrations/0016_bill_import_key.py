@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 09:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('splitApp', '0015_settlejob_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='import_key',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+    ]
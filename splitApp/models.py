@@ -1,9 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import User as user
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, post_init
 from django.db.models.query import QuerySet
-from famsplit.settings import SUPPORTED_CURRENCIES
+from django.db.backends.signals import connection_created
+from famsplit.settings import SUPPORTED_CURRENCIES, SETTLEMENT_STRATEGIES
 from django.utils import timezone
+import splitApp.cache as splitAppCache
+from splitApp.middleware import install_query_recorder
 
 # Create your models here.
 class BaseModelQuerySet(QuerySet):
@@ -11,10 +14,10 @@ class BaseModelQuerySet(QuerySet):
     using BaseModel for queryset operations
     '''
     def delete(self):
-        for obj in self:
-            obj.is_deleted=True
-            obj.deleted_on=timezone.now()
-            obj.save()
+        # soft delete with a single UPDATE instead of
+        # loading and saving every row
+        now = timezone.now()
+        return self.update(is_deleted=True, deleted_on=now, updated_on=now)
 
 
 class BaseModelManager(models.Manager):
@@ -26,6 +29,20 @@ class BaseModelManager(models.Manager):
             is_deleted=False)
 
 
+class ArchivableManager(models.Manager):
+    '''
+    manager for all rows including soft deleted ones.
+    Rows moved to cold storage by the archive_deleted_rows
+    command are reachable through archived()
+    '''
+    def archived(self):
+        if self.model.archive_model is None:
+            raise ValueError('%s rows are never archived' % self.model.__name__)
+        return self.model._meta.apps.get_model(
+            self.model._meta.app_label, self.model.archive_model
+        ).objects.all()
+
+
 class BaseModel(models.Model):
     '''
     BaseModel for enabling soft-delete and adding
@@ -39,7 +56,10 @@ class BaseModel(models.Model):
     is_deleted = models.BooleanField(default=False)
     deleted_on = models.DateTimeField(null=True, blank=True)
     objects = BaseModelManager()
-    original_objects = models.Manager()
+    original_objects = ArchivableManager()
+
+    # name of the model deleted rows are archived to
+    archive_model = None
 
     def delete(self):
         self.is_deleted=True
@@ -81,6 +101,36 @@ def create_user(sender, instance, created, **kwargs):
 post_save.connect(create_user, sender=user)
 
 
+def remember_username(sender, instance, **kwargs):
+    """
+    username the django user was loaded with, so a
+    rename also drops the cached old username
+    """
+    instance._loaded_username = instance.__dict__.get('username')
+
+def invalidate_username(sender, instance, **kwargs):
+    """
+    drop cached resolution of the username of a django user
+    """
+    splitAppCache.invalidate_profiles(
+        [instance.username, instance._loaded_username]
+    )
+    instance._loaded_username = instance.username
+
+def invalidate_profile(sender, instance, **kwargs):
+    """
+    drop cached resolution of a user profile
+    """
+    splitAppCache.invalidate_profiles([instance.name])
+
+# Signals to keep splitApp.cache username resolution fresh
+post_init.connect(remember_username, sender=user)
+post_save.connect(invalidate_username, sender=user)
+post_delete.connect(invalidate_username, sender=user)
+post_save.connect(invalidate_profile, sender=User)
+post_delete.connect(invalidate_profile, sender=User)
+
+
 class Group(BaseModel):
     # Keeping name unique for easy usage in API.
     # Should be done via unique ID ideally.
@@ -94,6 +144,12 @@ class Group(BaseModel):
     group_icon = models.ImageField(upload_to ='uploads/',null=True, blank=True)
     simplify_payments = models.BooleanField(default=False)
 
+    # how simplified payments are computed, see
+    # helpers.SETTLEMENT_STRATEGIES
+    settlement_strategy = models.CharField(max_length=20, null=False,
+                                        blank=False, choices=SETTLEMENT_STRATEGIES,
+                                        default='greedy')
+
     default_currency = models.CharField(max_length=20, null=False,
                                         blank=False, choices=SUPPORTED_CURRENCIES,
                                         default='INR')
@@ -101,6 +157,45 @@ class Group(BaseModel):
     def __str__(self):
         return self.name
 
+def remember_group_name(sender, instance, **kwargs):
+    """
+    name the group was loaded with, so a rename
+    also drops the cached old name
+    """
+    instance._loaded_name = instance.__dict__.get('name')
+
+def invalidate_group(sender, instance, **kwargs):
+    """
+    drop cached resolution of a group name
+    """
+    splitAppCache.invalidate_groups([instance.name, instance._loaded_name])
+    instance._loaded_name = instance.name
+
+# Signals to keep splitApp.cache group resolution fresh
+post_init.connect(remember_group_name, sender=Group)
+post_save.connect(invalidate_group, sender=Group)
+post_delete.connect(invalidate_group, sender=Group)
+
+class MembershipQuerySet(BaseModelQuerySet):
+    '''
+    clear the live marker along with the soft delete
+    '''
+    def delete(self):
+        now = timezone.now()
+        return self.update(
+            is_deleted=True, live=None, deleted_on=now, updated_on=now
+        )
+
+
+class MembershipManager(BaseModelManager):
+    '''
+    manager for returning non-deleted memberships
+    '''
+    def get_queryset(self):
+        return MembershipQuerySet(self.model, using=self._db).filter(
+            is_deleted=False)
+
+
 class Membership(BaseModel):
     user = models.ForeignKey('User', null=False, blank=False,
                             related_name="membership",
@@ -111,6 +206,41 @@ class Membership(BaseModel):
                             on_delete=models.PROTECT
                             )
 
+    # True while the membership is live and NULL once deleted.
+    # MySQL has no partial unique indexes but allows repeated
+    # NULLs, so (group, user, live) is unique for live rows only
+    live = models.BooleanField(null=True, default=True, editable=False)
+    objects = MembershipManager()
+    archive_model = 'ArchivedMembership'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['group', 'user', 'live'],
+                name='unique_live_membership'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['group', 'is_deleted', 'user'],
+                        name='membership_group_idx'),
+            models.Index(fields=['user', 'is_deleted', 'group'],
+                        name='membership_user_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.live = None if self.is_deleted else True
+        super().save(*args, **kwargs)
+
+def invalidate_membership(sender, instance, **kwargs):
+    """
+    drop cached membership check of a user in a group
+    """
+    splitAppCache.invalidate_memberships([(instance.group_id, instance.user_id)])
+
+# Signals to keep splitApp.cache membership checks fresh
+post_save.connect(invalidate_membership, sender=Membership)
+post_delete.connect(invalidate_membership, sender=Membership)
+
 
 class Bill(BaseModel):
     title = models.CharField(max_length=500, null=True, blank=True)
@@ -124,7 +254,18 @@ class Bill(BaseModel):
                             related_name="bill",
                             on_delete=models.PROTECT
                             )
-    bill_amount = models.FloatField(null=False, blank=False, default=0)
+    # amounts are in minor units of group currency,
+    # see CURRENCY_MINOR_UNITS
+    bill_amount = models.BigIntegerField(null=False, blank=False, default=0)
+    # set on bills written by the bill import so their ids can be read
+    # back after a bulk insert on backends which do not return them
+    import_key = models.UUIDField(null=True, blank=True, unique=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'is_deleted', 'created_on'],
+                        name='bill_group_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -135,12 +276,33 @@ class Expense(BaseModel):
                             related_name="expense",
                             on_delete=models.PROTECT
                             )
+    # copy of bill.group so group scoped reads
+    # do not have to join Bill
+    group = models.ForeignKey('Group', null=False, blank=False,
+                            related_name="expense",
+                            on_delete=models.PROTECT
+                            )
     user = models.ForeignKey('User', null=False, blank=False,
                             related_name="expense",
                             on_delete=models.PROTECT
                             )
-    amount_paid = models.FloatField(null=False, blank=False, default=0)
-    amount_owed = models.FloatField(null=False, blank=False, default=0)
+    amount_paid = models.BigIntegerField(null=False, blank=False, default=0)
+    amount_owed = models.BigIntegerField(null=False, blank=False, default=0)
+    archive_model = 'ArchivedExpense'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['bill', 'is_deleted'], name='expense_bill_idx'),
+            models.Index(fields=['group', 'is_deleted', 'user'],
+                        name='expense_group_idx'),
+            models.Index(fields=['user', 'is_deleted', 'group'],
+                        name='expense_user_group_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.group_id is None:
+            self.group_id = self.bill.group_id
+        super().save(*args, **kwargs)
 
     def get_balance(self):
         return self.amount_paid - self.amount_owed
@@ -151,6 +313,12 @@ class Payment(BaseModel):
                             related_name="payment",
                             on_delete=models.PROTECT
                             )
+    # copy of bill.group so group scoped reads
+    # do not have to join Bill
+    group = models.ForeignKey('Group', null=False, blank=False,
+                            related_name="payment",
+                            on_delete=models.PROTECT
+                            )
     payer = models.ForeignKey('User', null=False, blank=False,
                             related_name="payer",
                             on_delete=models.PROTECT
@@ -159,7 +327,26 @@ class Payment(BaseModel):
                             related_name="receiver",
                             on_delete=models.PROTECT
                             )
-    amount = models.FloatField(null=False, blank=False, default=0)
+    amount = models.BigIntegerField(null=False, blank=False, default=0)
+    archive_model = 'ArchivedPayment'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['bill', 'is_deleted'], name='payment_bill_idx'),
+            models.Index(fields=['group', 'is_deleted', 'payer', 'receiver'],
+                        name='payment_group_idx'),
+            models.Index(fields=['group', 'is_deleted', 'created_on'],
+                        name='payment_group_created_idx'),
+            models.Index(fields=['payer', 'is_deleted', 'group'],
+                        name='payment_payer_group_idx'),
+            models.Index(fields=['receiver', 'is_deleted', 'group'],
+                        name='payment_receiver_group_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.group_id is None:
+            self.group_id = self.bill.group_id
+        super().save(*args, **kwargs)
 
 
 class Note(BaseModel):
@@ -171,3 +358,241 @@ class Note(BaseModel):
 
     # should be uploaded to services like S3 ideally
     image = models.ImageField(upload_to ='uploads/',null=True, blank=True)
+
+
+class PairBalance(models.Model):
+    '''
+    materialized net balance between two users in a group.
+    user_a always has the smaller id; a positive amount
+    means user_b owes user_a. Maintained incrementally
+    by the bill write paths, see helpers.update_pair_balances
+    '''
+    group = models.ForeignKey('Group', null=False, blank=False,
+                            related_name="pair_balance",
+                            on_delete=models.PROTECT
+                            )
+    user_a = models.ForeignKey('User', null=False, blank=False,
+                            related_name="pair_balance_a",
+                            on_delete=models.PROTECT
+                            )
+    user_b = models.ForeignKey('User', null=False, blank=False,
+                            related_name="pair_balance_b",
+                            on_delete=models.PROTECT
+                            )
+    amount = models.BigIntegerField(null=False, blank=False, default=0)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['group', 'user_a', 'user_b'],
+                name='unique_pair_balance'
+            ),
+        ]
+        # balances of a user are looked up from either side of the pair
+        indexes = [
+            models.Index(fields=['user_a', 'group'], name='pair_balance_user_a_idx'),
+            models.Index(fields=['user_b', 'group'], name='pair_balance_user_b_idx'),
+        ]
+
+
+class GroupBalance(models.Model):
+    '''
+    materialized net balance (paid - owed) of a member in a group.
+    Maintained incrementally from expenses, see
+    helpers.update_group_balances
+    '''
+    group = models.ForeignKey('Group', null=False, blank=False,
+                            related_name="group_balance",
+                            on_delete=models.PROTECT
+                            )
+    user = models.ForeignKey('User', null=False, blank=False,
+                            related_name="group_balance",
+                            on_delete=models.PROTECT
+                            )
+    amount = models.BigIntegerField(null=False, blank=False, default=0)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['group', 'user'],
+                name='unique_group_balance'
+            ),
+        ]
+
+
+class SettleJob(models.Model):
+    '''
+    pending auto settle work for a user. Created by bill writes
+    and processed by the run_settle_worker management command
+    '''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'pending'),
+        (RUNNING, 'running'),
+        (FAILED, 'failed'),
+    )
+
+    user = models.ForeignKey('User', null=False, blank=False,
+                            related_name="settle_job",
+                            on_delete=models.CASCADE
+                            )
+    status = models.CharField(max_length=20, null=False, blank=False,
+                            choices=STATUS_CHOICES, default=PENDING
+                            )
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    # True while the job is pending and NULL otherwise, so
+    # (user, pending) allows one pending job per user, see
+    # Membership.live. Bulk updates of status must set it too
+    pending = models.BooleanField(null=True, default=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'pending'],
+                name='unique_pending_settle_job'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='settle_job_status_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.pending = True if self.status == self.PENDING else None
+        super().save(*args, **kwargs)
+
+
+class BalanceCheckpoint(models.Model):
+    '''
+    net pairwise balances of a group over the payments created up
+    to cutoff. Balances as of a date are read from the latest
+    checkpoint plus the payments after it, see
+    helpers.create_balance_checkpoint
+    '''
+    group = models.ForeignKey('Group', null=False, blank=False,
+                            related_name="balance_checkpoint",
+                            on_delete=models.PROTECT
+                            )
+    cutoff = models.DateTimeField(null=False, blank=False)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'cutoff'], name='checkpoint_group_idx'),
+        ]
+
+
+class CheckpointBalance(models.Model):
+    '''
+    balance between two users in a checkpoint, with the
+    same user_a/user_b ordering and sign as PairBalance
+    '''
+    checkpoint = models.ForeignKey('BalanceCheckpoint', null=False, blank=False,
+                            related_name="balance",
+                            on_delete=models.CASCADE
+                            )
+    user_a = models.ForeignKey('User', null=False, blank=False,
+                            related_name="checkpoint_balance_a",
+                            on_delete=models.PROTECT
+                            )
+    user_b = models.ForeignKey('User', null=False, blank=False,
+                            related_name="checkpoint_balance_b",
+                            on_delete=models.PROTECT
+                            )
+    amount = models.BigIntegerField(null=False, blank=False, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['checkpoint', 'user_a', 'user_b'],
+                name='unique_checkpoint_balance'
+            ),
+        ]
+
+class ArchivedModel(models.Model):
+    '''
+    cold storage for soft deleted rows, filled by the
+    archive_deleted_rows command. Rows keep their original id
+    and foreign keys are not enforced so archived rows
+    never block changes to the hot tables
+    '''
+    class Meta:
+        abstract = True
+
+    id = models.IntegerField(primary_key=True)
+    created_on = models.DateTimeField()
+    updated_on = models.DateTimeField()
+    deleted_on = models.DateTimeField(null=True, blank=True)
+    archived_on = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def from_row(cls, row):
+        '''
+        archive copy of a soft deleted row
+        '''
+        return cls(**{
+            field.attname: getattr(row, field.attname)
+            for field in cls._meta.concrete_fields
+            if field.attname != 'archived_on'
+        })
+
+
+class ArchivedMembership(ArchivedModel):
+    user = models.ForeignKey('User', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+    group = models.ForeignKey('Group', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+
+
+class ArchivedExpense(ArchivedModel):
+    bill = models.ForeignKey('Bill', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+    group = models.ForeignKey('Group', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+    user = models.ForeignKey('User', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+    amount_paid = models.BigIntegerField(null=False, blank=False, default=0)
+    amount_owed = models.BigIntegerField(null=False, blank=False, default=0)
+
+
+class ArchivedPayment(ArchivedModel):
+    bill = models.ForeignKey('Bill', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+    group = models.ForeignKey('Group', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+    payer = models.ForeignKey('User', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+    receiver = models.ForeignKey('User', null=False, blank=False,
+                            related_name="+", db_constraint=False,
+                            on_delete=models.DO_NOTHING
+                            )
+    amount = models.BigIntegerField(null=False, blank=False, default=0)
+
+
+# count queries of every connection, including the ones worker
+# threads open, for the request QueryCountMiddleware is recording
+connection_created.connect(install_query_recorder)
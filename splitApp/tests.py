@@ -1,3 +1,1747 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import importlib
+import io
+import json
+import multiprocessing
+import random
+import tempfile
+import unittest
+from unittest import mock
+from collections import defaultdict
 
-# Create your tests here.
+from django.test import (
+    AsyncClient, TestCase, SimpleTestCase, TransactionTestCase, override_settings
+)
+from django.contrib.admin.sites import site as admin_site
+from django.contrib.auth.models import User as DjangoUser
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F, Max, Sum
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import RefreshToken
+
+import splitApp.models as splitAppModels
+import splitApp.cache as splitAppCache
+from splitApp import helpers
+import splitApp.export as splitAppExport
+import splitApp.importer as splitAppImporter
+from splitApp.authentication import ProfileJWTAuthentication
+from splitApp.middleware import get_query_budget
+from splitApp.management.commands import check_query_plans, run_settle_worker
+
+
+class BalanceQueryCountTest(TestCase):
+    """
+    balance reads should cost a fixed number of queries
+    however many bills and members a group has
+    """
+    def setUp(self):
+        cache.clear()
+        splitAppCache.clear_resolution_cache()
+        self.client = APIClient()
+        django_users = [
+            DjangoUser.objects.create(username="user%s" % i, email="user%s@test.com" % i)
+            for i in range(6)
+        ]
+        self.client.force_authenticate(user=django_users[0])
+        self.client.post('/group/create/', {"groupname": "party"}, format='json')
+        for django_user in django_users[1:]:
+            self.client.post('/group/adduser/', {
+                "groupname": "party", "username": django_user.username
+            }, format='json')
+
+        for i in range(1, 6):
+            response = self.client.post('/group/addbill/', {
+                "groupname": "party",
+                "title": "bill%s" % i,
+                "amount": 100,
+                "split_type": "equal",
+                "split_data": {},
+                "pay_data": {"user%s" % i: 100},
+            }, format='json')
+            self.assertEqual(response.status_code, 200)
+
+        self.user = django_users[0].user
+        self.group = splitAppModels.Group.objects.get(name="party")
+
+    def test_group_balance_query_count(self):
+        with self.assertNumQueries(1):
+            owe_map = helpers.compute_group_user_balance(self.user, self.group)
+        # amounts are in paise
+        self.assertEqual(owe_map, {
+            "user1": -1667, "user2": -1667, "user3": -1667,
+            "user4": -1667, "user5": -1667,
+        })
+
+    def test_simplified_group_balance_query_count(self):
+        self.group.simplify_payments = True
+        self.group.save()
+        with self.assertNumQueries(1):
+            owe_map = helpers.compute_group_user_balance(self.user, self.group)
+        # plan of the group is cached for every member
+        other_user = splitAppModels.User.objects.select_related('user').get(
+            user__username="user1"
+        )
+        with self.assertNumQueries(0):
+            helpers.compute_group_user_balance(other_user, self.group)
+        # user0 paid for nothing so owes everyone it is matched with
+        self.assertTrue(owe_map)
+        self.assertTrue(all(balance < 0 for balance in owe_map.values()))
+
+    def test_overall_balance_query_count(self):
+        with self.assertNumQueries(1):
+            owe_map = helpers.compute_overall_user_balance(self.user)
+        self.assertEqual(len(owe_map["INR"]), 5)
+
+
+class SmallGroupMixin:
+    """
+    group of three members with one bill paid by user1
+    """
+    def setUp(self):
+        # ids are reused once a test rolls back
+        cache.clear()
+        splitAppCache.clear_resolution_cache()
+        self.client = APIClient()
+        django_users = [
+            DjangoUser.objects.create(username="user%s" % i, email="user%s@test.com" % i)
+            for i in range(3)
+        ]
+        self.client.force_authenticate(user=django_users[0])
+        self.client.post('/group/create/', {"groupname": "party"}, format='json')
+        for django_user in django_users[1:]:
+            self.client.post('/group/adduser/', {
+                "groupname": "party", "username": django_user.username
+            }, format='json')
+        response = self.client.post('/group/addbill/', {
+            "groupname": "party",
+            "title": "dinner",
+            "amount": 90,
+            "split_type": "equal",
+            "split_data": {},
+            "pay_data": {"user1": 90},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.group = splitAppModels.Group.objects.get(name="party")
+        self.user = django_users[2].user
+
+
+class SharedCacheTest(SmallGroupMixin, TestCase):
+    """
+    balances cached by the web process should be invalidated by
+    ledger writes made in other processes, eg run_settle_worker
+    """
+    def in_other_process(self, func, *args):
+        process = multiprocessing.get_context('fork').Process(target=func, args=args)
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+    def test_user_balance_invalidated(self):
+        self.assertEqual(
+            self.client.get('/user/balance/').json(), {"INR": {"user1": -30.0}}
+        )
+
+        # what a settle in the worker process leaves behind
+        splitAppModels.PairBalance.objects.update(amount=0)
+        self.in_other_process(
+            splitAppCache.bump_user_balance_versions,
+            list(splitAppModels.User.objects.values_list('id', flat=True))
+        )
+        self.assertEqual(self.client.get('/user/balance/').json(), {})
+
+    def test_settlement_plan_invalidated(self):
+        self.group.simplify_payments = True
+        self.group.save()
+        self.assertEqual(
+            helpers.compute_group_user_balance(self.user, self.group), {"user1": -3000}
+        )
+
+        splitAppModels.GroupBalance.objects.update(amount=0)
+        self.in_other_process(
+            splitAppCache.bump_group_ledger_versions, [self.group.id]
+        )
+        self.assertEqual(helpers.compute_group_user_balance(self.user, self.group), {})
+
+
+class CacheStatsTest(SmallGroupMixin, TestCase):
+    """
+    cached reads should count their hits and misses per type
+    """
+    def setUp(self):
+        super().setUp()
+        splitAppCache.reset_stats()
+
+    def test_user_balance(self):
+        for _ in range(3):
+            self.client.get('/user/balance/')
+        self.assertEqual(
+            splitAppCache.get_stats()['user_balance'], {'hits': 2, 'misses': 1}
+        )
+        splitAppCache.bump_user_balance_versions([self.user.id])
+        splitAppCache.get_overall_user_balance(
+            self.user, helpers.compute_overall_user_balance
+        )
+        self.assertEqual(
+            splitAppCache.get_stats()['user_balance'], {'hits': 2, 'misses': 2}
+        )
+
+    def test_settlement_plan(self):
+        self.group.simplify_payments = True
+        self.group.save()
+        for _ in range(2):
+            helpers.compute_group_user_balance(self.user, self.group)
+        splitAppCache.bump_group_ledger_versions([self.group.id])
+        helpers.compute_group_user_balance(self.user, self.group)
+        self.assertEqual(
+            splitAppCache.get_stats()['settlement_plan'], {'hits': 1, 'misses': 2}
+        )
+
+    def test_resolution(self):
+        splitAppCache.clear_resolution_cache()
+        for _ in range(2):
+            helpers.get_group_by_name("party")
+        self.assertEqual(
+            splitAppCache.get_stats()['resolution'], {'hits': 1, 'misses': 1}
+        )
+        splitAppCache.reset_stats()
+        self.assertEqual(splitAppCache.get_stats(), {})
+
+
+class EditBillTest(SmallGroupMixin, TestCase):
+    """
+    editing a bill should only write what changed, report the
+    change and keep the balance ledgers matching the raw rows
+    """
+    def setUp(self):
+        super().setUp()
+        self.bill = splitAppModels.Bill.objects.get(title="dinner")
+        self.profiles = {
+            user.name: user for user in splitAppModels.User.objects.all()
+        }
+
+    def edit_bill(self, amount, split_type, split_data, pay_data):
+        response = self.client.post('/group/editbill/', {
+            "bill_id": self.bill.id, "title": "dinner", "amount": amount,
+            "split_type": split_type, "split_data": split_data, "pay_data": pay_data,
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        call_command('rebuild_balances', check=True, stdout=io.StringIO())
+        content = response.json()
+        return content["balance_delta"], sorted(
+            (payment["from"], payment["to"], payment["amount"])
+            for payment in content["payment_delta"]
+        )
+
+    def member_balances(self):
+        return dict(splitAppModels.GroupBalance.objects.filter(
+            group=self.group
+        ).values_list('user__name', 'amount'))
+
+    def pair_balance(self, username, other_username):
+        """
+        amount other_username owes username
+        """
+        user_id = self.profiles[username].id
+        other_id = self.profiles[other_username].id
+        pair_balance = splitAppModels.PairBalance.objects.get(
+            group=self.group, user_a_id=min(user_id, other_id),
+            user_b_id=max(user_id, other_id)
+        )
+        return pair_balance.amount if user_id < other_id else -1*pair_balance.amount
+
+    def test_amounts_only(self):
+        expense_ids = set(splitAppModels.Expense.objects.values_list('id', flat=True))
+        balance_delta, payment_delta = self.edit_bill(
+            120, "equal", {}, {"user1": 120}
+        )
+        self.assertEqual(balance_delta, {"user0": -10.0, "user1": 20.0, "user2": -10.0})
+        self.assertEqual(payment_delta, [
+            ("user0", "user1", 10.0), ("user2", "user1", 10.0)
+        ])
+        # rows are updated in place
+        self.assertEqual(
+            set(splitAppModels.Expense.objects.values_list('id', flat=True)), expense_ids
+        )
+        self.assertEqual(
+            self.member_balances(), {"user0": -4000, "user1": 8000, "user2": -4000}
+        )
+        self.assertEqual(self.pair_balance("user1", "user2"), 4000)
+
+    def test_member_removed(self):
+        balance_delta, payment_delta = self.edit_bill(
+            90, "fixed", {"user0": 45, "user1": 45}, {"user1": 90}
+        )
+        self.assertEqual(balance_delta, {"user0": -15.0, "user1": -15.0, "user2": 30.0})
+        self.assertEqual(payment_delta, [
+            ("user0", "user1", 15.0), ("user2", "user1", -30.0)
+        ])
+        self.assertFalse(splitAppModels.Expense.objects.filter(
+            user=self.profiles["user2"]
+        ).exists())
+        self.assertFalse(splitAppModels.Payment.objects.filter(
+            payer=self.profiles["user2"]
+        ).exists())
+        self.assertEqual(self.pair_balance("user1", "user2"), 0)
+        self.assertEqual(
+            self.member_balances(), {"user0": -4500, "user1": 4500, "user2": 0}
+        )
+
+    def test_payer_becomes_debtor(self):
+        balance_delta, payment_delta = self.edit_bill(
+            90, "equal", {}, {"user0": 90}
+        )
+        self.assertEqual(balance_delta, {"user0": 90.0, "user1": -90.0})
+        self.assertEqual(payment_delta, [
+            ("user0", "user1", -30.0), ("user1", "user0", 30.0),
+            ("user2", "user0", 30.0), ("user2", "user1", -30.0),
+        ])
+        self.assertEqual(self.pair_balance("user0", "user1"), 3000)
+        self.assertEqual(self.pair_balance("user0", "user2"), 3000)
+        self.assertEqual(self.pair_balance("user1", "user2"), 0)
+        self.assertEqual(
+            self.member_balances(), {"user0": 6000, "user1": -3000, "user2": -3000}
+        )
+
+
+class LedgerMaintenanceTest(SmallGroupMixin, TestCase):
+    """
+    PairBalance/GroupBalance should follow every write to expenses
+    and payments, and rebuild_balances --check should catch drift
+    """
+    def check_balances(self):
+        call_command('rebuild_balances', check=True, stdout=io.StringIO())
+
+    def member_balances(self):
+        return dict(splitAppModels.GroupBalance.objects.filter(
+            group=self.group
+        ).values_list('user__name', 'amount'))
+
+    def test_add(self):
+        self.check_balances()
+        self.assertEqual(
+            self.member_balances(), {"user0": -3000, "user1": 6000, "user2": -3000}
+        )
+        self.assertEqual(splitAppModels.PairBalance.objects.filter(
+            group=self.group
+        ).exclude(amount=0).count(), 2)
+
+    def test_edit_and_delete(self):
+        bill = splitAppModels.Bill.objects.get(title="dinner")
+        response = self.client.post('/group/editbill/', {
+            "bill_id": bill.id, "title": "dinner", "amount": 90,
+            "split_type": "fixed", "split_data": {"user0": 90}, "pay_data": {"user1": 90},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        # user2 rows are deleted, user1 only pays now
+        self.assertEqual(splitAppModels.Expense.original_objects.filter(
+            bill=bill, is_deleted=True
+        ).count(), 1)
+        self.check_balances()
+        self.assertEqual(
+            self.member_balances(), {"user0": -9000, "user1": 9000, "user2": 0}
+        )
+
+    def test_settle(self):
+        response = self.client.post('/group/settle/', {
+            "groupname": "party", "username": "user1"
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.check_balances()
+        self.assertEqual(
+            self.member_balances(), {"user0": 0, "user1": 3000, "user2": -3000}
+        )
+
+    def test_group_locked_before_bill_insert(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/group/addbill/', {
+                "groupname": "party", "title": "lunch", "amount": 30,
+                "split_type": "equal", "split_data": {}, "pay_data": {"user0": 30},
+            }, format='json')
+        self.assertEqual(response.status_code, 200)
+        statements = [query['sql'] for query in context.captured_queries]
+        group_lock = next(
+            index for index, sql in enumerate(statements)
+            if sql.startswith('SELECT') and 'FROM "splitApp_group" WHERE' in sql
+        )
+        bill_insert = next(
+            index for index, sql in enumerate(statements)
+            if sql.startswith('INSERT INTO "splitApp_bill"')
+        )
+        self.assertLess(group_lock, bill_insert)
+
+    def test_rebuild_locks_groups_first(self):
+        with CaptureQueriesContext(connection) as context:
+            call_command('rebuild_balances', stdout=io.StringIO())
+        statements = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT')
+        ]
+        self.assertIn('FROM "splitApp_group"', statements[0])
+        raw_reads = [
+            index for index, sql in enumerate(statements)
+            if 'FROM "splitApp_payment"' in sql or 'FROM "splitApp_expense"' in sql
+        ]
+        ledger_reads = [
+            index for index, sql in enumerate(statements)
+            if 'FROM "splitApp_pairbalance"' in sql or 'FROM "splitApp_groupbalance"' in sql
+        ]
+        self.assertLess(max(ledger_reads), min(raw_reads))
+        self.check_balances()
+
+    def test_check_detects_drift(self):
+        splitAppModels.PairBalance.objects.filter(
+            group=self.group
+        ).update(amount=F('amount')+1)
+        stdout = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('rebuild_balances', check=True, stdout=stdout)
+        self.assertIn('pair (group, user_a, user_b)', stdout.getvalue())
+
+        call_command('rebuild_balances', stdout=io.StringIO())
+        self.check_balances()
+
+        splitAppModels.GroupBalance.objects.filter(
+            group=self.group, user=self.user
+        ).update(amount=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_balances', check=True, stdout=io.StringIO())
+
+    def test_admin_read_only(self):
+        request = APIRequestFactory().get('/admin/')
+        request.user = DjangoUser.objects.create_superuser(username="admin")
+        for model in (
+            splitAppModels.Expense, splitAppModels.Payment,
+            splitAppModels.PairBalance, splitAppModels.GroupBalance
+        ):
+            model_admin = admin_site._registry[model]
+            self.assertFalse(model_admin.has_add_permission(request))
+            self.assertFalse(model_admin.has_change_permission(request))
+            self.assertFalse(model_admin.has_delete_permission(request))
+            self.assertTrue(model_admin.has_view_permission(request))
+
+
+@override_settings(CURRENCY_MINOR_UNITS={'INR': 2, 'USD': 2, 'JPY': 0, 'KWD': 3})
+class MinorUnitTest(SimpleTestCase):
+    """
+    amounts are integer minor units inside, floats in major
+    units at the API
+    """
+    def test_to_minor_units(self):
+        self.assertEqual(helpers.to_minor_units(10.5, 'INR'), 1050)
+        self.assertEqual(helpers.to_minor_units(0.1+0.2, 'USD'), 30)
+        # half up on the decimal value, not on the binary float
+        self.assertEqual(helpers.to_minor_units(2.675, 'INR'), 268)
+        self.assertEqual(helpers.to_minor_units(0.005, 'INR'), 1)
+        self.assertEqual(helpers.to_minor_units(0.004, 'INR'), 0)
+        self.assertEqual(helpers.to_minor_units(-0.005, 'INR'), -1)
+        self.assertEqual(helpers.to_minor_units(100.5, 'JPY'), 101)
+        self.assertEqual(helpers.to_minor_units(1.2345, 'KWD'), 1235)
+
+    def test_to_major_units(self):
+        self.assertEqual(helpers.to_major_units(1050, 'INR'), 10.5)
+        self.assertEqual(helpers.to_major_units(-1, 'INR'), -0.01)
+        self.assertEqual(helpers.to_major_units(101, 'JPY'), 101.0)
+        self.assertEqual(helpers.to_major_units(1235, 'KWD'), 1.235)
+        for amount in range(-1000, 1000, 7):
+            self.assertEqual(
+                helpers.to_minor_units(helpers.to_major_units(amount, 'INR'), 'INR'),
+                amount
+            )
+
+    def test_percentage_remainder(self):
+        roster = helpers.GroupRoster(None, {"a": "A", "b": "B", "c": "C"})
+        # floors are 33 each, the unit left goes to the largest fraction
+        self.assertEqual(helpers.compute_expense(
+            100, "percentage", {"a": 33.33, "b": 33.33, "c": 33.34}, {"a": 100}, roster
+        ), {"A": [100, 33], "B": [0, 33], "C": [0, 34]})
+        # equal fractions keep the split_data order
+        self.assertEqual(helpers.compute_expense(
+            101, "percentage", {"b": 50, "a": 50}, {"a": 101}, roster
+        ), {"A": [101, 50], "B": [0, 51]})
+        expense_data = helpers.compute_expense(
+            1001, "percentage", {"a": 20, "b": 30, "c": 50}, {"a": 1001}, roster
+        )
+        self.assertEqual(sum(owed for _, owed in expense_data.values()), 1001)
+
+
+class MinorUnitApiTest(SmallGroupMixin, TestCase):
+    """
+    bill amounts sent as floats are stored in minor units and
+    read back as floats
+    """
+    def test_bill_round_trip(self):
+        response = self.client.post('/group/addbill/', {
+            "groupname": "party",
+            "title": "snacks",
+            "amount": 10.01,
+            "split_type": "fixed",
+            "split_data": {"user0": 3.335, "user2": 6.674},
+            "pay_data": {"user0": 10.01},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        bill = splitAppModels.Bill.objects.get(title="snacks")
+        self.assertEqual(bill.bill_amount, 1001)
+        self.assertEqual(
+            dict(splitAppModels.Expense.objects.filter(
+                bill=bill
+            ).values_list('user__name', 'amount_owed')),
+            {"user0": 334, "user2": 667}
+        )
+
+        response = self.client.generic(
+            'GET', '/group/balance/', json.dumps({"groupname": "party"}),
+            content_type='application/json'
+        )
+        # user0 owes user1 30 for dinner, user2 owes user0 6.67
+        self.assertEqual(response.json(), {"user1": -30.0, "user2": 6.67})
+
+
+class AccessPathTest(SmallGroupMixin, TestCase):
+    """
+    hot queries should use the composite indexes and
+    only one live membership per user and group is allowed
+    """
+    def test_hot_queries_use_indexes(self):
+        out = io.StringIO()
+        call_command('check_query_plans', stdout=out)
+        self.assertNotIn('full scan', out.getvalue())
+        # queries come from running the helpers themselves
+        for label in (
+            'bill roster query 1', 'overall balance query 1',
+            'bill history page query 4', 'bill history next page query 1',
+        ):
+            self.assertIn('%s: ok' % label, out.getvalue())
+
+    def test_unique_live_membership(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            splitAppModels.Membership.objects.create(user=self.user, group=self.group)
+
+        # deleted memberships do not block adding the member again
+        splitAppModels.Membership.objects.filter(
+            user=self.user, group=self.group
+        ).delete()
+        splitAppModels.Membership.objects.create(user=self.user, group=self.group)
+        self.assertEqual(splitAppModels.Membership.original_objects.filter(
+            user=self.user, group=self.group
+        ).count(), 2)
+
+
+class QueryPlanParserTest(SimpleTestCase):
+    """
+    full scans found in canned EXPLAIN output of the
+    production databases
+    """
+    def test_mysql(self):
+        plan = json.dumps({"query_block": {"select_id": 1, "nested_loop": [
+            {"table": {
+                "table_name": "splitApp_membership", "access_type": "ref",
+                "key": "splitApp_me_group_i_9a1f2e_idx",
+            }},
+            {"table": {
+                "table_name": "splitApp_expense", "access_type": "ALL",
+                "rows_examined_per_scan": 1200,
+            }},
+        ]}})
+        self.assertEqual(
+            check_query_plans.plan_full_scans('mysql', plan), ['splitApp_expense']
+        )
+        plan = json.dumps({"query_block": {"select_id": 1, "table": {
+            "table_name": "splitApp_pairbalance", "access_type": "index_merge",
+            "key": "union(splitApp_pa_user_a_idx,splitApp_pa_user_b_idx)",
+        }}})
+        self.assertEqual(check_query_plans.plan_full_scans('mysql', plan), [])
+
+    def test_postgresql(self):
+        plan = "\n".join([
+            'Hash Join  (cost=1.07..2.21 rows=3 width=53)',
+            '  Hash Cond: (U0."group_id" = "splitApp_group"."id")',
+            '  ->  Seq Scan on "splitApp_payment"  (cost=0.00..1.10 rows=10 width=45)',
+            '  ->  Index Scan using "splitApp_group_pkey" on "splitApp_group"'
+            '  (cost=0.15..8.17 rows=1 width=8)',
+            '  ->  Bitmap Heap Scan on "splitApp_expense"  (cost=4.18..12.64 rows=4 width=45)',
+            '        ->  Bitmap Index Scan on "splitApp_ex_user_id_8c0d1e_idx"',
+            '  ->  Parallel Seq Scan on settlejob  (cost=0.00..1.01 rows=1 width=8)',
+        ])
+        self.assertEqual(
+            check_query_plans.plan_full_scans('postgresql', plan),
+            ['splitApp_payment', 'settlejob']
+        )
+
+    def test_sqlite(self):
+        plan = "\n".join([
+            '3 0 0 SEARCH TABLE splitApp_membership USING INDEX splitApp_me_group_i_idx (group_id=?)',
+            '7 0 0 SCAN TABLE splitApp_bill',
+            '9 0 0 SCAN splitApp_expense USING COVERING INDEX splitApp_ex_group_idx',
+        ])
+        self.assertEqual(
+            check_query_plans.plan_full_scans('sqlite', plan), ['splitApp_bill']
+        )
+
+    def test_unsupported_vendor(self):
+        with self.assertRaises(CommandError):
+            check_query_plans.plan_full_scans('oracle', '')
+
+
+class ArchiveDeletedRowsTest(SmallGroupMixin, TestCase):
+    """
+    soft delete is a single UPDATE and old deleted rows
+    move to the archive tables
+    """
+    def test_archive_deleted_rows(self):
+        expenses = splitAppModels.Expense.objects.filter(group=self.group)
+        expense_ids = sorted(expenses.values_list('id', flat=True))
+        with self.assertNumQueries(1):
+            expenses.delete()
+        self.assertEqual(splitAppModels.Expense.objects.count(), 0)
+
+        # recently deleted rows stay in the hot table
+        call_command('archive_deleted_rows', days=30, stdout=io.StringIO())
+        self.assertEqual(splitAppModels.Expense.original_objects.count(), 3)
+
+        splitAppModels.Expense.original_objects.update(
+            deleted_on=timezone.now() - datetime.timedelta(days=31)
+        )
+        call_command('archive_deleted_rows', days=30, batch_size=2, stdout=io.StringIO())
+        self.assertEqual(splitAppModels.Expense.original_objects.count(), 0)
+        archived = splitAppModels.Expense.original_objects.archived()
+        self.assertEqual(
+            sorted(archived.values_list('id', flat=True)), expense_ids
+        )
+        self.assertEqual(
+            sum(archived.values_list('amount_paid', flat=True)), 9000
+        )
+        self.assertEqual(splitAppModels.Payment.original_objects.count(), 2)
+
+
+class BalanceCheckpointTest(SmallGroupMixin, TestCase):
+    """
+    balances as of a date read from checkpoints should match
+    a full replay of the payments
+    """
+    def add_bill(self, amount, payer):
+        response = self.client.post('/group/addbill/', {
+            "groupname": "party",
+            "title": "bill",
+            "amount": amount,
+            "split_type": "equal",
+            "split_data": {},
+            "pay_data": {payer: amount},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        return splitAppModels.Bill.objects.latest('id')
+
+    def test_balance_as_of(self):
+        before = timezone.now() - datetime.timedelta(days=1)
+        self.assertEqual(
+            helpers.compute_group_user_balance_as_of(self.user, self.group, before), {}
+        )
+        now = timezone.now()
+        self.assertEqual(
+            helpers.compute_group_user_balance_as_of(self.user, self.group, now),
+            helpers.compute_group_user_balance(self.user, self.group)
+        )
+
+    def test_incremental_checkpoints(self):
+        first = helpers.create_balance_checkpoint(self.group, timezone.now())
+        self.add_bill(30, "user2")
+        second = helpers.create_balance_checkpoint(self.group, timezone.now())
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(
+            helpers.compute_pair_balances_as_of(self.group, second.cutoff),
+            helpers.compute_pair_balances_between(self.group, None, second.cutoff)
+        )
+        self.assertEqual(
+            helpers.compute_group_user_balance_as_of(self.user, self.group, timezone.now()),
+            {"user0": 1000, "user1": -2000}
+        )
+
+    def test_checkpoint_command(self):
+        call_command('checkpoint_balances', lag=0, min_payments=1, stdout=io.StringIO())
+        call_command('checkpoint_balances', lag=0, min_payments=1, stdout=io.StringIO())
+        self.assertEqual(splitAppModels.BalanceCheckpoint.objects.count(), 1)
+        self.assertEqual(
+            helpers.compute_group_user_balance_as_of(self.user, self.group, timezone.now()),
+            {"user1": -3000}
+        )
+
+    def test_edit_invalidates_checkpoints(self):
+        bill = splitAppModels.Bill.objects.get(title="dinner")
+        helpers.create_balance_checkpoint(self.group, timezone.now())
+        response = self.client.post('/group/editbill/', {
+            "bill_id": bill.id,
+            "title": "dinner",
+            "amount": 90,
+            "split_type": "equal",
+            "split_data": {},
+            "pay_data": {"user2": 90},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(splitAppModels.BalanceCheckpoint.objects.exists())
+        self.assertEqual(
+            helpers.compute_group_user_balance_as_of(self.user, self.group, timezone.now()),
+            {"user0": 3000, "user1": 3000}
+        )
+
+
+class BillHistoryTest(SmallGroupMixin, TestCase):
+    """
+    bill history pages should cost the same number of
+    queries however deep they are and however many bills they hold
+    """
+    def setUp(self):
+        super().setUp()
+        for i in range(6):
+            self.client.post('/group/addbill/', {
+                "groupname": "party",
+                "title": "bill%s" % i,
+                "amount": 30,
+                "split_type": "equal",
+                "split_data": {},
+                "pay_data": {"user%s" % (i % 3): 30},
+            }, format='json')
+        bill = splitAppModels.Bill.objects.get(title="bill5")
+        splitAppModels.Note.objects.create(bill=bill, text="cash")
+
+    def test_pagination(self):
+        bill_ids, cursor, pages = [], None, 0
+        while True:
+            with self.assertNumQueries(4):
+                bills, cursor = helpers.get_bill_history_page(self.group, cursor, 3)
+                rows = [helpers.bill_history_row(bill, "INR") for bill in bills]
+            bill_ids += [row["id"] for row in rows]
+            pages += 1
+            if cursor is None:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(bill_ids, list(
+            splitAppModels.Bill.objects.order_by('-created_on', '-id').values_list(
+                'id', flat=True
+            )
+        ))
+
+    def test_group_bills_view(self):
+        response = self.client.get('/group/bills/', {"groupname": "party", "limit": 1})
+        self.assertEqual(response.status_code, 200)
+        row = response.json()["bills"][0]
+        self.assertEqual(row["title"], "bill5")
+        self.assertEqual(row["amount"], 30.0)
+        self.assertEqual(row["notes"][0]["text"], "cash")
+        self.assertEqual(len(row["expenses"]), 3)
+        self.assertEqual(len(row["payments"]), 2)
+
+        response = self.client.get('/group/bills/', {
+            "groupname": "party", "cursor": response.json()["next_cursor"]
+        })
+        self.assertEqual(
+            [row["title"] for row in response.json()["bills"]],
+            ["bill4", "bill3", "bill2", "bill1", "bill0", "dinner"]
+        )
+        self.assertIsNone(response.json()["next_cursor"])
+
+        response = self.client.get('/group/bills/', {
+            "groupname": "party", "cursor": "bad"
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+class LedgerExportTest(SmallGroupMixin, TestCase):
+    """
+    ledger exports should hold every row of the group,
+    read in bounded batches
+    """
+    def test_export_formats(self):
+        rows = list(splitAppExport.iter_ledger_rows(self.group, batch_size=1))
+        self.assertEqual(
+            [row["record"] for row in rows],
+            ["bill", "expense", "expense", "expense", "payment", "payment"]
+        )
+        self.assertEqual(rows[0]["amount"], "90.00")
+
+        ndjson = b"".join(splitAppExport.iter_group_export(self.group, "ndjson"))
+        self.assertEqual(
+            [json.loads(line) for line in ndjson.decode().splitlines()], rows
+        )
+        csv_lines = gzip.decompress(b"".join(
+            splitAppExport.iter_group_export(self.group, "csv", compress=True)
+        )).decode().splitlines()
+        self.assertEqual(len(csv_lines), 7)
+        self.assertTrue(csv_lines[0].startswith("record,id,bill_id"))
+
+    def test_export_view(self):
+        response = self.client.get('/group/export/', {
+            "groupname": "party", "export_format": "csv", "gzip": "1"
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        content = gzip.decompress(b"".join(response.streaming_content)).decode()
+        self.assertEqual(len(content.splitlines()), 7)
+
+        response = self.client.get('/group/export/', {
+            "groupname": "party", "export_format": "xml"
+        })
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_command(self):
+        output = tempfile.NamedTemporaryFile(suffix='.ndjson')
+        call_command('export_ledger', 'party', output=output.name)
+        with open(output.name) as export_file:
+            self.assertEqual(len(export_file.readlines()), 6)
+
+
+@override_settings(BILL_IMPORT_BATCH_SIZE=2)
+class BillImportTest(SmallGroupMixin, TestCase):
+    """
+    bulk imported bills should land in the ledgers like
+    bills added one by one, skipping invalid rows
+    """
+    def bill_row(self, amount, payer, split_data=None):
+        return json.dumps({
+            "title": "imported", "amount": amount, "split_type": "equal",
+            "split_data": split_data or {}, "pay_data": {payer: amount},
+        })
+
+    def test_import_view(self):
+        lines = [self.bill_row(30, "user%s" % (i % 3)) for i in range(5)] + [
+            "{not json", self.bill_row(30, "stranger"),
+        ]
+        bills_file = SimpleUploadedFile(
+            'bills.ndjson', "\n".join(lines).encode(), 'application/x-ndjson'
+        )
+        response = self.client.post('/group/importbills/', {
+            "groupname": "party", "file": bills_file
+        }, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["imported"], 5)
+        self.assertEqual(response.json()["failed"], 2)
+        self.assertEqual(
+            [error["row"] for error in response.json()["errors"]], [6, 7]
+        )
+        self.assertEqual(
+            splitAppModels.Bill.objects.filter(title="imported").count(), 5
+        )
+        self.assertEqual(
+            splitAppModels.SettleJob.objects.filter(
+                status=splitAppModels.SettleJob.PENDING
+            ).values('user').distinct().count(), 3
+        )
+        call_command('rebuild_balances', check=True, stdout=io.StringIO())
+
+    def test_import_command(self):
+        csv_file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        csv_file.write("title,amount,split_type,split_data,pay_data\n")
+        csv_file.write('taxi,60,fixed,"{""user0"": 60}","{""user2"": 60}"\n')
+        csv_file.write('bus,10,percentage,"{""user0"": 50, ""user1"": 50}","{""user2"": 10}"\n')
+        csv_file.close()
+
+        out = io.StringIO()
+        call_command('import_bills', 'party', csv_file.name, username='user0', stdout=out)
+        self.assertIn('Imported 2 bills, 0 rows failed', out.getvalue())
+        self.assertEqual(
+            helpers.compute_group_user_balance(self.user, self.group),
+            {"user0": 6500, "user1": -2500}
+        )
+        call_command('rebuild_balances', check=True, stdout=io.StringIO())
+
+    def test_bill_batch_ids(self):
+        roster = helpers.GroupRoster.load(self.group)
+        batches = {}
+        for size in (2, 6):
+            batches[size] = [
+                splitAppImporter.parse_bill_row({
+                    "title": "bill%s_%s" % (size, i), "amount": 10*(i+1),
+                    "split_type": "equal", "split_data": {},
+                    "pay_data": {"user%s" % (i % 3): 10*(i+1)},
+                }, roster)
+                for i in range(size)
+            ]
+
+        # bills are inserted together whatever the batch size,
+        # with their ids set when the backend does not return them
+        queries = []
+        for size, batch in batches.items():
+            with CaptureQueriesContext(connection) as context:
+                splitAppImporter.write_bill_batch(self.group, self.user, batch)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+        if not connection.features.can_return_rows_from_bulk_insert:
+            # ids are read back by a key of each bill, not by position
+            self.assertEqual(len(set(splitAppModels.Bill.objects.filter(
+                title__startswith="bill6"
+            ).exclude(import_key=None).values_list('import_key', flat=True))), 6)
+
+        for bill in splitAppModels.Bill.objects.filter(title__startswith="bill"):
+            self.assertEqual(splitAppModels.Expense.objects.filter(
+                bill=bill
+            ).aggregate(owed=Sum('amount_owed'))['owed'], bill.bill_amount)
+            self.assertEqual(
+                list(splitAppModels.Expense.objects.filter(
+                    bill=bill, amount_paid__gt=0
+                ).values_list('amount_paid', flat=True)),
+                [bill.bill_amount]
+            )
+        call_command('rebuild_balances', check=True, stdout=io.StringIO())
+
+
+class BillWriteQueryCountTest(TestCase):
+    """
+    writing a bill should cost the same number of
+    queries however many members the group has
+    """
+    def setUp(self):
+        cache.clear()
+        splitAppCache.clear_resolution_cache()
+        self.owner = DjangoUser.objects.create(username="owner")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.owner)
+
+    def create_group(self, name, members_count):
+        self.client.post('/group/create/', {"groupname": name}, format='json')
+        group_obj = splitAppModels.Group.objects.get(name=name)
+        for i in range(members_count-1):
+            django_user = DjangoUser.objects.create(username="%s%s" % (name, i))
+            splitAppModels.Membership.objects.create(
+                user=django_user.user, group=group_obj
+            )
+
+    def bill_queries(self, name, path, data):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(path, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_add_and_edit_bill(self):
+        query_counts = []
+        for name, members_count in (("small", 3), ("large", 60)):
+            self.create_group(name, members_count)
+            bill = {
+                "groupname": name, "title": "pizza", "amount": 100,
+                "split_type": "equal", "split_data": {},
+                "pay_data": {"owner": 100},
+            }
+            add_queries = self.bill_queries(name, '/group/addbill/', bill)
+            bill_obj = splitAppModels.Bill.objects.get(group__name=name)
+            bill.update(bill_id=bill_obj.id, amount=120, pay_data={"owner": 120})
+            edit_queries = self.bill_queries(name, '/group/editbill/', bill)
+            query_counts.append((add_queries, edit_queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_sparse_split(self):
+        self.create_group("large", 60)
+        group_obj = splitAppModels.Group.objects.get(name="large")
+        usernames = helpers.bill_usernames("fixed", {"large0": 50}, {"owner": 50})
+        roster = helpers.GroupRoster.load(group_obj, usernames)
+        self.assertEqual((len(roster), roster.complete), (2, False))
+        with self.assertRaises(ValueError):
+            helpers.compute_expense(50, "equal", {}, {"owner": 50}, roster)
+
+        response = self.client.post('/group/addbill/', {
+            "groupname": "large", "title": "taxi", "amount": 50,
+            "split_type": "fixed", "split_data": {"large0": 50},
+            "pay_data": {"owner": 50},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(splitAppModels.Expense.objects.count(), 2)
+        self.assertEqual(splitAppModels.SettleJob.objects.count(), 2)
+
+
+class ResolutionCacheTest(SmallGroupMixin, TestCase):
+    """
+    group, username and membership resolution should be
+    served from the LRU cache and dropped on writes
+    """
+    def test_group_resolution(self):
+        splitAppCache.clear_resolution_cache()
+        with self.assertNumQueries(1):
+            helpers.get_group_by_name("party")
+        with self.assertNumQueries(0):
+            group_obj = helpers.get_group_by_name("party")
+        self.assertEqual(
+            (group_obj.id, group_obj.created_by_id),
+            (self.group.id, self.group.created_by_id)
+        )
+
+        self.group.name = "trip"
+        self.group.save()
+        with self.assertRaises(splitAppModels.Group.DoesNotExist):
+            helpers.get_group_by_name("party")
+        self.assertEqual(helpers.get_group_by_name("trip").id, self.group.id)
+
+        # unknown names are cached too until the group is created
+        with self.assertRaises(splitAppModels.Group.DoesNotExist):
+            helpers.get_group_by_name("party")
+        self.client.post('/group/create/', {"groupname": "party"}, format='json')
+        self.assertNotEqual(helpers.get_group_by_name("party").id, self.group.id)
+
+    def test_username_resolution(self):
+        helpers.get_user_by_username("user1")
+        with self.assertNumQueries(0):
+            user_obj = helpers.get_user_by_username("user1")
+            self.assertEqual(user_obj.user.username, "user1")
+        self.assertEqual(
+            user_obj.id, splitAppModels.User.objects.get(name="user1").id
+        )
+
+        with self.assertRaises(splitAppModels.User.DoesNotExist):
+            helpers.get_user_by_username("user3")
+        DjangoUser.objects.create(username="user3")
+        self.assertEqual(helpers.get_user_by_username("user3").user.username, "user3")
+
+    def test_membership_resolution(self):
+        user_obj = DjangoUser.objects.create(username="user3").user
+        self.assertFalse(helpers.is_group_member(self.group.id, user_obj.id))
+
+        self.client.post('/group/adduser/', {
+            "groupname": "party", "username": "user3"
+        }, format='json')
+        with self.assertNumQueries(1):
+            self.assertTrue(helpers.is_group_member(self.group.id, user_obj.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(helpers.is_group_member(self.group.id, user_obj.id))
+
+        self.client.post('/group/removeuser/', {
+            "groupname": "party", "username": "user3"
+        }, format='json')
+        self.assertFalse(helpers.is_group_member(self.group.id, user_obj.id))
+
+    def test_admin_bulk_delete(self):
+        self.assertTrue(helpers.is_group_member(self.group.id, self.user.id))
+        helpers.get_group_by_name("party")
+        admin_site._registry[splitAppModels.Membership].delete_queryset(
+            None, splitAppModels.Membership.objects.filter(user=self.user)
+        )
+        self.assertFalse(helpers.is_group_member(self.group.id, self.user.id))
+
+        admin_site._registry[splitAppModels.Group].delete_queryset(
+            None, splitAppModels.Group.objects.filter(id=self.group.id)
+        )
+        with self.assertRaises(splitAppModels.Group.DoesNotExist):
+            helpers.get_group_by_name("party")
+
+
+class AutoSettleTest(TestCase):
+    """
+    auto settle should net pair balances across groups of the
+    same currency and leave overall balances unchanged
+    """
+    def setUp(self):
+        cache.clear()
+        splitAppCache.clear_resolution_cache()
+        self.client = APIClient()
+        self.django_users = {
+            username: DjangoUser.objects.create(username=username)
+            for username in ("a", "b", "c")
+        }
+        self.users = {
+            username: django_user.user
+            for username, django_user in self.django_users.items()
+        }
+
+    def create_group(self, name, currency="INR", simplify_payments=False):
+        self.client.force_authenticate(user=self.django_users["a"])
+        self.client.post('/group/create/', {"groupname": name}, format='json')
+        for username in ("b", "c"):
+            self.client.post('/group/adduser/', {
+                "groupname": name, "username": username
+            }, format='json')
+        splitAppModels.Group.objects.filter(name=name).update(
+            default_currency=currency, simplify_payments=simplify_payments
+        )
+        splitAppCache.clear_resolution_cache()
+
+    def add_bill(self, group_name, payer, split_data):
+        amount = sum(split_data.values())
+        response = self.client.post('/group/addbill/', {
+            "groupname": group_name, "title": "bill", "amount": amount,
+            "split_type": "fixed", "split_data": split_data,
+            "pay_data": {payer: amount},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def overall_balances(self):
+        """
+        pair balances summed over groups per currency
+        """
+        balances = defaultdict(lambda:0)
+        for pair_balance in splitAppModels.PairBalance.objects.select_related('group'):
+            balances[(
+                pair_balance.user_a_id, pair_balance.user_b_id,
+                pair_balance.group.default_currency
+            )] += pair_balance.amount
+        return {key: amount for key, amount in balances.items() if amount != 0}
+
+    def group_balances(self, group_name):
+        return {
+            pair_balance.user_a.name + pair_balance.user_b.name: pair_balance.amount
+            for pair_balance in splitAppModels.PairBalance.objects.filter(
+                group__name=group_name
+            ).exclude(amount=0).select_related('user_a', 'user_b')
+        }
+
+    def auto_settle(self):
+        overall_balances = self.overall_balances()
+        helpers.auto_settle(self.users.values())
+        # settling moves balances between groups, never creates them
+        self.assertEqual(self.overall_balances(), overall_balances)
+        for group_obj in splitAppModels.Group.objects.all():
+            self.assertEqual(
+                sum(splitAppModels.GroupBalance.objects.filter(
+                    group=group_obj
+                ).values_list('amount', flat=True)), 0
+            )
+        call_command('rebuild_balances', check=True, stdout=io.StringIO())
+
+    def test_nets_across_groups(self):
+        self.create_group("trip")
+        self.create_group("party")
+        self.add_bill("trip", "a", {"b": 10})
+        self.add_bill("party", "b", {"a": 10, "c": 4})
+
+        self.auto_settle()
+        # a and b net to 0 over both groups, c only owes b
+        self.assertEqual(self.group_balances("trip"), {})
+        self.assertEqual(self.group_balances("party"), {"bc": 400})
+        self.assertEqual(
+            splitAppModels.Bill.objects.filter(title="Settle Balance").count(), 2
+        )
+
+    def test_partial_balance_not_settled(self):
+        self.create_group("trip")
+        self.create_group("party")
+        self.add_bill("trip", "a", {"b": 10})
+        self.add_bill("party", "b", {"a": 5})
+
+        self.auto_settle()
+        self.assertEqual(self.group_balances("trip"), {"ab": 1000})
+        self.assertEqual(self.group_balances("party"), {"ab": -500})
+
+    def test_currencies_do_not_net(self):
+        self.create_group("trip")
+        self.create_group("usa", currency="USD")
+        self.add_bill("trip", "a", {"b": 10})
+        self.add_bill("usa", "b", {"a": 10})
+
+        self.auto_settle()
+        self.assertFalse(
+            splitAppModels.Bill.objects.filter(title="Settle Balance").exists()
+        )
+        self.assertEqual(self.group_balances("trip"), {"ab": 1000})
+        self.assertEqual(self.group_balances("usa"), {"ab": -1000})
+        self.assertEqual(
+            helpers.compute_overall_user_balance(self.users["a"]),
+            {"INR": {"b": 10.0}, "USD": {"b": -10.0}}
+        )
+
+    def test_simplified_group(self):
+        self.create_group("trip", simplify_payments=True)
+        self.create_group("party")
+        self.add_bill("trip", "a", {"b": 10})
+        self.add_bill("party", "b", {"a": 10})
+
+        self.auto_settle()
+        self.assertEqual(
+            set(splitAppModels.GroupBalance.objects.exclude(
+                amount=0
+            ).values_list('amount', flat=True)), set()
+        )
+        self.assertEqual(self.group_balances("party"), {})
+
+
+class GroupBackfillMigrationTest(TransactionTestCase):
+    """
+    0011 should copy bill.group onto expenses and payments in
+    batches and pick up where an interrupted run stopped
+    """
+    migrate_from = ('splitApp', '0010_access_path_indexes')
+    migrate_to = ('splitApp', '0011_expense_payment_group')
+    backfill_migration = importlib.import_module(
+        'splitApp.migrations.0011_expense_payment_group'
+    )
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([target])
+        return executor.loader.project_state(target).apps
+
+    def setUp(self):
+        apps = self.migrate(self.migrate_from)
+        User = apps.get_model('splitApp', 'User')
+        Group = apps.get_model('splitApp', 'Group')
+        Bill = apps.get_model('splitApp', 'Bill')
+        Expense = apps.get_model('splitApp', 'Expense')
+        Payment = apps.get_model('splitApp', 'Payment')
+        DjangoUserModel = apps.get_model('auth', 'User')
+
+        users = [
+            User.objects.create(
+                name="user%s" % i,
+                user=DjangoUserModel.objects.create(username="user%s" % i)
+            )
+            for i in range(2)
+        ]
+        groups = [
+            Group.objects.create(name="group%s" % i, created_by=users[0])
+            for i in range(2)
+        ]
+        self.bill_groups = {}
+        for i in range(7):
+            bill = Bill.objects.create(
+                title="bill%s" % i, group=groups[i % 2],
+                added_by=users[0], bill_amount=200
+            )
+            self.bill_groups[bill.id] = bill.group_id
+            Expense.objects.create(bill=bill, user=users[0], amount_paid=200, amount_owed=100)
+            Expense.objects.create(bill=bill, user=users[1], amount_owed=100)
+            Payment.objects.create(bill=bill, payer=users[1], receiver=users[0], amount=100)
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('splitApp')[0])
+
+    def assertBackfilled(self, apps):
+        for model_name in ('Expense', 'Payment'):
+            rows = apps.get_model('splitApp', model_name).objects.values_list(
+                'bill_id', 'group_id'
+            )
+            self.assertEqual(
+                [group_id for _, group_id in rows],
+                [self.bill_groups[bill_id] for bill_id, _ in rows]
+            )
+
+    def test_backfill_in_batches(self):
+        with mock.patch.object(self.backfill_migration, 'BACKFILL_BATCH_SIZE', 4), \
+                CaptureQueriesContext(connection) as queries:
+            apps = self.migrate(self.migrate_to)
+        self.assertBackfilled(apps)
+        # one UPDATE per range of 4 ids, the 14 expenses and
+        # 7 payments span several ranges each
+        batches = 0
+        for model_name in ('Expense', 'Payment'):
+            max_id = apps.get_model('splitApp', model_name).objects.aggregate(
+                max_id=Max('id')
+            )['max_id']
+            batches += len(range(0, max_id+1, 4))
+        updates = [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('UPDATE')
+        ]
+        self.assertGreaterEqual(batches, 6)
+        self.assertEqual(len(updates), batches)
+
+        apps = self.migrate(('splitApp', '0012_group_not_null'))
+        self.assertBackfilled(apps)
+
+    def test_resume_interrupted_backfill(self):
+        apps = self.migrate(self.migrate_to)
+        Expense = apps.get_model('splitApp', 'Expense')
+        # batches after the first never committed, one row was
+        # moved to another group since and must be left alone
+        expense_ids = list(Expense.objects.order_by('id').values_list('id', flat=True))
+        Expense.objects.filter(id__gte=expense_ids[4]).update(group=None)
+        moved_expense = Expense.objects.get(id=expense_ids[0])
+        other_group_id = next(
+            group_id for group_id in self.bill_groups.values()
+            if group_id != moved_expense.group_id
+        )
+        Expense.objects.filter(id=moved_expense.id).update(group_id=other_group_id)
+
+        with mock.patch.object(self.backfill_migration, 'BACKFILL_BATCH_SIZE', 4):
+            self.backfill_migration.backfill_group('Expense')(apps, None)
+        self.assertFalse(Expense.objects.filter(group__isnull=True).exists())
+        self.assertEqual(Expense.objects.get(id=moved_expense.id).group_id, other_group_id)
+
+        Expense.objects.filter(id=moved_expense.id).update(group_id=moved_expense.group_id)
+        self.assertBackfilled(apps)
+
+
+class SettleWorkerTest(TransactionTestCase):
+    """
+    run_settle_worker should claim each job once, settle claimed
+    users together and retry failed jobs with backoff
+    """
+    logger_name = 'splitApp.management.commands.run_settle_worker'
+
+    def setUp(self):
+        self.users = [
+            DjangoUser.objects.create(username="user%s" % i).user for i in range(3)
+        ]
+        self.jobs = [splitAppModels.SettleJob.objects.create(user=user) for user in self.users]
+
+    def run_worker(self, **options):
+        call_command('run_settle_worker', once=True, stdout=io.StringIO(), **options)
+
+    def test_claim_is_conditional(self):
+        SettleJob = splitAppModels.SettleJob
+        SettleJob.objects.filter(id=self.jobs[0].id).update(
+            status=SettleJob.RUNNING, pending=None
+        )
+        SettleJob.objects.filter(id=self.jobs[1].id).update(
+            run_after=timezone.now() + datetime.timedelta(minutes=1)
+        )
+        command = run_settle_worker.Command()
+        claimed = command.claim_jobs(10)
+        self.assertEqual([job.id for job in claimed], [self.jobs[2].id])
+        self.assertEqual((claimed[0].status, claimed[0].attempts), (SettleJob.RUNNING, 1))
+        # a second worker polling finds nothing left to claim
+        self.assertEqual(command.claim_jobs(10), [])
+
+    def test_one_pending_job_per_user(self):
+        SettleJob = splitAppModels.SettleJob
+        helpers.enqueue_auto_settle(self.users + self.users[:1])
+        self.assertEqual(SettleJob.objects.count(), 3)
+        # enforced by the database, not only by enqueue_auto_settle
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SettleJob.objects.create(user=self.users[0])
+
+        # running jobs do not hold back new work for their user
+        run_settle_worker.Command().claim_jobs(1)
+        helpers.enqueue_auto_settle(self.users)
+        self.assertEqual(
+            sorted(SettleJob.objects.filter(
+                user=self.users[0]
+            ).values_list('status', flat=True)),
+            [SettleJob.PENDING, SettleJob.RUNNING]
+        )
+
+    def test_retry_behind_new_job(self):
+        SettleJob = splitAppModels.SettleJob
+        command = run_settle_worker.Command()
+        jobs = command.claim_jobs(10)
+        # a bill queues new work for user0 while the jobs run
+        helpers.enqueue_auto_settle(self.users[:1])
+        with mock.patch('splitApp.helpers.auto_settle', side_effect=RuntimeError('boom')), \
+                self.assertLogs(self.logger_name, 'ERROR'):
+            command.run_jobs(jobs, max_attempts=3, retry_delay=0)
+        self.assertEqual(
+            sorted(SettleJob.objects.values_list('user_id', 'status', 'attempts')),
+            [
+                (self.users[0].id, SettleJob.PENDING, 0),
+                (self.users[1].id, SettleJob.PENDING, 1),
+                (self.users[2].id, SettleJob.PENDING, 1),
+            ]
+        )
+
+    def test_requeue_stale_jobs(self):
+        SettleJob = splitAppModels.SettleJob
+        command = run_settle_worker.Command()
+        command.stdout = io.StringIO()
+        command.claim_jobs(10)
+        helpers.enqueue_auto_settle(self.users[:1])
+        SettleJob.objects.filter(status=SettleJob.RUNNING).update(
+            updated_on=timezone.now() - datetime.timedelta(hours=1)
+        )
+        command.requeue_stale_jobs(600)
+        self.assertEqual(
+            sorted(SettleJob.objects.values_list('user_id', 'status', 'attempts')),
+            [
+                (self.users[0].id, SettleJob.PENDING, 0),
+                (self.users[1].id, SettleJob.PENDING, 1),
+                (self.users[2].id, SettleJob.PENDING, 1),
+            ]
+        )
+
+    def test_users_settled_together(self):
+        with mock.patch('splitApp.helpers.auto_settle') as auto_settle:
+            self.run_worker(workers=1)
+        auto_settle.assert_called_once()
+        self.assertEqual(
+            set(user.id for user in auto_settle.call_args[0][0]),
+            set(user.id for user in self.users)
+        )
+        self.assertFalse(splitAppModels.SettleJob.objects.exists())
+
+    def test_retry_with_backoff(self):
+        with mock.patch('splitApp.helpers.auto_settle', side_effect=RuntimeError('boom')), \
+                self.assertLogs(self.logger_name, 'ERROR'):
+            self.run_worker(workers=1, retry_delay=30)
+        for job in splitAppModels.SettleJob.objects.all():
+            self.assertEqual(
+                (job.status, job.attempts, job.last_error),
+                (splitAppModels.SettleJob.PENDING, 1, 'boom')
+            )
+            self.assertGreater(
+                job.run_after, timezone.now() + datetime.timedelta(seconds=25)
+            )
+
+    def test_failed_after_max_attempts(self):
+        with mock.patch('splitApp.helpers.auto_settle', side_effect=RuntimeError('boom')), \
+                self.assertLogs(self.logger_name, 'ERROR') as logs:
+            self.run_worker(workers=2, retry_delay=0, max_attempts=3)
+        self.assertEqual(
+            set(splitAppModels.SettleJob.objects.values_list('status', 'attempts')),
+            {(splitAppModels.SettleJob.FAILED, 3)}
+        )
+        self.assertIn('RuntimeError: boom', logs.output[0])
+
+
+class SettlementStrategyTest(SimpleTestCase):
+    """
+    settlement plans should settle every balance exactly, optimal
+    with the fewest transfers while the group is small enough
+    """
+    # greedy needs 5 transfers, d/f and a/b/c/e settle apart in 4
+    balances = {"a": -800, "b": 600, "c": -200, "d": 300, "e": 400, "f": -300}
+
+    def assertSettles(self, balances, transfers):
+        remaining = dict(balances)
+        for debtor, creditor, amount in transfers:
+            self.assertGreater(amount, 0)
+            remaining[debtor] += amount
+            remaining[creditor] -= amount
+        self.assertEqual(set(remaining.values()) - {0}, set())
+        members_count = sum(1 for balance in balances.values() if balance != 0)
+        self.assertLessEqual(len(transfers), max(members_count-1, 0))
+
+    def test_optimal_fewest_transfers(self):
+        self.assertEqual(len(helpers.greedy_settlement(self.balances)), 5)
+        transfers = helpers.optimal_settlement(self.balances)
+        self.assertEqual(len(transfers), 4)
+        self.assertSettles(self.balances, transfers)
+        self.assertIn(("f", "d", 300), transfers)
+        with override_settings(SETTLEMENT_OPTIMAL_MAX_MEMBERS=6):
+            self.assertEqual(
+                helpers.compute_settlement_plan(self.balances, "optimal"), transfers
+            )
+
+    @override_settings(SETTLEMENT_OPTIMAL_MAX_MEMBERS=5)
+    def test_large_group_falls_back_to_greedy(self):
+        failing_optimal = mock.Mock(side_effect=AssertionError("optimal was used"))
+        with mock.patch.dict(helpers.SETTLEMENT_STRATEGIES, optimal=failing_optimal):
+            transfers = helpers.compute_settlement_plan(self.balances, "optimal")
+        self.assertEqual(transfers, helpers.greedy_settlement(self.balances))
+        # members with no balance do not count towards the limit
+        balances = {"a": -800, "b": 800, "c": 0, "d": 0, "e": 0, "f": 0}
+        self.assertEqual(
+            helpers.compute_settlement_plan(balances, "optimal"), [("a", "b", 800)]
+        )
+
+    def test_strategies_conserve_balances(self):
+        rng = random.Random(0)
+        for members_count in (0, 1, 2, 3, 7, 10, 600):
+            for _ in range(10):
+                amounts = [rng.randint(-5000, 5000) for _ in range(members_count-1)]
+                amounts.append(-1*sum(amounts))
+                balances = {
+                    "user%s" % index: amount
+                    for index, amount in enumerate(amounts[:members_count])
+                }
+                self.assertSettles(balances, helpers.greedy_settlement(balances))
+                self.assertSettles(balances, helpers.two_pointer_settlement(balances))
+                for strategy in helpers.SETTLEMENT_STRATEGIES:
+                    self.assertSettles(
+                        balances, helpers.compute_settlement_plan(balances, strategy)
+                    )
+                if members_count <= 10:
+                    self.assertSettles(balances, helpers.optimal_settlement(balances))
+
+
+@unittest.skipIf(helpers.numpy is None, "numpy not installed")
+class VectorizedSettlementTest(SimpleTestCase):
+    """
+    vectorized settlement should give exactly the scalar transfers
+    """
+    def test_matches_scalar_settlement(self):
+        rng = random.Random(0)
+        for members_count in (1, 2, 3, 10, 600):
+            for _ in range(20):
+                # repeated amounts check ties are ordered the same way
+                amounts = [
+                    rng.choice((rng.randint(-5000, 5000), -100, 100, 0))
+                    for _ in range(members_count-1)
+                ]
+                amounts.append(-1*sum(amounts))
+                balances = {
+                    "user%s" % index: amount for index, amount in enumerate(amounts)
+                }
+                with override_settings(VECTORIZED_SETTLEMENT_MIN_MEMBERS=10**9):
+                    scalar_transfers = helpers.two_pointer_settlement(balances)
+                self.assertEqual(
+                    helpers.vectorized_two_pointer_settlement(balances),
+                    scalar_transfers
+                )
+
+
+class QueryBudgetTestMixin:
+    """
+    assert requests stay within the query budget of their url,
+    see QUERY_BUDGETS in settings
+    """
+    def assertWithinQueryBudget(self, response, url_name):
+        budget = get_query_budget(url_name)
+        query_count = int(response['X-Query-Count'])
+        self.assertLessEqual(
+            query_count, budget,
+            '%s ran %s queries, budget is %s' % (url_name, query_count, budget)
+        )
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class QueryBudgetTest(QueryBudgetTestMixin, TestCase):
+    """
+    every url in famsplit/urls.py should stay within its query budget
+    """
+    def setUp(self):
+        cache.clear()
+        splitAppCache.clear_resolution_cache()
+        self.client = APIClient()
+        for i in range(5):
+            self.request('create_user', {
+                "username": "user%s" % i, "password": "root@123",
+                "email": "user%s@test.com" % i,
+            })
+        self.tokens = self.request('token_obtain_pair', {
+            "username": "user0", "password": "root@123"
+        }).json()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.tokens["access"])
+
+        self.request('create_group', {"groupname": "party"})
+        for i in range(1, 4):
+            self.request('add_member', {"groupname": "party", "username": "user%s" % i})
+        self.request('add_bill', {
+            "groupname": "party", "title": "pizza", "amount": 100,
+            "split_type": "equal", "split_data": {}, "pay_data": {"user1": 100},
+        })
+        self.bill = splitAppModels.Bill.objects.get(title="pizza")
+        # user4 joins after the bill so it has no balance
+        self.request('add_member', {"groupname": "party", "username": "user4"})
+
+    def request(self, url_name, data=None, method='post', format='json'):
+        """
+        call url_name and check it stays within its query budget
+        """
+        if method == 'get':
+            response = self.client.generic(
+                'GET', reverse(url_name), json.dumps(data or {}),
+                content_type='application/json'
+            )
+        else:
+            response = self.client.post(reverse(url_name), data or {}, format=format)
+        self.assertLess(response.status_code, 500)
+        self.assertWithinQueryBudget(response, url_name)
+        return response
+
+    def image(self):
+        image_file = io.BytesIO()
+        Image.new('RGB', (1, 1)).save(image_file, 'png')
+        return SimpleUploadedFile('icon.png', image_file.getvalue(), 'image/png')
+
+    def test_token_refresh(self):
+        self.request('token_refresh', {"refresh": self.tokens["refresh"]})
+
+    def test_group_actions(self):
+        self.request('group_balance', {"groupname": "party"}, method='get')
+        self.request('group_export', {"groupname": "party"}, method='get')
+        self.request('group_settle_balance', {"groupname": "party", "username": "user1"})
+        self.request('remove_member', {"groupname": "party", "username": "user4"})
+        self.request('group_add_picture', {
+            "groupname": "party", "image": self.image()
+        }, format='multipart')
+
+    def test_simplified_group_balance(self):
+        group_obj = splitAppModels.Group.objects.get(name="party")
+        group_obj.simplify_payments = True
+        group_obj.save()
+        self.request('group_balance', {"groupname": "party"}, method='get')
+
+    def test_bill_actions(self):
+        self.request('edit_bill', {
+            "bill_id": self.bill.id, "title": "pizza", "amount": 120,
+            "split_type": "fixed", "split_data": {"user0": 60, "user2": 60},
+            "pay_data": {"user1": 120},
+        })
+        self.request('bill_comment', {
+            "bill_id": self.bill.id, "comment": "dominos", "image": self.image()
+        }, format='multipart')
+        self.request('group_bills', {"groupname": "party"}, method='get')
+        self.request('import_bills', {
+            "groupname": "party", "file": SimpleUploadedFile(
+                'bills.ndjson', json.dumps({
+                    "title": "taxi", "amount": 30, "split_type": "equal",
+                    "split_data": {}, "pay_data": {"user2": 30},
+                }).encode()
+            )
+        }, format='multipart')
+
+    def test_user_actions(self):
+        self.request('user_balance', method='get')
+        self.request('user_balance_async', method='get')
+        self.request('group_balance_async', {"groupname": "party"}, method='get')
+        self.request('user_add_picture', {"image": self.image()}, format='multipart')
+
+
+class TokenAuthenticationTest(TestCase):
+    """
+    requests should authenticate from the token
+    claims without querying the database
+    """
+    def setUp(self):
+        cache.clear()
+        splitAppCache.clear_resolution_cache()
+        self.client = APIClient()
+        self.client.post(reverse('create_user'), {
+            "username": "user0", "password": "root@123", "email": "user0@test.com",
+        }, format='json')
+        self.django_user = DjangoUser.objects.get(username="user0")
+        self.tokens = self.client.post(reverse('token_obtain_pair'), {
+            "username": "user0", "password": "root@123"
+        }, format='json').json()
+
+    def authenticate(self, access_token):
+        request = APIRequestFactory().get(
+            '/', HTTP_AUTHORIZATION='Bearer ' + access_token
+        )
+        return ProfileJWTAuthentication().authenticate(request)[0]
+
+    def test_token_claims(self):
+        refreshed = self.client.post(reverse('token_refresh'), {
+            "refresh": self.tokens["refresh"]
+        }, format='json').json()
+        profile_id = self.django_user.user.id
+        for token in (self.tokens["access"], refreshed["access"]):
+            with self.assertNumQueries(0):
+                user = self.authenticate(token)
+                self.assertEqual(user.user.id, profile_id)
+                self.assertEqual(user.user.user.username, "user0")
+        # other fields are loaded from the database on access
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, "user0@test.com")
+            self.assertEqual(user.date_joined, self.django_user.date_joined)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.user.email, "user0@test.com")
+
+    def test_balance_without_auth_queries(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.tokens["access"])
+        self.client.post('/group/create/', {"groupname": "party"}, format='json')
+        for _ in range(2):
+            response = self.client.generic(
+                'GET', '/group/balance/', json.dumps({"groupname": "party"}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.json(), {})
+        # only the balance read itself once the group name is cached
+        self.assertEqual(response['X-Query-Count'], '1')
+
+    def test_token_without_claims(self):
+        access_token = str(RefreshToken.for_user(self.django_user).access_token)
+        with self.assertNumQueries(1):
+            user = self.authenticate(access_token)
+        self.assertEqual(user, self.django_user)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + access_token)
+        response = self.client.post('/group/create/', {"groupname": "party"}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+
+class AsyncBalanceTest(QueryBudgetTestMixin, TransactionTestCase):
+    """
+    async balance views should match the sync ones. Balances are
+    computed on worker threads with their own connections, so data
+    has to be committed
+    """
+    def setUp(self):
+        cache.clear()
+        splitAppCache.clear_resolution_cache()
+        self.client = APIClient()
+        for i in range(3):
+            self.client.post(reverse('create_user'), {
+                "username": "user%s" % i, "password": "root@123",
+                "email": "user%s@test.com" % i,
+            }, format='json')
+        self.tokens = self.client.post(reverse('token_obtain_pair'), {
+            "username": "user0", "password": "root@123"
+        }, format='json').json()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.tokens["access"])
+
+        for group_index in range(4):
+            group_name = "group%s" % group_index
+            self.client.post('/group/create/', {"groupname": group_name}, format='json')
+            for i in (1, 2):
+                self.client.post('/group/adduser/', {
+                    "groupname": group_name, "username": "user%s" % i
+                }, format='json')
+            # group3 has no bills
+            if group_index < 3:
+                self.client.post('/group/addbill/', {
+                    "groupname": group_name, "title": "dinner",
+                    "amount": 30*(group_index+1), "split_type": "equal",
+                    "split_data": {}, "pay_data": {"user%s" % group_index: 30*(group_index+1)},
+                }, format='json')
+
+    def get(self, path, data=None):
+        return self.client.generic(
+            'GET', path, json.dumps(data or {}), content_type='application/json'
+        )
+
+    def test_group_balances(self):
+        response = self.get(reverse('user_group_balances'))
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinQueryBudget(response, 'user_group_balances')
+        self.assertEqual(response.json(), {
+            "group%s" % i: self.get('/group/balance/', {"groupname": "group%s" % i}).json()
+            for i in range(4)
+        })
+        self.assertEqual(response.json()["group1"], {"user1": -20.0})
+
+        with override_settings(BALANCE_FANOUT_CONCURRENCY=1):
+            self.assertEqual(self.get(reverse('user_group_balances')).json(), response.json())
+
+    def test_async_variants(self):
+        for group_name in ("group0", "group1"):
+            self.assertEqual(
+                self.get(reverse('group_balance_async'), {"groupname": group_name}).json(),
+                self.get('/group/balance/', {"groupname": group_name}).json(),
+            )
+        # query params work as well
+        response = self.client.get(reverse('group_balance_async'), {"groupname": "group1"})
+        self.assertEqual(response.json(), {"user1": -20.0})
+        self.assertEqual(
+            self.get(reverse('group_balance_async'), {"groupname": "missing"}).status_code,
+            404
+        )
+        self.assertEqual(
+            self.get(reverse('user_balance_async')).json(),
+            self.get('/user/balance/').json(),
+        )
+
+    def test_asgi_middleware_not_adapted(self):
+        # sync only middleware would be wrapped in sync_to_async and
+        # every request would queue up on its single thread
+        with mock.patch('django.core.handlers.base.logger') as logger:
+            handler = ASGIHandler()
+        self.assertTrue(asyncio.iscoroutinefunction(handler._middleware_chain))
+        self.assertNotIn('QueryCountMiddleware', str(logger.debug.call_args_list))
+
+    async def test_asgi_query_count(self):
+        client = AsyncClient()
+        response = await client.get(
+            reverse('user_group_balances'),
+            authorization='Bearer ' + self.tokens["access"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["group1"], {"user1": -20.0})
+        # the balance reads of the worker threads are counted too
+        self.assertEqual(response['X-Query-Count'], '5')
+
+        response = await client.get(
+            reverse('group_balance_async') + '?groupname=group1',
+            authorization='Bearer ' + self.tokens["access"]
+        )
+        self.assertEqual(response.json(), {"user1": -20.0})
+        self.assertWithinQueryBudget(response, 'group_balance_async')
+
+    def test_authentication(self):
+        self.client.credentials()
+        self.assertEqual(self.get(reverse('user_group_balances')).status_code, 401)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer invalid')
+        self.assertEqual(self.get(reverse('user_balance_async')).status_code, 401)
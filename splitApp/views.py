@@ -2,13 +2,25 @@ from django.shortcuts import render
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework_simplejwt import views as jwt_views
 from django.contrib.auth.models import User as DjangoUser
 from django.contrib.auth.hashers import make_password
 from django.db import transaction
+from django.conf import settings
+from django.http import StreamingHttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from collections import defaultdict
-import threading
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+import codecs
+import json
 
 import splitApp.models as splitAppModels
+import splitApp.cache as splitAppCache
+import splitApp.export as splitAppExport
+import splitApp.importer as splitAppImporter
+import splitApp.authentication as splitAppAuthentication
 from splitApp import helpers
 
 
@@ -37,6 +49,14 @@ class CreateUserView(APIView):
             return Response({'error': str(e)}, status=400)
 
 
+class ObtainTokenPairView(jwt_views.TokenObtainPairView):
+    """
+    login with username and password, the tokens carry
+    the claims ProfileJWTAuthentication needs
+    """
+    serializer_class = splitAppAuthentication.ProfileTokenObtainPairSerializer
+
+
 class CreateGroupView(APIView):
     """
     create new group
@@ -78,7 +98,7 @@ class AddMemberToGroupView(APIView):
             username = request.data.get("username")
 
             try:
-                group_obj = splitAppModels.Group.objects.get(name=group_name)
+                group_obj = helpers.get_group_by_name(group_name)
             except:
                 return Response(
                     {'error': 'Group not found!'},
@@ -86,13 +106,13 @@ class AddMemberToGroupView(APIView):
                     )
 
             # check if request user is group creator
-            if request.user.user != group_obj.created_by:
+            if request.user.user.id != group_obj.created_by_id:
                 return Response(
                     {'error': 'Only group creator can add members'},
                     status=403
                     )
             try:
-                user_obj = splitAppModels.User.objects.get(user__username=username)
+                user_obj = helpers.get_user_by_username(username)
             except:
                 return Response(
                     {'error': 'User not found!'},
@@ -108,6 +128,7 @@ class AddMemberToGroupView(APIView):
                     {'error': 'User already present in group!'},
                     status=400
                     )
+            splitAppCache.bump_group_ledger_versions([group_obj.id])
 
             content = {'message': 'Member added successfully!'}
             return Response(content)
@@ -128,7 +149,7 @@ class RemoveMemberFromGroupView(APIView):
             username = request.data.get("username")
 
             try:
-                group_obj = splitAppModels.Group.objects.get(name=group_name)
+                group_obj = helpers.get_group_by_name(group_name)
             except:
                 return Response(
                     {'error': 'Group not found!'},
@@ -136,13 +157,13 @@ class RemoveMemberFromGroupView(APIView):
                     )
 
             # check if request user is group creator
-            if request.user.user != group_obj.created_by:
+            if request.user.user.id != group_obj.created_by_id:
                 return Response(
                     {'error': 'Only group creator can remove members'},
                     status=403
                     )
             try:
-                user_obj = splitAppModels.User.objects.get(user__username=username)
+                user_obj = helpers.get_user_by_username(username)
                 membership_obj = splitAppModels.Membership.objects.get(
                     user=user_obj, group=group_obj
                 )
@@ -163,6 +184,7 @@ class RemoveMemberFromGroupView(APIView):
 
             # remove user from group if balances are settled
             membership_obj.delete()
+            splitAppCache.bump_group_ledger_versions([group_obj.id])
             content = {'message': 'Member removed successfully!'}
             return Response(content)
         except Exception as e:
@@ -180,71 +202,63 @@ class AddBillView(APIView):
         try:
             group_name = request.data.get("groupname")
             user = request.user.user
+            bill_title = request.data.get("title")
+            split_type = request.data.get("split_type")
+            split_data = request.data.get("split_data", {})
+            pay_data = request.data.get("pay_data")
 
+            # group and the members involved in the bill in one
+            # query, shared by validation, split computation and
+            # persistence. All members only for an equal split
+            # between everyone
             try:
-                group_obj = splitAppModels.Group.objects.get(name=group_name)
-            except:
+                roster = helpers.GroupRoster.load_by_name(
+                    group_name, helpers.bill_usernames(split_type, split_data, pay_data)
+                )
+            except splitAppModels.Group.DoesNotExist:
                 return Response(
                     {'error': 'Group not found!'},
                     status=404
                     )
+            group_obj = roster.group
 
-            bill_title = request.data.get("title")
-            bill_amount = float(request.data.get("amount"))
-
-            split_type = request.data.get("split_type")
-            split_data = request.data.get("split_data", {})
-            pay_data = request.data.get("pay_data")
+            # amounts are stored in minor units of group currency
+            bill_amount, split_data, pay_data = helpers.bill_data_to_minor_units(
+                request.data.get("amount"), split_type,
+                split_data, pay_data, group_obj.default_currency
+            )
 
             # validate data sent in bill.
             # split amounts/percentages should match total
             is_valid, msg = helpers.validate_bill_split(bill_amount, split_type,
-                                                    split_data, pay_data, group_obj)
+                                                    split_data, pay_data, roster)
 
             if not is_valid:
                 return Response({'error': msg}, status=400)
 
             # calculate expenses and payments on the basis of split data
             expense_data = helpers.compute_expense(bill_amount, split_type,
-                                                    split_data, pay_data, group_obj)
+                                                    split_data, pay_data, roster)
             payments_data = helpers.compute_payments(expense_data)
 
-            # create Bill record
-            bill_object = splitAppModels.Bill.objects.create(
-                title=bill_title, group=group_obj,
-                added_by=request.user.user, bill_amount=bill_amount
-                )
-
-            # save all expenses and payments atomically
+            # save bill with all expenses and payments atomically
             # to handle concurrency issues
             with transaction.atomic():
-                for user, expense in expense_data.items():
-                    if expense != [0,0]:
-                        expense_obj = splitAppModels.Expense(
-                            bill=bill_object, user=user,
-                            amount_paid=expense[0], amount_owed=expense[1]
-                            )
-                        expense_obj.save()
-
-                for payment in payments_data:
-                    payment_obj = splitAppModels.Payment(
-                        payer = payment["from"],
-                        receiver = payment["to"],
-                        amount = payment["amount"],
-                        bill=bill_object
+                # group lock before the bill insert, the insert holds
+                # a shared lock on the group row for its foreign key and
+                # concurrent bills would deadlock upgrading it later
+                splitAppModels.Group.objects.select_for_update().get(id=group_obj.id)
+                bill_object = splitAppModels.Bill.objects.create(
+                    title=bill_title, group=group_obj,
+                    added_by=user, bill_amount=bill_amount
                     )
-                    payment_obj.save()
-
-            user_list = [expense_data.keys()]
+                helpers.create_bill_records(bill_object, expense_data, payments_data)
 
-            # auto settle group balances between 2 users if
-            # overall owe amount is 0 spanning accross multiple groups
-            # Running in background thread as this could be complex
-            # and take more time depending on users/groups
-            threading.Thread(
-                target=helpers.auto_settle,
-                args = (user_list)
-            ).start()
+                # auto settle group balances between 2 users if
+                # overall owe amount is 0 spanning accross multiple groups.
+                # Queued for run_settle_worker as this could be complex
+                # and take more time depending on users/groups
+                helpers.enqueue_auto_settle(expense_data.keys())
 
             content = {'message': 'Bill added successfully!'}
             return Response(content)
@@ -253,6 +267,66 @@ class AddBillView(APIView):
             return Response({'error': str(e)}, status=400)
 
 
+class ImportBillsView(APIView):
+    """
+    Bulk import bills into a group from an
+    NDJSON or CSV file
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        try:
+            user = request.user.user
+            group_name = request.data.get("groupname")
+            bills_file = request.data.get("file")
+
+            if not bills_file:
+                return Response(
+                    {'error': 'Bills file not sent in request!'},
+                    status=400
+                    )
+            import_format = request.data.get("import_format") or (
+                'csv' if bills_file.name.endswith('.csv') else 'ndjson'
+            )
+
+            try:
+                group_obj = helpers.get_group_by_name(group_name)
+            except:
+                return Response(
+                    {'error': 'Group not found!'},
+                    status=404
+                    )
+
+            user_is_member = helpers.is_group_member(group_obj.id, user.id)
+            if not user_is_member:
+                return Response(
+                    {'error': 'You are not a member of the group!'},
+                    status=403
+                    )
+
+            # read the upload line by line instead of loading it
+            try:
+                rows = splitAppImporter.iter_import_rows(
+                    codecs.iterdecode(bills_file, 'utf-8'), import_format
+                )
+            except ValueError as e:
+                return Response({'error': str(e)}, status=400)
+            imported, failed, errors = splitAppImporter.import_bills(
+                group_obj, user, rows
+            )
+
+            content = {
+                'message': 'Bills imported successfully!',
+                'imported': imported,
+                'failed': failed,
+                'errors': errors,
+            }
+            return Response(content)
+        except Exception as e:
+            print(str(e))
+            return Response({'error': str(e)}, status=400)
+
+
 class EditBillView(APIView):
     """
     Edit already created bill
@@ -265,7 +339,9 @@ class EditBillView(APIView):
             bill_id = request.data.get("bill_id")
 
             try:
-                bill_object = splitAppModels.Bill.objects.get(id=bill_id)
+                bill_object = splitAppModels.Bill.objects.select_related(
+                    'group'
+                ).get(id=bill_id)
             except:
                 return Response(
                     {'error': 'Bill not found!'},
@@ -273,15 +349,24 @@ class EditBillView(APIView):
                     )
 
             bill_title = request.data.get("title")
-            bill_amount = float(request.data.get("amount"))
-
             split_type = request.data.get("split_type")
             split_data = request.data.get("split_data", {})
             pay_data = request.data.get("pay_data")
 
+            # only members involved in the updated bill are loaded
+            roster = helpers.GroupRoster.load(
+                bill_object.group,
+                helpers.bill_usernames(split_type, split_data, pay_data)
+            )
+
+            bill_amount, split_data, pay_data = helpers.bill_data_to_minor_units(
+                request.data.get("amount"), split_type,
+                split_data, pay_data, bill_object.group.default_currency
+            )
+
             # validate updated bill details
             is_valid, msg = helpers.validate_bill_split(
-                bill_amount, split_type, split_data, pay_data, bill_object.group
+                bill_amount, split_type, split_data, pay_data, roster
             )
 
             if not is_valid:
@@ -289,38 +374,41 @@ class EditBillView(APIView):
 
             # compute payments and expenses for new data
             expense_data = helpers.compute_expense(
-                bill_amount, split_type, split_data, pay_data, bill_object.group
+                bill_amount, split_type, split_data, pay_data, roster
             )
             payments_data = helpers.compute_payments(expense_data)
 
-            bill_object.title = bill_title
-            bill_object.bill_amount = bill_amount
-            bill_object.save()
-
-            # create new payments and expenses and delete older ones
+            # write only changed payments and expenses
             # atomically to handle concurrency.
             with transaction.atomic():
-                splitAppModels.Expense.objects.filter(bill=bill_object).delete()
-                splitAppModels.Payment.objects.filter(bill=bill_object).delete()
-
-                for user, expense in expense_data.items():
-                    if expense != [0,0]:
-                        expense_obj = splitAppModels.Expense(
-                            bill=bill_object, user=user,
-                            amount_paid=expense[0], amount_owed=expense[1]
-                        )
-                        expense_obj.save()
-
-                for payment in payments_data:
-                    payment_obj = splitAppModels.Payment(
-                        payer = payment["from"],
-                        receiver = payment["to"],
-                        amount = payment["amount"],
-                        bill=bill_object
-                    )
-                    payment_obj.save()
+                # lock bill so concurrent edits do not apply
+                # the same change twice in the balance ledger
+                splitAppModels.Bill.objects.select_for_update().get(id=bill_object.id)
+
+                bill_object.title = bill_title
+                bill_object.bill_amount = bill_amount
+                bill_object.save()
+
+                balance_delta, payment_delta = helpers.update_bill_records(
+                    bill_object, expense_data, payments_data
+                )
 
-            content = {'message': 'Bill updated successfully!'}
+            # report what changed so clients can adjust
+            # balances they hold without refetching
+            currency = bill_object.group.default_currency
+            content = {
+                'message': 'Bill updated successfully!',
+                'balance_delta': helpers.owe_map_to_major_units(
+                    balance_delta, currency
+                ),
+                'payment_delta': [
+                    {
+                        "from": payment["from"], "to": payment["to"],
+                        "amount": helpers.to_major_units(payment["amount"], currency)
+                    }
+                    for payment in payment_delta
+                ],
+            }
             return Response(content)
         except Exception as e:
             print(str(e))
@@ -340,14 +428,151 @@ class GetGroupBalanceView(APIView):
             user = request.user.user
 
             try:
-                group_obj = splitAppModels.Group.objects.get(name=group_name)
+                group_obj = helpers.get_group_by_name(group_name)
             except:
                 return Response(
                     {'error': 'Group not found!'},
                     status=404
                     )
-            owe_map = helpers.compute_group_user_balance(user, group_obj)
-            return Response(owe_map)
+
+            # balance counting only payments made up to a date
+            as_of = request.data.get("as_of")
+            if as_of:
+                as_of = parse_datetime(str(as_of))
+                if as_of is None:
+                    return Response(
+                        {'error': 'Invalid as_of date!'},
+                        status=400
+                        )
+                if timezone.is_naive(as_of):
+                    as_of = timezone.make_aware(as_of)
+                owe_map = helpers.compute_group_user_balance_as_of(
+                    user, group_obj, as_of
+                )
+            else:
+                owe_map = helpers.compute_group_user_balance(user, group_obj)
+            return Response(
+                helpers.owe_map_to_major_units(owe_map, group_obj.default_currency)
+            )
+        except Exception as e:
+            print(str(e))
+            return Response({'error': str(e)}, status=400)
+
+
+class GetGroupBillsView(APIView):
+    """
+    Get bill history of a group, newest first,
+    one page at a time
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        try:
+            group_name = request.query_params.get(
+                "groupname", request.data.get("groupname")
+            )
+            cursor = request.query_params.get("cursor", request.data.get("cursor"))
+            limit = request.query_params.get("limit", request.data.get("limit"))
+            user = request.user.user
+
+            try:
+                limit = int(limit or settings.BILL_HISTORY_PAGE_SIZE)
+            except ValueError:
+                return Response({'error': 'Invalid limit!'}, status=400)
+            if not 0 < limit <= settings.BILL_HISTORY_MAX_PAGE_SIZE:
+                return Response(
+                    {'error': 'limit should be between 1 and %s' % (
+                        settings.BILL_HISTORY_MAX_PAGE_SIZE
+                    )},
+                    status=400
+                    )
+
+            try:
+                group_obj = helpers.get_group_by_name(group_name)
+            except:
+                return Response(
+                    {'error': 'Group not found!'},
+                    status=404
+                    )
+
+            user_is_member = helpers.is_group_member(group_obj.id, user.id)
+            if not user_is_member:
+                return Response(
+                    {'error': 'You are not a member of the group!'},
+                    status=403
+                    )
+
+            try:
+                bills, next_cursor = helpers.get_bill_history_page(
+                    group_obj, cursor, limit
+                )
+            except ValueError as e:
+                return Response({'error': str(e)}, status=400)
+
+            content = {
+                'bills': [
+                    helpers.bill_history_row(bill_obj, group_obj.default_currency)
+                    for bill_obj in bills
+                ],
+                'next_cursor': next_cursor,
+            }
+            return Response(content)
+        except Exception as e:
+            print(str(e))
+            return Response({'error': str(e)}, status=400)
+
+
+class ExportGroupLedgerView(APIView):
+    """
+    Stream every bill, expense and payment of a group
+    as NDJSON or CSV, optionally gzip compressed
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        try:
+            group_name = request.query_params.get(
+                "groupname", request.data.get("groupname")
+            )
+            export_format = request.query_params.get(
+                "export_format", request.data.get("export_format", "ndjson")
+            )
+            compress = request.query_params.get(
+                "gzip", request.data.get("gzip", "")
+            ) in ("1", "true", True)
+            user = request.user.user
+
+            try:
+                group_obj = helpers.get_group_by_name(group_name)
+            except:
+                return Response(
+                    {'error': 'Group not found!'},
+                    status=404
+                    )
+
+            user_is_member = helpers.is_group_member(group_obj.id, user.id)
+            if not user_is_member:
+                return Response(
+                    {'error': 'You are not a member of the group!'},
+                    status=403
+                    )
+
+            try:
+                chunks = splitAppExport.iter_group_export(
+                    group_obj, export_format, compress
+                )
+            except ValueError as e:
+                return Response({'error': str(e)}, status=400)
+
+            filename = '%s.%s' % (group_obj.name, export_format)
+            content_type = 'application/x-ndjson' if export_format == 'ndjson' \
+                else 'text/csv'
+            if compress:
+                filename += '.gz'
+                content_type = 'application/gzip'
+            response = StreamingHttpResponse(chunks, content_type=content_type)
+            response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+            return response
         except Exception as e:
             print(str(e))
             return Response({'error': str(e)}, status=400)
@@ -365,14 +590,14 @@ class SettleGroupBalanceView(APIView):
             username = request.data.get("username")
             user = request.user.user
             try:
-                other_user = splitAppModels.User.objects.get(user__username=username)
+                other_user = helpers.get_user_by_username(username)
             except:
                 return Response(
                     {'error': 'User not found!'},
                     status=404
                     )
             try:
-                group_obj = splitAppModels.Group.objects.get(name=group_name)
+                group_obj = helpers.get_group_by_name(group_name)
             except:
                 return Response(
                     {'error': 'Group not found!'},
@@ -397,8 +622,10 @@ class GetUserBalanceView(APIView):
         try:
             user = request.user.user
 
-            owe_map = helpers.compute_overall_user_balance(user)
-            print(owe_map)
+            # cached per user, bill writes invalidate it
+            owe_map = splitAppCache.get_overall_user_balance(
+                user, helpers.compute_overall_user_balance
+            )
             return Response(owe_map)
         except Exception as e:
             print(str(e))
@@ -422,7 +649,7 @@ class AddUserProfilePictureView(APIView):
                     status=400
                     )
             user.profile_picture = image
-            user.save()
+            user.save(update_fields=['profile_picture', 'updated_on'])
 
             content = {
                 'message': 'User profile pic updated successfully!',
@@ -452,20 +679,22 @@ class AddGroupIconView(APIView):
                     status=400
                     )
             try:
-                group_obj = splitAppModels.Group.objects.get(name=group_name)
+                group_obj = helpers.get_group_by_name(group_name)
             except:
                 return Response(
                     {'error': 'Group not found!'},
                     status=404
                     )
-            if not user == group_obj.created_by:
+            if not user.id == group_obj.created_by_id:
                 return Response(
                     {'error': 'Only group owner can add group icon!'},
                     status=403
                     )
 
+            # group_obj may be a cached snapshot, only
+            # write the icon so other fields are not reverted
             group_obj.group_icon = image
-            group_obj.save()
+            group_obj.save(update_fields=['group_icon', 'updated_on'])
 
             content = {
                 'message': 'Group icon updated successfully!',
@@ -503,9 +732,7 @@ class AddBillCommentView(APIView):
                     status=404
                     )
 
-            user_is_member = splitAppModels.Membership.objects.filter(
-                group=bill_obj.group, user=user
-            ).exists()
+            user_is_member = helpers.is_group_member(bill_obj.group_id, user.id)
 
             if not user_is_member:
                 return Response(
@@ -524,3 +751,123 @@ class AddBillCommentView(APIView):
         except Exception as e:
             print(str(e))
             return Response({'error': str(e)}, status=400)
+
+
+# Async views. DRF views are sync only, so these are plain django
+# async views doing the JWT authentication themselves. Balances of
+# several groups are computed concurrently on worker threads, see
+# helpers.map_in_threads
+
+def _request_data(request):
+    """
+    query params, falling back to a JSON body
+    as sent to the sync balance views
+    """
+    data = {}
+    if request.body and request.content_type == 'application/json':
+        data = json.loads(request.body)
+    data.update(request.GET.dict())
+    return data
+
+
+def _authenticated_user(request):
+    """
+    splitApp User of the request token, None if not authenticated
+    """
+    result = splitAppAuthentication.ProfileJWTAuthentication().authenticate(request)
+    if result is None:
+        return None
+    return result[0].user
+
+
+async def _authenticate(request):
+    """
+    (user, None) for an authenticated GET request,
+    (None, error response) otherwise
+    """
+    if request.method != 'GET':
+        return None, JsonResponse(
+            {'detail': 'Method "%s" not allowed.' % request.method}, status=405
+        )
+    try:
+        user = await sync_to_async(_authenticated_user)(request)
+    except (AuthenticationFailed, InvalidToken) as e:
+        return None, JsonResponse({'detail': str(e.detail)}, status=401)
+    if user is None:
+        return None, JsonResponse(
+            {'detail': 'Authentication credentials were not provided.'}, status=401
+        )
+    return user, None
+
+
+def _group_balance(user, group_obj):
+    return helpers.owe_map_to_major_units(
+        helpers.compute_group_user_balance(user, group_obj),
+        group_obj.default_currency
+    )
+
+
+async def get_group_balance_async(request):
+    """
+    Get balance amounts in a group for
+    logged in user
+    """
+    try:
+        user, error_response = await _authenticate(request)
+        if error_response:
+            return error_response
+        group_name = _request_data(request).get("groupname")
+
+        try:
+            group_obj = await sync_to_async(helpers.get_group_by_name)(group_name)
+        except splitAppModels.Group.DoesNotExist:
+            return JsonResponse({'error': 'Group not found!'}, status=404)
+
+        return JsonResponse(await sync_to_async(_group_balance)(user, group_obj))
+    except Exception as e:
+        print(str(e))
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+async def get_user_balance_async(request):
+    """
+    get overall balance for
+    logged in user
+    """
+    try:
+        user, error_response = await _authenticate(request)
+        if error_response:
+            return error_response
+
+        # cached per user, bill writes invalidate it
+        owe_map = await sync_to_async(splitAppCache.get_overall_user_balance)(
+            user, helpers.compute_overall_user_balance
+        )
+        return JsonResponse(owe_map)
+    except Exception as e:
+        print(str(e))
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+async def get_user_group_balances(request):
+    """
+    Get balance amounts of logged in user in every
+    group they are a member of. Groups are computed
+    concurrently so this takes about as long as the
+    slowest group
+    """
+    try:
+        user, error_response = await _authenticate(request)
+        if error_response:
+            return error_response
+
+        groups = await sync_to_async(helpers.user_groups)(user)
+        balances = await helpers.map_in_threads(
+            lambda group_obj: _group_balance(user, group_obj), groups
+        )
+        return JsonResponse({
+            group_obj.name: balance for group_obj, balance in zip(groups, balances)
+        })
+    except Exception as e:
+        print(str(e))
+        return JsonResponse({'error': str(e)}, status=400)